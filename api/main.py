@@ -1,8 +1,12 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Depends, Header, status
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Depends, Header, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from auth.models import UserBase, UserCreate, UserLogin, Token, UserUpdate, TokenData, StatsResponse, StatsUpdate
+from auth.models import (
+    CourseMember, UserBase, UserCreate, UserLogin, UserProfile, Token, UserUpdate, TokenData, StatsResponse, StatsUpdate
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from pymongo import ReturnDocument
 from typing import List, Dict, Any, Optional
 import os
 import json
@@ -12,11 +16,22 @@ import logging
 from contextlib import asynccontextmanager
 from core.learning_assistant_v2 import LearningAssistant
 from indexing.document_indexer import DocumentIndexer
+from vectorstores import create_vector_store
 from auth.utils import (
     authenticate_user, create_access_token, verify_token,
-    get_password_hash, get_mongo_connection
+    get_password_hash, get_mongo_connection, get_current_user_optional
 )
 from config import settings as config # Import the config settings
+from utils.metrics import metrics
+from utils.tracing import tracer
+from core.prompts import prompts
+from utils.generation_cache import get_generation_cache
+from utils.concurrency_limiter import LimiterRejected, get_llm_limiter
+from core.pregeneration import create_pregenerator
+from llm import request_deadline
+from utils.partitions import (
+    is_course_member, is_reserved_username, owner_for_upload, partition_keys_for, user_courses
+)
 
 # Ensure StatsResponse is imported
 from auth.models import UserBase, UserCreate, UserLogin, Token, UserUpdate, TokenData, StatsResponse, StatsUpdate
@@ -32,12 +47,14 @@ logger = logging.getLogger(__name__)
 # Biến toàn cục để lưu trữ tài nguyên
 assistant = None
 document_indexer = None
+pregenerator = None
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Context manager để quản lý lifecycle của ứng dụng
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global assistant, document_indexer
+    global assistant, document_indexer, pregenerator
+    vector_store = None
     mongo_collection = None # Initialize mongo_collection to None
     milvus_collection_name = os.getenv("MILVUS_COLLECTION_NAME", config.DEFAULT_COLLECTION_NAME) # Use config default
     logger.info(f"Starting EduMentor API with Milvus collection: {milvus_collection_name}")
@@ -55,20 +72,31 @@ async def lifespan(app: FastAPI):
 
     # --- Initialize Assistant and Indexer ---
     try:
+        # Retriever và indexer dùng chung một vector store để dữ liệu mới index được thấy ngay
+        vector_store = create_vector_store(milvus_collection_name)
         # Pass the mongo_collection (which might be None) to the assistant
         assistant = LearningAssistant(
             mongo_collection=mongo_collection,
-            collection_name=milvus_collection_name
+            collection_name=milvus_collection_name,
+            vector_store=vector_store
         )
-        document_indexer = DocumentIndexer(collection_name=milvus_collection_name)
+        document_indexer = DocumentIndexer(collection_name=milvus_collection_name, vector_store=vector_store)
         logger.info("LearningAssistant and DocumentIndexer initialized successfully")
+        # Sinh trước tài liệu học tập sau khi index (tùy chọn, PREGENERATION_ENABLED)
+        pregenerator = create_pregenerator(assistant, get_llm_limiter() if config.LLM_LIMITER_ENABLED else None)
+        if pregenerator:
+            pregenerator.start()
         yield # Application runs here
     except Exception as e:
         logger.error(f"Error initializing core resources (Assistant/Indexer): {e}")
         raise # Raise error if core components fail to initialize
     finally:
         logger.info("Shutting down EduMentor API")
+        if pregenerator:
+            await pregenerator.stop()
         if assistant:
+            # Ghi nốt các lượt hội thoại còn trong hàng đợi trước khi đóng
+            await assistant.chat_history.flush(timeout=10)
             try:
                 assistant.close()
                 logger.info("LearningAssistant closed")
@@ -80,6 +108,12 @@ async def lifespan(app: FastAPI):
                 logger.info("DocumentIndexer closed")
             except Exception as e:
                 logger.error(f"Error closing DocumentIndexer: {e}")
+        if vector_store:
+            try:
+                vector_store.close()
+                logger.info("Vector store closed")
+            except Exception as e:
+                logger.error(f"Error closing vector store: {e}")
 
 # Khởi tạo FastAPI app
 app = FastAPI(
@@ -118,6 +152,7 @@ class SpecificToolInput(BaseModel):
 
 class AskRequest(BaseModel):
     question: str
+    course: Optional[str] = None # Khóa học/môn để tìm thêm trong tài liệu chung của lớp
 
 # --- Models for Quiz Submission ---
 class QuizQuestion(BaseModel):
@@ -153,6 +188,14 @@ class ApiResponse(BaseModel):
     sources: Optional[List[Dict[str, Any]]] = None
     metadata: Optional[Dict[str, Any]] = None
 
+def authorized_course(current_user: Optional[Dict], course: Optional[str]) -> Optional[str]:
+    """The requested course if the caller is enrolled in it (profile "courses"), 403 otherwise."""
+    if not course or not course.strip():
+        return None
+    if not is_course_member(current_user, course):
+        raise HTTPException(status_code=403, detail=f"Bạn không thuộc khóa học '{course}'")
+    return course
+
 # Thư mục lưu trữ file upload
 UPLOAD_DIR = Path("uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
@@ -160,9 +203,23 @@ UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 # --- Endpoints API ---
 
 @app.post("/upload", response_model=UploadResponse)
-async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+async def upload_file(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    subject: Optional[str] = Form(None),
+    current_user: Optional[Dict] = Depends(get_current_user_optional)
+):
     """Upload file và chạy indexing trong background."""
+    # Upload ẩn danh sẽ rơi vào phân vùng dùng chung mà mọi người đều đọc được
+    if not current_user:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Cần đăng nhập để upload tài liệu",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     try:
+        # Tài liệu được gắn vào phân vùng của khóa học (nếu có subject) hoặc của người upload
+        owner = owner_for_upload(current_user.get("username"), authorized_course(current_user, subject))
         allowed_extensions = {'.pdf', '.docx', '.doc', '.txt', '.pptx', '.ppt'}
         file_ext = Path(file.filename).suffix.lower()
         
@@ -191,16 +248,20 @@ async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File
             try:
                 metadata = {"original_filename": file.filename}
                 if ext == '.pdf':
-                    result = document_indexer.index_document(str(location), doc_metadata=metadata)
+                    result = document_indexer.index_document(str(location), doc_metadata=metadata, owner=owner)
                 elif ext in ['.pptx', '.ppt']:
-                    result = document_indexer.index_document(str(location), file_type="pptx", doc_metadata=metadata)
+                    result = document_indexer.index_document(str(location), file_type="pptx", doc_metadata=metadata, owner=owner)
                 elif ext in ['.docx', '.doc']:
-                    result = document_indexer.index_document(str(location), file_type="docx", doc_metadata=metadata)
+                    result = document_indexer.index_document(str(location), file_type="docx", doc_metadata=metadata, owner=owner)
                 else:  # .txt
-                    result = document_indexer.index_document(str(location), doc_metadata=metadata)
+                    result = document_indexer.index_document(str(location), doc_metadata=metadata, owner=owner)
                 
                 if result.get("success"):
                     logger.info(f"Indexed {location.name}: {result.get('documents_added', 0)} chunks added")
+                    # Nạp lại BM25/posting list để tài liệu mới có mặt trong tìm kiếm từ khóa và tra cứu theo slide
+                    assistant.retriever.refresh_index()
+                    if pregenerator:
+                        pregenerator.submit(location.name, owner)
                 else:
                     logger.error(f"Indexing failed for {location.name}: {result.get('error', 'Unknown error')}")
             except Exception as e:
@@ -215,7 +276,7 @@ async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File
             documents_added=0,
             file_type=file_ext,
             message="File đã được nhận và đang được xử lý trong background",
-            metadata={"saved_as": safe_filename}
+            metadata={"saved_as": safe_filename, "owner": owner}
         )
     except HTTPException as e:
         raise e
@@ -281,7 +342,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
 
 @app.post("/ask", response_model=ApiResponse)
 # Add optional current_user dependency (now defined above)
-async def ask_question(request: AskRequest, current_user: Optional[dict] = Depends(get_current_user)): 
+async def ask_question(request: AskRequest, current_user: Optional[dict] = Depends(get_current_user),
+                       x_request_id: Optional[str] = Header(None)):
     """Xử lý câu hỏi từ người dùng. Lưu lịch sử nếu người dùng đã đăng nhập."""
     if not request.question.strip():
         raise HTTPException(status_code=400, detail="Câu hỏi không được để trống")
@@ -289,13 +351,18 @@ async def ask_question(request: AskRequest, current_user: Optional[dict] = Depen
     if not assistant:
         raise HTTPException(status_code=503, detail="Hệ thống đang khởi động, vui lòng thử lại sau")
 
+    course = authorized_course(current_user, request.course)
+    # Mọi span của request (node, truy xuất, công cụ, LLM) gắn với request ID này
+    trace = tracer.start_trace("ask", request_id=x_request_id)
     try:
         # Extract username if authenticated
         username = current_user.get("username") if current_user else None
         
-        logger.info(f"Processing question for user '{username or 'anonymous'}': {request.question[:100]}...")
+        logger.info(f"[{trace.request_id}] Processing question for user '{username or 'anonymous'}': {request.question[:100]}...")
         # Pass username to the answer method
-        result = await asyncio.wait_for(assistant.answer(request.question, username=username), timeout=120.0) 
+        # Mọi lời gọi LLM (kể cả thử lại) phải xong trong thời hạn của request
+        with tracer.use_trace(trace), request_deadline(config.API_TIMEOUT):
+            result = await asyncio.wait_for(assistant.answer(request.question, username=username, course=course), timeout=config.API_TIMEOUT)
 
         if not result or "response" not in result:
             logger.error(f"Invalid response from workflow: {result}")
@@ -305,7 +372,10 @@ async def ask_question(request: AskRequest, current_user: Optional[dict] = Depen
             "timestamp": asyncio.get_event_loop().time(),
             "route_decision": result.get("metadata", {}).get("route_decision"),
             "selected_tool": result.get("metadata", {}).get("selected_tool"),
-            "executed_tools": list(result.get("tool_outputs", {}).keys()) if result.get("tool_outputs") else []
+            "executed_tools": list(result.get("tool_outputs", {}).keys()) if result.get("tool_outputs") else [],
+            # Giai đoạn truy xuất đã chạy/bị bỏ qua và lý do (retriever suy giảm)
+            "retrieval": result.get("metadata", {}).get("retrieval"),
+            "timings": trace.breakdown()
         }
 
         return ApiResponse(
@@ -318,11 +388,70 @@ async def ask_question(request: AskRequest, current_user: Optional[dict] = Depen
         return ApiResponse(
             response="Quá thời gian xử lý câu hỏi. Vui lòng thử lại.",
             sources=[],
-            metadata={"error": "timeout"}
+            metadata={"error": "timeout", "timings": trace.breakdown()}
 )
+    except LimiterRejected as e:
+        logger.warning(f"Rejected /ask under LLM overload: {e}")
+        raise HTTPException(status_code=503, detail="Hệ thống đang quá tải, vui lòng thử lại sau",
+                            headers={"Retry-After": str(int(config.LLM_QUEUE_TIMEOUT_SECONDS) or 1)})
     except Exception as e:
         logger.error(f"Error processing /ask: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Lỗi máy chủ khi xử lý câu hỏi: {str(e)}")
+    finally:
+        tracer.end_trace(trace)
+
+
+def _sse(event: str, data: Any) -> str:
+    """Formats one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@app.post("/ask/stream")
+async def ask_question_stream(request: AskRequest, current_user: Optional[dict] = Depends(get_current_user),
+                              x_request_id: Optional[str] = Header(None)):
+    """
+    Như /ask nhưng trả về Server-Sent Events: `route`, `sources`, `tool`, từng `token` của câu trả lời,
+    `sources_text` (danh sách nguồn đã định dạng) và cuối cùng `done` (hoặc `error`).
+    """
+    if not request.question.strip():
+        raise HTTPException(status_code=400, detail="Câu hỏi không được để trống")
+
+    if not assistant:
+        raise HTTPException(status_code=503, detail="Hệ thống đang khởi động, vui lòng thử lại sau")
+
+    username = current_user.get("username") if current_user else None
+    course = authorized_course(current_user, request.course)
+    trace = tracer.start_trace("ask_stream", request_id=x_request_id)
+    logger.info(f"[{trace.request_id}] Streaming question for user '{username or 'anonymous'}': {request.question[:100]}...")
+
+    async def event_stream():
+        deadline = asyncio.get_running_loop().time() + config.API_TIMEOUT
+        events = assistant.answer_stream(request.question, username=username, course=course).__aiter__()
+        try:
+            while True:
+                remaining = deadline - asyncio.get_running_loop().time()
+                try:
+                    # Mỗi bước chạy trong task riêng nên trace và thời hạn được đặt lại cho từng bước
+                    with tracer.use_trace(trace), request_deadline(remaining):
+                        item = await asyncio.wait_for(events.__anext__(), timeout=max(remaining, 0.001))
+                except StopAsyncIteration:
+                    break
+                if item["event"] == "done":
+                    item["data"].setdefault("metadata", {})["timings"] = trace.breakdown()
+                yield _sse(item["event"], item["data"])
+        except asyncio.TimeoutError:
+            logger.warning(f"Timeout streaming question: {request.question[:50]}...")
+            yield _sse("error", {"message": "Quá thời gian xử lý câu hỏi. Vui lòng thử lại.", "error": "timeout"})
+        finally:
+            await events.aclose()
+            tracer.end_trace(trace)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # Tắt buffer của proxy (nginx) để token tới client ngay
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": trace.request_id}
+    )
 
 
 # Endpoint để thực thi một công cụ cụ thể qua path parameter
@@ -330,7 +459,8 @@ async def ask_question(request: AskRequest, current_user: Optional[dict] = Depen
 async def use_specific_tool(
     tool_name: str, 
     request: SpecificToolInput,
-    current_user: Dict = Depends(get_current_user)  # Thêm dependency này để xác thực người dùng
+    current_user: Dict = Depends(get_current_user),  # Thêm dependency này để xác thực người dùng
+    x_request_id: Optional[str] = Header(None)
 ): 
     """Thực thi một công cụ cụ thể theo tên được cung cấp trong URL path."""
     tool_map = {
@@ -354,6 +484,7 @@ async def use_specific_tool(
     if not assistant or not assistant.tool_registry.has_tool(actual_tool_name):
         raise HTTPException(status_code=503, detail=f"Hệ thống đang khởi động hoặc công cụ '{actual_tool_name}' không khả dụng.")
 
+    course = authorized_course(current_user, (request.options or {}).get("course"))
     try:
         # Chuẩn bị arguments cho tool execute
         # 'question' là key mặc định mà nhiều tool dùng cho input chính
@@ -373,22 +504,28 @@ async def use_specific_tool(
         # Cập nhật tool_kwargs với options đã được bổ sung username
         if options:
             tool_kwargs["options"] = options
+
+        # Chỉ tìm trong tài liệu dùng chung, của người dùng và của khóa học được chọn
+        tool_kwargs["partition_keys"] = partition_keys_for(current_user.get("username"), course)
         
         logger.info(f"Executing tool: {actual_tool_name} with input: {request.input[:50]}...")
-        result = await assistant.tool_registry.execute_tool(actual_tool_name, **tool_kwargs)
+        with tracer.trace_request("tools", request_id=x_request_id) as trace, request_deadline(config.API_TIMEOUT):
+            result = await assistant.tool_registry.execute_tool(actual_tool_name, **tool_kwargs)
         
         # Xử lý đặc biệt cho Progress_Tracker
         if actual_tool_name == "Progress_Tracker":
             # Trả về dữ liệu trực tiếp không cần chuyển đổi nữa vì tool đã trả về dict
             return ApiResponse(
                 response=result,
-                metadata={"tool_executed": actual_tool_name, "input_provided": request.input[:100]}
+                metadata={"tool_executed": actual_tool_name, "input_provided": request.input[:100],
+                          "timings": trace.breakdown()}
             )
         else:
             # Các công cụ khác vẫn xử lý như bình thường
             return ApiResponse(
                 response=result,
-                metadata={"tool_executed": actual_tool_name, "input_provided": request.input[:100]}
+                metadata={"tool_executed": actual_tool_name, "input_provided": request.input[:100],
+                          "timings": trace.breakdown()}
             )
     except Exception as e:
         logger.error(f"Error executing tool {actual_tool_name}: {e}", exc_info=True)
@@ -441,6 +578,33 @@ async def root():
     """Kiểm tra trạng thái API."""
     return {"status": "EduMentor API is running", "version": "2.0.0"}
 
+@app.get("/metrics", summary="Số liệu vận hành nội bộ")
+async def get_metrics():
+    """Trả về các bộ đếm và gauge trong tiến trình (coalescing, cache, ...) và trạng thái vector store."""
+    snapshot = metrics.snapshot()
+    if assistant and assistant.retriever.vector_store:
+        try:
+            snapshot["vector_store"] = await asyncio.to_thread(assistant.retriever.vector_store.stats)
+        except Exception as e:
+            snapshot["vector_store"] = {"error": str(e)}
+    generation_cache = get_generation_cache()
+    if generation_cache is not None:
+        snapshot["generation_cache"] = await asyncio.to_thread(generation_cache.stats)
+    if assistant:
+        snapshot["chat_history"] = assistant.chat_history.stats()
+    snapshot["prompt_versions"] = prompts.versions()
+    return snapshot
+
+@app.get("/traces/{request_id}", summary="Các span của một request")
+async def get_trace(request_id: str):
+    """Trả về các span (theo thứ tự bắt đầu) của một request gần đây, từ exporter trong bộ nhớ."""
+    if tracer.memory_exporter is None:
+        raise HTTPException(status_code=404, detail="Tracing đang tắt")
+    spans = tracer.memory_exporter.get_finished_spans(request_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy span cho request '{request_id}'")
+    return {"request_id": request_id, "spans": [span.to_dict() for span in sorted(spans, key=lambda s: s.start_time)]}
+
 # --- Authentication & User Management Endpoints ---
 
 # get_current_user is now defined above the endpoints that use it
@@ -451,6 +615,10 @@ async def register_user(user: UserCreate):
     try:
         collection = get_mongo_connection()
         
+        # Tên trùng phân vùng dùng chung hoặc khóa học sẽ đọc/ghi nhầm tài liệu của phân vùng đó
+        if is_reserved_username(user.username):
+            raise HTTPException(status_code=400, detail="Username không hợp lệ")
+
         # Kiểm tra xem người dùng đã tồn tại chưa
         existing_user = collection.find_one({"_id": user.username})
         if existing_user:
@@ -548,7 +716,7 @@ async def login(user_data: UserLogin):
         "full_name": user.get("full_name")
     }
 
-@app.get("/me", response_model=UserBase)
+@app.get("/me", response_model=UserProfile)
 async def get_user_profile(current_user: dict = Depends(get_current_user)):
     """Lấy thông tin người dùng hiện tại"""
     try:
@@ -565,7 +733,8 @@ async def get_user_profile(current_user: dict = Depends(get_current_user)):
         return {
             "username": current_user["username"],
             "email": current_user.get("email"),
-            "full_name": current_user.get("full_name")
+            "full_name": current_user.get("full_name"),
+            "courses": user_courses(current_user)
         }
     except HTTPException:
         raise
@@ -613,6 +782,56 @@ async def update_user_profile(user_update: UserUpdate, current_user: dict = Depe
         raise HTTPException(status_code=500, detail="Lỗi máy chủ khi cập nhật thông tin người dùng")
 
 
+# --- Course Enrollment Endpoints ---
+
+def require_admin(current_user: dict) -> None:
+    if not current_user.get("is_admin", False):
+        raise HTTPException(status_code=403, detail="Chỉ admin được quản lý thành viên khóa học")
+
+def _course_name(course: str) -> str:
+    name = course.strip().lower()
+    # Tên khóa học tạo thành partition key `course:<tên>`, không được rỗng
+    if not name:
+        raise HTTPException(status_code=400, detail="Tên khóa học không hợp lệ")
+    return name
+
+@app.post("/courses/{course}/members", response_model=UserProfile)
+async def add_course_member(course: str, member: CourseMember, current_user: dict = Depends(get_current_user)):
+    """Ghi danh người dùng vào khóa học (chỉ admin)"""
+    require_admin(current_user)
+    name = _course_name(course)
+    try:
+        collection = get_mongo_connection()
+        user = collection.find_one_and_update(
+            {"_id": member.username}, {"$addToSet": {"courses": name}}, return_document=ReturnDocument.AFTER
+        )
+    except Exception as e:
+        logger.error(f"Error enrolling {member.username} in {name}: {e}")
+        raise HTTPException(status_code=500, detail="Lỗi máy chủ khi ghi danh")
+    if not user:
+        raise HTTPException(status_code=404, detail="Người dùng không tồn tại")
+    logger.info(f"{current_user['username']} enrolled {member.username} in course '{name}'")
+    return {"username": user["username"], "email": user.get("email"), "full_name": user.get("full_name"),
+            "courses": user_courses(user)}
+
+@app.delete("/courses/{course}/members/{username}", response_model=UserProfile)
+async def remove_course_member(course: str, username: str, current_user: dict = Depends(get_current_user)):
+    """Xóa người dùng khỏi khóa học (chỉ admin)"""
+    require_admin(current_user)
+    name = _course_name(course)
+    try:
+        collection = get_mongo_connection()
+        user = collection.find_one_and_update({"_id": username}, {"$pull": {"courses": name}}, return_document=ReturnDocument.AFTER)
+    except Exception as e:
+        logger.error(f"Error removing {username} from {name}: {e}")
+        raise HTTPException(status_code=500, detail="Lỗi máy chủ khi xóa thành viên")
+    if not user:
+        raise HTTPException(status_code=404, detail="Người dùng không tồn tại")
+    logger.info(f"{current_user['username']} removed {username} from course '{name}'")
+    return {"username": user["username"], "email": user.get("email"), "full_name": user.get("full_name"),
+            "courses": user_courses(user)}
+
+
 # --- Stats Endpoints ---
 
 @app.get("/stats/{username}", response_model=StatsResponse)
@@ -7,6 +7,13 @@ class UserBase(BaseModel):
     email: Optional[EmailStr] = None
     full_name: Optional[str] = None
 
+class UserProfile(UserBase):
+    # Khóa học đã ghi danh (chữ thường); chỉ admin thay đổi qua /courses/{course}/members
+    courses: List[str] = []
+
+class CourseMember(BaseModel):
+    username: str
+
 class UserCreate(UserBase):
     password: str
 
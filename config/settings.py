@@ -11,6 +11,42 @@ MILVUS_PORT = os.getenv("MILVUS_PORT", "19530")
 # Giá trị này có thể bị ghi đè bởi lifespan nếu cần
 DEFAULT_COLLECTION_NAME = "learning_docs_v3"
 MILVUS_COLLECTION = os.getenv("MILVUS_COLLECTION", DEFAULT_COLLECTION_NAME)
+# Alias kết nối riêng của ứng dụng (không dùng alias "default" dùng chung)
+MILVUS_CONNECTION_ALIAS = os.getenv("MILVUS_CONNECTION_ALIAS", "edumentor")
+MILVUS_TIMEOUT = float(os.getenv("MILVUS_TIMEOUT", 10))
+MILVUS_MAX_RETRIES = int(os.getenv("MILVUS_MAX_RETRIES", 2))
+MILVUS_RETRY_BACKOFF = float(os.getenv("MILVUS_RETRY_BACKOFF", 0.2))
+# Circuit breaker: mở sau N lần lỗi liên tiếp, thử lại sau số giây cấu hình
+MILVUS_CIRCUIT_FAILURES = int(os.getenv("MILVUS_CIRCUIT_FAILURES", 3))
+MILVUS_CIRCUIT_RESET_SECONDS = float(os.getenv("MILVUS_CIRCUIT_RESET_SECONDS", 30))
+# Chu kỳ kiểm tra sức khỏe kết nối (giây), 0 để tắt
+MILVUS_HEALTH_INTERVAL = float(os.getenv("MILVUS_HEALTH_INTERVAL", 15))
+
+# --- Vector Store Backend ---
+# "milvus" (mặc định) hoặc "local" (NumPy/FAISS trong tiến trình, lưu trên đĩa)
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "milvus").lower()
+LOCAL_VECTOR_STORE_DIR = os.getenv("LOCAL_VECTOR_STORE_DIR", "vector_store")
+LOCAL_VECTOR_STORE_FAISS = os.getenv("LOCAL_VECTOR_STORE_FAISS", "false").lower() == "true"
+
+# --- Multi-tenancy (Milvus partition key) ---
+# Trường partition key: chủ sở hữu (username) hoặc khóa học ("course:<môn>") của tài liệu
+MILVUS_PARTITION_KEY_FIELD = "owner"
+MILVUS_NUM_PARTITIONS = int(os.getenv("MILVUS_NUM_PARTITIONS", 64))
+# Tài liệu không gắn người dùng/khóa học được xếp vào phân vùng dùng chung
+SHARED_PARTITION_KEY = os.getenv("SHARED_PARTITION_KEY", "shared")
+
+# --- Cross-encoder rerank (tùy chọn) ---
+# Để trống để tắt; ví dụ: "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1" (đa ngôn ngữ, có tiếng Việt)
+CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "")
+# "auto": thử ONNX, sau đó PyTorch (lượng tử hóa int8); hoặc chỉ định "onnx" / "torch"
+CROSS_ENCODER_BACKEND = os.getenv("CROSS_ENCODER_BACKEND", "auto").lower()
+CROSS_ENCODER_TOP_N = int(os.getenv("CROSS_ENCODER_TOP_N", 8))
+CROSS_ENCODER_BUDGET_MS = float(os.getenv("CROSS_ENCODER_BUDGET_MS", 150))
+CROSS_ENCODER_CACHE_SIZE = int(os.getenv("CROSS_ENCODER_CACHE_SIZE", 4096))
+
+# --- MMR (đa dạng hóa kết quả truy xuất) ---
+# 1.0 = chỉ xét độ liên quan (tắt MMR); càng nhỏ càng loại bỏ mạnh các đoạn trùng lặp
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7))
 
 # --- MongoDB Configuration ---
 MONGODB_HOST = os.getenv("MONGODB_HOST", "localhost") 
@@ -31,6 +67,41 @@ EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 LLM_MODEL_NAME = os.getenv("LLM_MODEL_NAME")
 LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", 0.05))
+# "gemini" (mặc định) hoặc "fake" (LLM giả cục bộ để đo thông lượng offline)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+# Độ trễ token đầu tiên của LLM giả: trung bình, độ lệch và phân phối (constant, uniform, normal, lognormal)
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", 800))
+FAKE_LLM_LATENCY_JITTER_MS = float(os.getenv("FAKE_LLM_LATENCY_JITTER_MS", 200))
+FAKE_LLM_LATENCY_DISTRIBUTION = os.getenv("FAKE_LLM_LATENCY_DISTRIBUTION", "lognormal").lower()
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", 60))
+# Tỷ lệ lỗi giả lập (0..1) để thử cơ chế thử lại
+FAKE_LLM_FAILURE_RATE = float(os.getenv("FAKE_LLM_FAILURE_RATE", 0))
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", 0))
+
+# --- LLM Concurrency Limiter ---
+# Giới hạn số lời gọi LLM đồng thời (AIMD: tăng dần khi nhanh, giảm một nửa khi bị 429 hoặc chậm)
+LLM_LIMITER_ENABLED = os.getenv("LLM_LIMITER_ENABLED", "true").lower() == "true"
+LLM_CONCURRENCY_INITIAL = int(os.getenv("LLM_CONCURRENCY_INITIAL", 8))
+LLM_CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", 1))
+LLM_CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", 32))
+# Lời gọi lâu hơn ngưỡng này được coi là dấu hiệu quá tải
+LLM_LATENCY_TARGET_SECONDS = float(os.getenv("LLM_LATENCY_TARGET_SECONDS", 15))
+# Số lời gọi chờ tối đa theo mức ưu tiên; hàng đợi đầy thì từ chối ngay
+LLM_QUEUE_SIZE_INTERACTIVE = int(os.getenv("LLM_QUEUE_SIZE_INTERACTIVE", 64))
+LLM_QUEUE_SIZE_ROUTING = int(os.getenv("LLM_QUEUE_SIZE_ROUTING", 64))
+LLM_QUEUE_SIZE_BACKGROUND = int(os.getenv("LLM_QUEUE_SIZE_BACKGROUND", 16))
+# Thời gian chờ tối đa trong hàng đợi (0 để chờ không giới hạn)
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", 10))
+
+# --- LLM Call Policy ---
+# Số lần thử lại khi gặp lỗi tạm thời (429, lỗi kết nối, 5xx), backoff lũy thừa có jitter
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))
+LLM_RETRY_BACKOFF_SECONDS = float(os.getenv("LLM_RETRY_BACKOFF_SECONDS", 0.5))
+LLM_RETRY_BACKOFF_CAP_SECONDS = float(os.getenv("LLM_RETRY_BACKOFF_CAP_SECONDS", 8))
+# Gửi thêm một request dự phòng khi request chưa xong sau p95 độ trễ gần đây (cần đủ số mẫu)
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_MIN_DELAY_SECONDS", 1.0))
 
 # --- Web Search Configuration ---
 SERPER_API_KEY = os.getenv("SERPER_API_KEY")
@@ -51,6 +122,85 @@ LOGGING_LEVEL = os.getenv("LOGGING_LEVEL", "INFO").upper()
 RETRIEVER_TOP_K = int(os.getenv("RETRIEVER_TOP_K", 5))
 VECTOR_WEIGHT = float(os.getenv("VECTOR_WEIGHT", 0.7))
 BM25_WEIGHT = float(os.getenv("BM25_WEIGHT", 0.3))
+# Thời hạn mềm cho truy xuất trong /ask: quá hạn thì bỏ rerank và dùng nhánh vector/BM25 đã xong
+RETRIEVAL_DEADLINE_SECONDS = float(os.getenv("RETRIEVAL_DEADLINE_SECONDS", 8))
+# Truy xuất suy đoán: chạy song song với phân tích ý định, bỏ đi nếu tuyến không cần ngữ cảnh
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "true").lower() == "true"
+
+# --- Intent Router ---
+# Định tuyến cục bộ (luật từ khóa + kNN trên ví dụ) trước LLM; yêu cầu không chắc chắn vẫn dùng LLM
+INTENT_ROUTER_ENABLED = os.getenv("INTENT_ROUTER_ENABLED", "true").lower() == "true"
+# Độ tương đồng cosine tối thiểu với ví dụ gần nhất và độ chênh lệch tối thiểu so với hành động đứng thứ hai
+INTENT_ROUTER_MIN_SIMILARITY = float(os.getenv("INTENT_ROUTER_MIN_SIMILARITY", 0.8))
+INTENT_ROUTER_MARGIN = float(os.getenv("INTENT_ROUTER_MARGIN", 0.1))
+
+# Yêu cầu ghép ("giải thích X và tạo quiz") chạy tối đa bấy nhiêu công cụ song song
+MULTI_TOOL_MAX = int(os.getenv("MULTI_TOOL_MAX", 3))
+# Thời hạn riêng cho mỗi công cụ; công cụ quá hạn trả lỗi, các công cụ khác vẫn được dùng
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", 90))
+
+# --- Emotion Analysis ---
+# "local": từ điển + câu mẫu trên encoder sẵn có (không gọi LLM); "llm": phân tích bằng LLM như trước
+EMOTION_BACKEND = os.getenv("EMOTION_BACKEND", "local").lower()
+EMOTION_PROTOTYPE_MIN_SIMILARITY = float(os.getenv("EMOTION_PROTOTYPE_MIN_SIMILARITY", 0.75))
+
+# --- Query Expansion (tùy chọn) ---
+QUERY_EXPANSION_ENABLED = os.getenv("QUERY_EXPANSION_ENABLED", "false").lower() == "true"
+# Dùng thêm LLM để sinh biến thể khi biến thể cục bộ chưa đủ
+QUERY_EXPANSION_LLM = os.getenv("QUERY_EXPANSION_LLM", "false").lower() == "true"
+QUERY_EXPANSION_MAX_VARIANTS = int(os.getenv("QUERY_EXPANSION_MAX_VARIANTS", 3))
+# Chỉ mở rộng câu hỏi ngắn (số từ tối đa)
+QUERY_EXPANSION_MAX_WORDS = int(os.getenv("QUERY_EXPANSION_MAX_WORDS", 12))
+# Thời gian tối đa cho bước sinh biến thể; phần còn lại của RETRIEVAL_DEADLINE_SECONDS dành cho tìm kiếm
+QUERY_EXPANSION_BUDGET_SECONDS = float(os.getenv("QUERY_EXPANSION_BUDGET_SECONDS", 1.5))
+
+# --- Generation Cache ---
+# Cache bền vững (SQLite) cho kết quả sinh của Summary/Mind map/Concept/Study plan
+GENERATION_CACHE_ENABLED = os.getenv("GENERATION_CACHE_ENABLED", "true").lower() == "true"
+GENERATION_CACHE_PATH = os.getenv("GENERATION_CACHE_PATH", os.path.join("cache", "generation_cache.sqlite3"))
+GENERATION_CACHE_MAX_ENTRIES = int(os.getenv("GENERATION_CACHE_MAX_ENTRIES", 2000))
+# 0 để không giới hạn thời gian
+GENERATION_CACHE_TTL_SECONDS = float(os.getenv("GENERATION_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+
+# --- Pre-generation (tùy chọn) ---
+# Sau khi index xong một tài liệu, sinh trước tóm tắt/sơ đồ tư duy/flashcard cho các chủ đề chính vào generation cache
+PREGENERATION_ENABLED = os.getenv("PREGENERATION_ENABLED", "false").lower() == "true"
+PREGENERATION_TOOLS = [name.strip() for name in os.getenv(
+    "PREGENERATION_TOOLS", "Summary_Generator,Mind_Map_Creator,Flashcard_Generator").split(",") if name.strip()]
+# Số chủ đề tối đa mỗi tài liệu (lấy từ tiêu đề và slide)
+PREGENERATION_MAX_TOPICS = int(os.getenv("PREGENERATION_MAX_TOPICS", 5))
+# Tạm dừng khi có lời gọi tương tác đang chờ hoặc limiter LLM đang dùng quá tỷ lệ này
+PREGENERATION_MAX_LOAD = float(os.getenv("PREGENERATION_MAX_LOAD", 0.5))
+PREGENERATION_PAUSE_SECONDS = float(os.getenv("PREGENERATION_PAUSE_SECONDS", 2.0))
+# Số tài liệu chờ sinh trước tối đa; tài liệu mới bị bỏ qua khi hàng đợi đầy
+PREGENERATION_MAX_PENDING = int(os.getenv("PREGENERATION_MAX_PENDING", 16))
+
+# --- Chat History Cache ---
+# Bộ đệm vòng các lượt hội thoại gần nhất của mỗi người dùng trong bộ nhớ (LRU theo người dùng, 0 để luôn đọc MongoDB)
+CHAT_HISTORY_CACHE_USERS = int(os.getenv("CHAT_HISTORY_CACHE_USERS", 1000))
+# Số lượt gần nhất giữ lại và đưa vào prompt
+CHAT_HISTORY_TURNS = int(os.getenv("CHAT_HISTORY_TURNS", 10))
+# Hàng đợi ghi sau (write-behind) xuống MongoDB: kích thước tối đa, số lượt mỗi lần ghi và số lần thử lại
+CHAT_HISTORY_WRITE_QUEUE = int(os.getenv("CHAT_HISTORY_WRITE_QUEUE", 1000))
+CHAT_HISTORY_WRITE_BATCH = int(os.getenv("CHAT_HISTORY_WRITE_BATCH", 100))
+CHAT_HISTORY_WRITE_RETRIES = int(os.getenv("CHAT_HISTORY_WRITE_RETRIES", 3))
+
+# --- Context Packing ---
+# Ngân sách token (ước lượng) cho ngữ cảnh + lịch sử + kết quả công cụ trong một prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# Phần tối đa của ngân sách dành cho lịch sử hội thoại và kết quả công cụ
+HISTORY_TOKEN_SHARE = float(os.getenv("HISTORY_TOKEN_SHARE", 0.25))
+TOOL_OUTPUT_TOKEN_SHARE = float(os.getenv("TOOL_OUTPUT_TOKEN_SHARE", 0.5))
+
+# --- Tracing ---
+# Span có thời gian cho từng node workflow, giai đoạn truy xuất, công cụ và lời gọi LLM
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# Số span gần nhất giữ trong bộ nhớ (tra cứu qua GET /traces/{request_id})
+TRACING_MEMORY_SPANS = int(os.getenv("TRACING_MEMORY_SPANS", 4096))
+# Ghi thêm span ra file JSON Lines, để trống để tắt
+TRACING_FILE = os.getenv("TRACING_FILE", "")
+# Gửi thêm span qua OpenTelemetry API (cần cài opentelemetry-api và cấu hình SDK/exporter)
+TRACING_OTEL = os.getenv("TRACING_OTEL", "false").lower() == "true"
 
 # --- API Configuration ---
 API_PORT = int(os.getenv("API_PORT", 5000))
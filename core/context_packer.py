@@ -0,0 +1,164 @@
+import logging
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypedDict
+
+from config import settings as config
+from utils.metrics import metrics
+from vectorstores.base import parse_metadata
+
+logger = logging.getLogger(__name__)
+
+# Mỗi từ/âm tiết ~1.3 token, mỗi dấu câu ~1 token (ước lượng nhanh, không cần tokenizer của LLM)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_PUNCT_RE = re.compile(r"[^\w\s]", re.UNICODE)
+TOKENS_PER_WORD = 1.3
+
+# Không cắt một chunk xuống dưới mức này; bỏ qua luôn nếu ngân sách còn lại ít hơn
+MIN_CHUNK_TOKENS = 48
+MIN_OVERLAP_CHARS = 16
+
+
+class PackedContext(TypedDict):
+    text: str
+    chunks: List[Dict[str, Any]]
+    tokens: int
+    tokens_saved: int
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Fast local token estimate for Vietnamese/English text."""
+    if not text:
+        return 0
+    return int(len(_WORD_RE.findall(text)) * TOKENS_PER_WORD + len(_PUNCT_RE.findall(text)))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep_tail: bool = False) -> str:
+    """Cuts text to roughly `max_tokens`, at a line or word boundary. `keep_tail` keeps the end."""
+    if max_tokens <= 0:
+        return ""
+    total = estimate_tokens(text)
+    if total <= max_tokens:
+        return text
+    cut = int(len(text) * max_tokens / total)
+    if keep_tail:
+        piece = text[len(text) - cut:]
+        boundary = piece.find("\n")
+        if boundary < 0 or boundary > len(piece) // 2:
+            boundary = piece.find(" ")
+        return piece[boundary + 1:] if 0 <= boundary < len(piece) // 2 else piece
+    piece = text[:cut]
+    boundary = max(piece.rfind("\n"), piece.rfind(". "))
+    if boundary < len(piece) // 2:
+        boundary = piece.rfind(" ")
+    return (piece[:boundary + 1] if boundary > 0 else piece).rstrip() + " …"
+
+
+def overlap_length(left: str, right: str, max_overlap: int = config.CHUNK_OVERLAP * 2) -> int:
+    """Length of the longest suffix of `left` that is also a prefix of `right` (chunk overlap)."""
+    if len(left) < MIN_OVERLAP_CHARS or len(right) < MIN_OVERLAP_CHARS:
+        return 0
+    probe = right[:MIN_OVERLAP_CHARS]
+    position = left.find(probe, max(0, len(left) - max_overlap))
+    while position >= 0:
+        if right.startswith(left[position:]):
+            return len(left) - position
+        position = left.find(probe, position + 1)
+    return 0
+
+
+def trim_overlap(kept_text: str, text: str) -> str:
+    """Drops the parts of `text` repeated from an adjacent chunk that is already kept."""
+    head = overlap_length(kept_text, text)
+    if head:
+        text = text[head:].lstrip()
+    tail = overlap_length(text, kept_text)
+    if tail:
+        text = text[:len(text) - tail].rstrip()
+    return text
+
+
+def _chunk_source(chunk: Dict[str, Any]) -> Any:
+    return parse_metadata(chunk.get("metadata")).get("source")
+
+
+def default_formatter(index: int, chunk: Dict[str, Any], text: str) -> str:
+    return f"[Nguồn {index + 1}]: {text}"
+
+
+def plain_formatter(index: int, chunk: Dict[str, Any], text: str) -> str:
+    return text
+
+
+def slide_formatter(index: int, chunk: Dict[str, Any], text: str) -> str:
+    return f"Slide {chunk.get('slide_number', 'N/A')}: {text}"
+
+
+def pack_chunks(chunks: List[Dict[str, Any]], budget_tokens: Optional[int] = None,
+                formatter: Callable[[int, Dict[str, Any], str], str] = default_formatter,
+                separator: str = "\n\n", label: str = "context") -> PackedContext:
+    """
+    Fits retrieved chunks into `budget_tokens`: highest score first, overlap with
+    already kept chunks of the same source trimmed, the last chunk cut to fit.
+    """
+    budget_tokens = config.CONTEXT_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+    ranked = sorted(chunks, key=lambda chunk: chunk.get("score", 0.0), reverse=True)
+    original_tokens = sum(estimate_tokens(formatter(i, chunk, chunk.get("text", "").strip())) for i, chunk in enumerate(ranked))
+
+    kept: List[Dict[str, Any]] = []
+    kept_texts: List[Tuple[Any, str]] = []
+    parts: List[str] = []
+    used = 0
+    for chunk in ranked:
+        text = chunk.get("text", "").strip()
+        source = _chunk_source(chunk)
+        for kept_source, kept_text in kept_texts:
+            if kept_source == source:
+                # Chunk liền kề có thể nằm trước hoặc sau chunk đã giữ
+                text = trim_overlap(kept_text, text)
+        if not text:
+            continue
+        entry = formatter(len(kept), chunk, text)
+        tokens = estimate_tokens(entry) + (estimate_tokens(separator) if parts else 0)
+        remaining = budget_tokens - used
+        if tokens > remaining:
+            if remaining < MIN_CHUNK_TOKENS:
+                break
+            entry = truncate_to_tokens(entry, remaining)
+            tokens = estimate_tokens(entry)
+        parts.append(entry)
+        kept.append(chunk)
+        kept_texts.append((source, text))
+        used += tokens
+        if used >= budget_tokens:
+            break
+
+    saved = max(0, original_tokens - used)
+    if saved:
+        metrics.increment("context_packer.tokens_saved", saved)
+        logger.info(f"Context packing ({label}): kept {len(kept)}/{len(chunks)} chunks, {used} tokens, saved {saved} tokens")
+    return PackedContext(text=separator.join(parts), chunks=kept, tokens=used, tokens_saved=saved)
+
+
+def pack_prompt_sections(context: Optional[str], chat_history: Optional[str], tool_output: Optional[str],
+                         budget_tokens: Optional[int] = None) -> Tuple[str, str, str]:
+    """
+    Splits one token budget between tool output, retrieved context and chat history.
+    Tool output and history are capped at their configured shares; whatever they do
+    not use goes to the context. History keeps its most recent turns.
+    """
+    budget_tokens = config.CONTEXT_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+    context, chat_history, tool_output = context or "", chat_history or "", tool_output or ""
+    original = estimate_tokens(context) + estimate_tokens(chat_history) + estimate_tokens(tool_output)
+
+    tool_output = truncate_to_tokens(tool_output, int(budget_tokens * config.TOOL_OUTPUT_TOKEN_SHARE))
+    remaining = budget_tokens - estimate_tokens(tool_output)
+    chat_history = truncate_to_tokens(chat_history, min(remaining, int(budget_tokens * config.HISTORY_TOKEN_SHARE)), keep_tail=True)
+    remaining -= estimate_tokens(chat_history)
+    context = truncate_to_tokens(context, remaining)
+
+    used = estimate_tokens(context) + estimate_tokens(chat_history) + estimate_tokens(tool_output)
+    saved = max(0, original - used)
+    if saved:
+        metrics.increment("context_packer.tokens_saved", saved)
+        logger.info(f"Context packing (prompt): {used} tokens, saved {saved} tokens")
+    return context, chat_history, tool_output
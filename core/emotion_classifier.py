@@ -0,0 +1,159 @@
+import logging
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from config import settings as config
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+NEUTRAL: Dict[str, Any] = {"emotion": "neutral", "intensity": 5, "triggers": "unknown", "suggested_tone": "balanced"}
+
+# Từ/cụm từ gợi cảm xúc (tiếng Việt và tiếng Anh) kèm trọng số cường độ
+LEXICON: Dict[str, Dict[str, int]] = {
+    "vui": {"vui": 2, "vui quá": 3, "hạnh phúc": 3, "tuyệt vời": 3, "tuyệt": 2, "hay quá": 2, "thích": 1,
+            "cảm ơn": 1, "cám ơn": 1, "happy": 2, "great": 2, "awesome": 3, "love": 2, "thanks": 1, "haha": 2, "😊": 2, "😄": 2},
+    "phấn khích": {"phấn khích": 3, "háo hức": 3, "hào hứng": 3, "nóng lòng": 2, "không thể chờ": 3, "excited": 3, "can't wait": 3, "🎉": 2},
+    "buồn": {"buồn": 2, "buồn quá": 3, "tủi": 2, "cô đơn": 3, "khóc": 3, "sad": 2, "upset": 2, "😢": 3, "😭": 3},
+    "chán nản": {"chán": 2, "chán nản": 3, "nản": 3, "mệt mỏi": 2, "mệt": 1, "muốn bỏ": 3, "bỏ cuộc": 3, "không muốn học": 3,
+                 "hết động lực": 3, "tired": 2, "bored": 2, "give up": 3, "unmotivated": 3},
+    "thất vọng": {"thất vọng": 3, "trượt": 2, "rớt môn": 3, "điểm kém": 2, "điểm thấp": 2, "failed": 3, "disappointed": 3},
+    "tức giận": {"tức": 2, "tức giận": 3, "bực": 2, "bực mình": 3, "khó chịu": 2, "điên": 3, "vô lý": 2, "angry": 3, "annoyed": 2, "😡": 3},
+    "lo lắng": {"lo": 1, "lo lắng": 3, "sợ": 2, "áp lực": 3, "căng thẳng": 3, "hồi hộp": 2, "sắp thi": 2, "deadline": 2,
+                "worried": 3, "anxious": 3, "stressed": 3, "nervous": 2},
+    "bối rối": {"bối rối": 3, "không hiểu": 2, "chưa hiểu": 2, "khó hiểu": 2, "rối": 2, "lú": 2, "không biết bắt đầu": 3,
+                "confused": 3, "don't understand": 2, "lost": 1},
+    "tò mò": {"tò mò": 3, "thắc mắc": 2, "muốn biết": 2, "tại sao": 1, "vì sao": 1, "curious": 3, "wonder": 2, "why": 1},
+}
+
+# Câu mẫu cho bộ phân loại theo embedding, dùng khi từ điển không khớp
+PROTOTYPES: Dict[str, List[str]] = {
+    "vui": ["Mình làm được bài rồi, vui ghê", "I finally solved it, so happy"],
+    "buồn": ["Hôm nay mình thấy buồn và không muốn làm gì", "I feel down today"],
+    "chán nản": ["Học mãi mà không vào, mình muốn bỏ cuộc", "I'm sick of studying, nothing sticks"],
+    "thất vọng": ["Mình ôn kỹ vậy mà vẫn bị điểm thấp", "I studied so hard and still failed"],
+    "tức giận": ["Bài này ra đề vô lý thật sự", "This assignment is ridiculous"],
+    "lo lắng": ["Tuần sau thi rồi mà mình chưa ôn gì cả", "The exam is next week and I'm not ready"],
+    "bối rối": ["Mình đọc mãi mà vẫn không hiểu phần này", "I'm completely lost on this topic"],
+}
+
+SUGGESTED_TONES: Dict[str, str] = {
+    "vui": "vui vẻ, chia vui cùng người dùng",
+    "phấn khích": "nhiệt tình, hào hứng",
+    "buồn": "nhẹ nhàng, đồng cảm",
+    "chán nản": "khích lệ, tiếp thêm động lực",
+    "thất vọng": "đồng cảm, động viên và gợi ý cách cải thiện",
+    "tức giận": "bình tĩnh, tôn trọng, đi thẳng vào vấn đề",
+    "lo lắng": "trấn an, rõ ràng và có kế hoạch cụ thể",
+    "bối rối": "kiên nhẫn, giải thích từng bước",
+    "tò mò": "hào hứng, khuyến khích khám phá",
+    "neutral": "balanced",
+}
+
+_INTENSIFIER_RE = re.compile(r"\b(rất|quá|lắm|cực kỳ|cực|siêu|vô cùng|thật sự|very|so|really|extremely)\b", re.IGNORECASE | re.UNICODE)
+# Phủ định ngay trước từ gợi cảm xúc đảo nghĩa ("không vui")
+_NEGATION_RE = re.compile(r"\b(không|chẳng|chả|chưa|đâu có|not|don't|isn't|never)\s+(\w+\s+)?$", re.IGNORECASE | re.UNICODE)
+# Cảm xúc tích cực bị phủ định được tính cho cảm xúc đối lập
+NEGATED_EMOTIONS: Dict[str, str] = {"vui": "buồn", "phấn khích": "chán nản"}
+
+
+def _cue_pattern(cue: str) -> re.Pattern:
+    if re.match(r"\w", cue):
+        return re.compile(rf"(?<!\w){re.escape(cue)}(?!\w)", re.IGNORECASE | re.UNICODE)
+    return re.compile(re.escape(cue))
+
+
+# Cụm dài khớp trước để "lo lắng" không bị tính thêm lần nữa cho "lo"
+_CUE_PATTERNS = sorted(
+    ((emotion, cue, weight, _cue_pattern(cue)) for emotion, cues in LEXICON.items() for cue, weight in cues.items()),
+    key=lambda item: len(item[1]), reverse=True
+)
+
+
+def _result(emotion: str, intensity: float, triggers: List[str]) -> Dict[str, Any]:
+    return {
+        "emotion": emotion,
+        "intensity": int(min(10, max(1, round(intensity)))),
+        "triggers": ", ".join(triggers) if triggers else "unknown",
+        "suggested_tone": SUGGESTED_TONES.get(emotion, "balanced"),
+    }
+
+
+class EmotionClassifier:
+    """
+    Local emotion/tone classifier returning the same schema as the LLM analysis
+    ({emotion, intensity, triggers, suggested_tone}). A Vietnamese/English lexicon
+    decides first; prototype sentences on the shared encoder cover the rest.
+    """
+
+    def __init__(self, encode: Optional[Callable[[List[str]], np.ndarray]] = None,
+                 min_similarity: float = config.EMOTION_PROTOTYPE_MIN_SIMILARITY):
+        self.encode = encode
+        self.min_similarity = min_similarity
+        self._labels: List[str] = []
+        self._embeddings: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def _index(self) -> np.ndarray:
+        """Encodes the prototype sentences once, on first use."""
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    pairs = [(emotion, text) for emotion, texts in PROTOTYPES.items() for text in texts]
+                    self._labels = [emotion for emotion, _ in pairs]
+                    self._embeddings = self.encode([text for _, text in pairs])
+        return self._embeddings
+
+    def match_lexicon(self, text: str) -> Optional[Dict[str, Any]]:
+        scores: Dict[str, float] = {}
+        triggers: Dict[str, List[str]] = {}
+        covered = [False] * len(text)
+        for emotion, cue, weight, pattern in _CUE_PATTERNS:
+            for match in pattern.finditer(text):
+                if any(covered[match.start():match.end()]):
+                    continue
+                covered[match.start():match.end()] = [True] * (match.end() - match.start())
+                target = emotion
+                if _NEGATION_RE.search(text[:match.start()]):
+                    target = NEGATED_EMOTIONS.get(emotion)
+                    if target is None:
+                        continue
+                scores[target] = scores.get(target, 0) + weight
+                triggers.setdefault(target, []).append(cue)
+                break
+        if not scores:
+            return None
+        emotion = max(scores, key=scores.get)
+        emphasis = len(_INTENSIFIER_RE.findall(text)) + min(text.count("!"), 3)
+        return _result(emotion, 4 + scores[emotion] + emphasis, triggers[emotion])
+
+    def match_prototypes(self, text: str) -> Optional[Dict[str, Any]]:
+        if self.encode is None:
+            return None
+        similarities = self._index() @ self.encode([text])[0]
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if similarity < self.min_similarity:
+            return None
+        # Càng giống câu mẫu, cường độ càng cao (5..8)
+        intensity = 5 + 3 * (similarity - self.min_similarity) / max(1e-6, 1 - self.min_similarity)
+        return _result(self._labels[best], intensity, [])
+
+    def classify(self, text: str) -> Dict[str, Any]:
+        """Emotion of `text`; neutral when neither the lexicon nor the prototypes match."""
+        result = self.match_lexicon(text)
+        source = "lexicon"
+        if result is None:
+            source = "prototype"
+            try:
+                result = self.match_prototypes(text)
+            except Exception as e:
+                logger.warning(f"Emotion prototypes failed: {e}")
+        if result is None:
+            source = "neutral"
+            result = dict(NEUTRAL)
+        metrics.increment(f"emotion.{source}")
+        return result
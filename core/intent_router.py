@@ -0,0 +1,275 @@
+import argparse
+import json
+import logging
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Pattern, Sequence, Tuple, TypedDict
+
+import numpy as np
+
+from config import settings as config
+from core.query_parser import parse_positional_query
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _request_rule(verbs: str, keywords: str) -> Pattern:
+    """
+    Keyword rule that only fires on a request: an imperative verb at the start of the
+    sentence or clause ("Tạo quiz...", "Cho em vài câu trắc nghiệm...", "..., cập nhật tiến độ
+    của tôi"), at most three words before the keyword. Questions that merely mention the
+    keyword ("Bài kiểm tra giữa kỳ gồm những chương nào?") fall through to kNN or the LLM.
+    """
+    return re.compile(
+        r"(?:^|[,;:.!?]|\b(?:và|rồi|sau đó|and|then)\b)\s*"
+        r"(?:(?:hãy|xin|làm ơn|giúp|bạn|tôi|em|mình|muốn|cần|please|can you|could you|help me)\s+){0,3}"
+        rf"(?:{verbs})\s+(?:[\w-]+\s+){{0,3}}?(?:{keywords})\b",
+        re.IGNORECASE | re.UNICODE
+    )
+
+
+# "Cho em ... " là yêu cầu, nhưng "Cho em hỏi ..."/"cho mình biết ..." là câu hỏi
+_GIVE = r"cho(?!\s+(?:tôi|em|mình)\s+(?:hỏi|biết))"
+
+# Luật từ khóa cho các yêu cầu hiển nhiên; chỉ áp dụng khi công cụ tương ứng đã được đăng ký
+RULES: List[Tuple[str, Pattern]] = [
+    ("DIRECT", re.compile(
+        r"^\W*(xin chào|chào|hello|hi|hey|cảm ơn|cám ơn|thanks?|thank you|tạm biệt|bye|ok|oke|okay)"
+        r"(\s+\w+){0,2}\W*$", re.IGNORECASE | re.UNICODE)),
+    ("Quiz_Generator", _request_rule(
+        r"tạo|làm|soạn|ra|" + _GIVE + r"|generate|create|make|give me|write",
+        r"quiz(?:zes)?|trắc nghiệm|bài kiểm tra|bài test|tests?")),
+    ("Flashcard_Generator", _request_rule(
+        r"tạo|làm|lập|soạn|viết|" + _GIVE + r"|generate|create|make|build|write|give me",
+        r"flash ?cards?|thẻ ghi nhớ|thẻ học")),
+    ("Mind_Map_Creator", _request_rule(
+        r"tạo|làm|vẽ|lập|soạn|" + _GIVE + r"|generate|create|make|draw|build|give me",
+        r"sơ đồ tư duy|mind ?maps?")),
+    ("Study_Plan_Creator", _request_rule(
+        r"tạo|làm|lập|soạn|xây dựng|gợi ý|đề xuất|" + _GIVE + r"|generate|create|make|build|suggest|give me",
+        r"kế hoạch học(?: tập)?|lộ trình học|lịch (?:học|ôn)|(?:study|learning) plan")),
+    ("Progress_Tracker", _request_rule(
+        r"xem|kiểm tra|cập nhật|theo dõi|ghi nhận|" + _GIVE + r"|show|check|track|update|view",
+        r"tiến độ|progress")),
+    ("Web_Search", re.compile(r"\b(tìm|tra cứu|tra|search|look up)\b.*\b(trên mạng|trên internet|trên web|google|the web|online)\b",
+                              re.IGNORECASE | re.UNICODE)),
+    ("Summary_Generator", re.compile(r"^\W*(tóm tắt|summari[sz]e)\b", re.IGNORECASE | re.UNICODE)),
+]
+
+# "Tóm tắt slide 5" được trả lời thẳng từ nội dung slide (RAG); các công cụ khác ("Tạo quiz từ slide 3") vẫn được chọn
+POSITIONAL_ANSWERS = {"Summary_Generator"}
+
+# Tách yêu cầu ghép thành các vế ("giải thích X và tạo quiz", "tóm tắt chương 2, sau đó lập sơ đồ tư duy")
+CLAUSE_SPLIT = re.compile(r"\s*(?:[,;]|\b(?:và|rồi|sau đó|đồng thời|kèm theo|and|then)\b)\s*", re.IGNORECASE | re.UNICODE)
+
+# Ví dụ cho các hành động không phải công cụ; ví dụ của công cụ nằm trong chính công cụ (BaseTool.examples)
+ACTION_EXAMPLES: Dict[str, List[str]] = {
+    "RAG": [
+        "Entropy trong cây quyết định là gì?",
+        "Thuật toán BFS hoạt động như thế nào?",
+        "Sự khác nhau giữa học có giám sát và không giám sát",
+        "Trong slide có công thức tính xác suất có điều kiện không?",
+        "What is the difference between BFS and DFS?",
+    ],
+    "DIRECT": [
+        "Xin chào",
+        "Cảm ơn bạn nhiều nhé",
+        "Bạn là ai?",
+        "Bạn có thể làm được những gì?",
+        "Hello, how are you?",
+    ],
+}
+
+
+class RouteDecision(TypedDict):
+    action: str
+    confidence: float
+    reasoning: str
+    source: str
+
+
+class CompoundRouteDecision(RouteDecision):
+    # Các công cụ của yêu cầu ghép, theo thứ tự; `action` là công cụ đầu tiên
+    actions: List[str]
+
+
+class IntentRouter:
+    """
+    Local router placed before the LLM router: keyword rules first, then a
+    nearest-neighbour match over example requests of each action. Returns None
+    when the request is ambiguous so that the caller falls back to the LLM.
+    """
+
+    def __init__(self, tool_registry: Any, encode: Callable[[List[str]], np.ndarray],
+                 min_similarity: float = config.INTENT_ROUTER_MIN_SIMILARITY,
+                 margin: float = config.INTENT_ROUTER_MARGIN):
+        self.tool_registry = tool_registry
+        self.encode = encode
+        self.min_similarity = min_similarity
+        self.margin = margin
+        self._labels: List[str] = []
+        self._embeddings: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+
+    def _known(self, action: str) -> bool:
+        return action in ("RAG", "DIRECT") or self.tool_registry.has_tool(action)
+
+    def _examples(self) -> List[Tuple[str, str]]:
+        examples = [(action, text) for action, texts in ACTION_EXAMPLES.items() for text in texts]
+        for name in self.tool_registry.get_tool_names():
+            examples += [(name, text) for text in self.tool_registry.get_tool_examples(name)]
+        return examples
+
+    def _index(self) -> Optional[np.ndarray]:
+        """Encodes the example requests once, on first use."""
+        if self._embeddings is None:
+            with self._lock:
+                if self._embeddings is None:
+                    examples = self._examples()
+                    self._labels = [action for action, _ in examples]
+                    self._embeddings = self.encode([text for _, text in examples]) if examples else np.zeros((0, 1), dtype=np.float32)
+                    logger.info(f"Intent router: indexed {len(examples)} example requests")
+        return self._embeddings
+
+    def warm_up(self) -> None:
+        self._index()
+
+    def match_rules(self, question: str) -> Optional[RouteDecision]:
+        positional = parse_positional_query(question) is not None
+        for action, pattern in RULES:
+            if positional and action in POSITIONAL_ANSWERS:
+                continue
+            if self._known(action) and pattern.search(question):
+                return RouteDecision(action=action, confidence=0.95, reasoning=f"Khớp từ khóa của '{action}'", source="rule")
+        if positional:
+            # Câu hỏi theo slide/trang được tra cứu trực tiếp trong tài liệu
+            return RouteDecision(action="RAG", confidence=0.95, reasoning="Câu hỏi theo vị trí slide/trang", source="rule")
+        return None
+
+    def match_compound(self, question: str) -> Optional[CompoundRouteDecision]:
+        """
+        Routes each clause of a compound request separately. Returns a decision only when
+        at least one clause matches a tool rule, every clause is routed confidently and
+        the clauses ask for two or more different tools.
+        """
+        clauses = [clause for clause in CLAUSE_SPLIT.split(question) if clause.strip()]
+        if len(clauses) < 2:
+            return None
+        rule_matches = [self.match_rules(clause) for clause in clauses]
+        if not any(match and match["action"] not in ("RAG", "DIRECT") for match in rule_matches):
+            return None
+        actions: List[str] = []
+        confidences: List[float] = []
+        for clause, decision in zip(clauses, rule_matches):
+            decision = decision or self.match_examples(clause)
+            if decision is None:
+                return None
+            confidences.append(decision["confidence"])
+            if decision["action"] not in ("RAG", "DIRECT") and decision["action"] not in actions:
+                actions.append(decision["action"])
+        if len(actions) < 2:
+            return None
+        return CompoundRouteDecision(
+            action=actions[0], actions=actions, confidence=min(confidences), source="compound",
+            reasoning=f"Yêu cầu ghép: {', '.join(actions)}"
+        )
+
+    def match_examples(self, question: str) -> Optional[RouteDecision]:
+        embeddings = self._index()
+        if embeddings is None or not len(embeddings):
+            return None
+        similarities = embeddings @ self.encode([question])[0]
+        order = np.argsort(-similarities)
+        best = int(order[0])
+        best_action = self._labels[best]
+        # Ví dụ gần nhất thuộc hành động khác, dùng để đo độ chênh lệch
+        runner_up = next((int(i) for i in order[1:] if self._labels[int(i)] != best_action), None)
+        best_similarity = float(similarities[best])
+        second_similarity = float(similarities[runner_up]) if runner_up is not None else -1.0
+        if best_similarity < self.min_similarity or best_similarity - second_similarity < self.margin:
+            return None
+        return RouteDecision(
+            action=best_action, confidence=round(best_similarity, 3), source="knn",
+            reasoning=f"Gần với ví dụ của '{best_action}' (cách biệt {best_similarity - second_similarity:.2f})"
+        )
+
+    def route(self, question: str) -> Optional[RouteDecision]:
+        """High-confidence local decision for `question`, or None to defer to the LLM router."""
+        metrics.increment("intent_router.calls")
+        try:
+            decision = self.match_compound(question) or self.match_rules(question)
+        except Exception as e:
+            logger.warning(f"Intent router: compound matching failed: {e}")
+            decision = self.match_rules(question)
+        if decision is None:
+            try:
+                decision = self.match_examples(question)
+            except Exception as e:
+                logger.warning(f"Intent router: example matching failed: {e}")
+        if decision is None:
+            metrics.increment("intent_router.fallbacks")
+        else:
+            metrics.increment(f"intent_router.{decision['source']}_hits")
+        calls = metrics.get("intent_router.calls")
+        metrics.set_gauge("intent_router.hit_rate", round(1 - metrics.get("intent_router.fallbacks") / calls, 3))
+        return decision
+
+
+def evaluate(router: IntentRouter, samples: Sequence[Dict[str, str]]) -> Dict[str, Any]:
+    """Fast-path hit rate and routing accuracy of the local router on labelled {question, action} samples."""
+    hits, correct = 0, 0
+    by_source: Dict[str, int] = {}
+    errors = []
+    for sample in samples:
+        decision = router.route(sample["question"])
+        if decision is None:
+            continue
+        hits += 1
+        by_source[decision["source"]] = by_source.get(decision["source"], 0) + 1
+        if decision["action"] == sample["action"]:
+            correct += 1
+        else:
+            errors.append({"question": sample["question"], "expected": sample["action"], "routed": decision["action"], "source": decision["source"]})
+    total = len(samples)
+    return {
+        "total": total,
+        "fast_path": hits,
+        "hit_rate": round(hits / total, 3) if total else 0.0,
+        "accuracy": round(correct / hits, 3) if hits else 0.0,
+        "by_source": by_source,
+        "errors": errors,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Evaluate the local intent router on a labelled set")
+    parser.add_argument("dataset", nargs="?", default="data/intent_eval.jsonl",
+                        help="JSONL file with one {\"question\": ..., \"action\": ...} per line")
+    parser.add_argument("--min-similarity", type=float, default=config.INTENT_ROUTER_MIN_SIMILARITY)
+    parser.add_argument("--margin", type=float, default=config.INTENT_ROUTER_MARGIN)
+    args = parser.parse_args()
+
+    from sentence_transformers import SentenceTransformer
+    from tools import ToolRegistry, register_all_tools
+
+    registry = ToolRegistry(assistant=None)
+    register_all_tools(registry)
+    model = SentenceTransformer(config.EMBEDDING_MODEL)
+    router = IntentRouter(
+        registry, lambda texts: model.encode(texts, normalize_embeddings=True),
+        min_similarity=args.min_similarity, margin=args.margin
+    )
+    with open(args.dataset, encoding="utf-8") as f:
+        samples = [json.loads(line) for line in f if line.strip()]
+
+    report = evaluate(router, samples)
+    print(f"Samples: {report['total']}")
+    print(f"Fast-path hit rate: {report['hit_rate']:.1%} ({report['fast_path']} routed locally, {report['by_source']})")
+    print(f"Routing accuracy on fast path: {report['accuracy']:.1%}")
+    for error in report["errors"]:
+        print(f"  miss  [{error['source']}] {error['question']!r}: expected {error['expected']}, got {error['routed']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,28 +5,36 @@ import asyncio
 import logging
 from typing import List, Dict, Any, Optional, TypedDict
 from langchain.memory import ConversationBufferMemory
-from langchain_google_genai import GoogleGenerativeAI
-from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from langgraph.graph import StateGraph, END
 import os
 import json
-from langchain.prompts import PromptTemplate
 import re
 import asyncio
 import logging
-from typing import List, Dict, Any, Optional, TypedDict
+from typing import List, Dict, Any, AsyncIterator, Optional, Tuple, TypedDict
 from langchain.memory import ConversationBufferMemory # Keep for now, might remove later if fully switching to DB history
-from langchain_google_genai import GoogleGenerativeAI
-from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from langgraph.graph import StateGraph, END
 from pymongo.collection import Collection # Import Collection type hint
-from datetime import datetime, timezone # Add datetime import
 from config import settings as config
 from retrievers.ensemble_retriever import EnsembleRetriever
+from vectorstores import VectorStore
+from llm import create_llm
 from tools.tool_registry import ToolRegistry
 from tools import register_all_tools
+from utils.partitions import partition_keys_for
+from core.context_packer import pack_chunks, pack_prompt_sections, slide_formatter
+from core.query_parser import parse_positional_query
+from core.query_expansion import QueryExpander, reciprocal_rank_fusion
+from core.intent_router import IntentRouter
+from core.emotion_classifier import EmotionClassifier
+from core.retrieval_context import RetrievalContext
+from core.prompts import ANSWER_PROMPTS, answer_prompt_name, prompts
+from utils.chat_history_cache import ChatHistoryCache
+from utils.metrics import metrics
+from utils.tracing import current_span, tracer
+from utils.concurrency_limiter import LimiterRejected, priority as llm_priority
 # No longer importing MongoClient or ConnectionFailure here
 
 logging.basicConfig(level=config.LOGGING_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -41,8 +49,14 @@ class AssistantState(TypedDict):
     tool_outputs: Optional[Dict[str, Any]]
     route_decision: Optional[str]
     selected_tool_name: Optional[str]
+    # Mọi công cụ được chọn (nhiều hơn một với yêu cầu ghép); selected_tool_name là công cụ đầu tiên
+    selected_tools: Optional[List[str]]
     needs_context_for_tool: Optional[bool]
     emotion: Optional[Dict[str, Any]] 
+    partition_keys: Optional[List[str]]
+    retrieval_report: Optional[Dict[str, Any]]
+    # Kết quả truy xuất của request, dùng lại cho công cụ thay vì tìm kiếm lại
+    retrieval: Optional[RetrievalContext]
 
 class LearningAssistant:
     # Modify __init__ to accept mongo_collection
@@ -51,9 +65,10 @@ class LearningAssistant:
                  collection_name: str = config.MILVUS_COLLECTION,
                  model_name: str = config.LLM_MODEL_NAME,
                  api_key: Optional[str] = config.GOOGLE_API_KEY,
-                 temperature: float = config.LLM_TEMPERATURE):
+                 temperature: float = config.LLM_TEMPERATURE,
+                 vector_store: Optional[VectorStore] = None):
         self.api_key = api_key
-        self.llm = GoogleGenerativeAI(model=model_name, google_api_key=self.api_key, temperature=temperature)
+        self.llm = create_llm(model_name=model_name, api_key=self.api_key, temperature=temperature)
         self.retriever = EnsembleRetriever(
             collection_name=collection_name,
             model_name=config.EMBEDDING_MODEL,
@@ -61,18 +76,31 @@ class LearningAssistant:
             port=config.MILVUS_PORT,
             vector_weight=config.VECTOR_WEIGHT,
             bm25_weight=config.BM25_WEIGHT,
-            top_k=config.RETRIEVER_TOP_K
+            top_k=config.RETRIEVER_TOP_K,
+            vector_store=vector_store
         )
         # Keep Langchain memory for now, might phase out later
         self.memory = ConversationBufferMemory(memory_key="chat_history", return_messages=False, output_key="response")
         self.tool_registry = ToolRegistry(self)
+        # Mở rộng truy vấn (tùy chọn): biến thể cục bộ trước, LLM chỉ khi QUERY_EXPANSION_LLM bật
+        self.query_expander = QueryExpander(self.llm) if config.QUERY_EXPANSION_ENABLED else None
         self._register_default_tools()
+        # Định tuyến cục bộ (luật + kNN trên ví dụ của từng công cụ) trước khi gọi LLM
+        self.intent_router = IntentRouter(self.tool_registry, self.retriever.encode_queries) if config.INTENT_ROUTER_ENABLED else None
+        # Phân tích cảm xúc: bộ phân loại cục bộ (mặc định) hoặc LLM (EMOTION_BACKEND=llm)
+        self.emotion_classifier = EmotionClassifier(self.retriever.encode_queries) if config.EMOTION_BACKEND != "llm" else None
+        # Chain dựng sẵn từ prompt đã biên dịch; mỗi request chỉ điền biến
+        self._router_chain = prompts.get("router") | self.llm | JsonOutputParser()
+        self._emotion_chain = prompts.get("emotion") | self.llm | JsonOutputParser()
+        self._answer_chains = {name: prompts.get(name) | self.llm | StrOutputParser() for name in ANSWER_PROMPTS}
         self.workflow = self._setup_workflow()
         # Store the passed-in MongoDB collection
         self.mongo_collection = mongo_collection
         # Fix: Instead of direct boolean check, compare with None
         if self.mongo_collection is None:
              logger.warning("LearningAssistant initialized without a valid MongoDB collection. Chat history saving will be disabled.")
+        # Lịch sử gần nhất giữ trong bộ nhớ, ghi xuống MongoDB ở nền
+        self.chat_history = ChatHistoryCache(self.mongo_collection)
 
     # Remove the _connect_mongo method entirely
     # def _connect_mongo(self, host, port, db_name, collection_name): ...
@@ -82,18 +110,20 @@ class LearningAssistant:
 
     def _setup_workflow(self) -> StateGraph:
         workflow = StateGraph(AssistantState)
-        workflow.add_node("analyze_intent", self._analyze_intent_node)
+        workflow.add_node("analyze", self._analyze_node)
         workflow.add_node("retrieve_context", self._retrieve_context_node)
         workflow.add_node("execute_tool", self._execute_tool_node)
         workflow.add_node("generate_response", self._generate_response_node)
         workflow.add_node("format_sources", self._format_sources_node)
-        workflow.set_entry_point("analyze_intent")
+        workflow.set_entry_point("analyze")
         workflow.add_conditional_edges(
-            "analyze_intent",
+            "analyze",
             self._route_after_intent,
             {
                 "retrieve_for_rag": "retrieve_context",
                 "retrieve_for_tool": "retrieve_context",
+                "tool_with_context": "execute_tool",
+                "rag_with_context": "generate_response",
                 "execute_tool_direct": "execute_tool",
                 "generate_direct": "generate_response"
             }
@@ -112,123 +142,201 @@ class LearningAssistant:
         decision = state.get("route_decision")
         tool_name = state.get("selected_tool_name")
         needs_context = state.get("needs_context_for_tool", False)
+        # Ngữ cảnh đã có sẵn từ truy xuất suy đoán thì bỏ qua node retrieve_context
+        retrieved = state.get("context") is not None
         if decision == "TOOL" and tool_name:
-            return "retrieve_for_tool" if needs_context else "execute_tool_direct"
-        elif decision == "RAG":
-            return "retrieve_for_rag"
+            if not needs_context:
+                return "execute_tool_direct"
+            return "tool_with_context" if retrieved else "retrieve_for_tool"
         elif decision == "DIRECT":
             return "generate_direct"
-        return "retrieve_for_rag"
+        return "rag_with_context" if retrieved else "retrieve_for_rag"
 
     def _route_after_retrieval(self, state: AssistantState) -> str:
         return "to_tool" if state.get("route_decision") == "TOOL" else "to_response"
 
+    @staticmethod
+    def _intent_needs_context(intent: Dict[str, Any]) -> bool:
+        decision = intent.get("route_decision")
+        if decision == "TOOL" and intent.get("selected_tool_name"):
+            return bool(intent.get("needs_context_for_tool"))
+        return decision != "DIRECT"
+
+    @tracer.traced("workflow.analyze")
+    async def _analyze_node(self, state: AssistantState) -> Dict[str, Any]:
+        """
+        Runs intent classification, emotion analysis and a speculative retrieval concurrently.
+        The retrieval is kept when the chosen route needs context and cancelled otherwise.
+        """
+        speculative = None
+        if config.SPECULATIVE_RETRIEVAL:
+            speculative = asyncio.ensure_future(self._retrieve_context_node(state))
+        try:
+            emotion = state.get("emotion")
+            if emotion is None:
+                intent, emotion = await asyncio.gather(
+                    self._analyze_intent_node(state), self._analyze_emotion(state["question"])
+                )
+            else:
+                intent = await self._analyze_intent_node(state)
+            update = {**intent, "emotion": emotion}
+            if speculative is not None:
+                if self._intent_needs_context(intent):
+                    update.update(await speculative)
+                    metrics.increment("assistant.speculative_retrieval.used")
+                else:
+                    speculative.cancel()
+                    metrics.increment("assistant.speculative_retrieval.discarded")
+            return update
+        except BaseException:
+            if speculative is not None:
+                speculative.cancel()
+            raise
+
+    def _intent_for_action(self, action: Optional[str], actions: Optional[List[str]] = None) -> Dict[str, Any]:
+        # Yêu cầu ghép: chỉ giữ các công cụ đã đăng ký, không trùng lặp
+        tools = [name for name in dict.fromkeys(actions or []) if isinstance(name, str) and self.tool_registry.has_tool(name)]
+        if len(tools) > 1:
+            tools = tools[:config.MULTI_TOOL_MAX]
+            return {
+                "route_decision": "TOOL",
+                "selected_tool_name": tools[0],
+                "selected_tools": tools,
+                "needs_context_for_tool": any(self.tool_registry.get_tool_needs_context(name) for name in tools)
+            }
+        if action in ("RAG", "DIRECT"):
+            return {"route_decision": action, "selected_tool_name": None, "selected_tools": None, "needs_context_for_tool": False}
+        if action and self.tool_registry.has_tool(action):
+            return {
+                "route_decision": "TOOL",
+                "selected_tool_name": action,
+                "selected_tools": [action],
+                "needs_context_for_tool": self.tool_registry.get_tool_needs_context(action)
+            }
+        logger.warning(f"Invalid action '{action}', defaulting to RAG")
+        return {"route_decision": "RAG", "selected_tool_name": None, "selected_tools": None, "needs_context_for_tool": False}
+
+    @tracer.traced("workflow.intent")
     async def _analyze_intent_node(self, state: AssistantState) -> Dict[str, Any]:
         question = state["question"]
+        if self.intent_router is not None:
+            # Encode câu hỏi là tác vụ CPU, chạy ngoài event loop
+            decision = await asyncio.to_thread(self.intent_router.route, question)
+            if decision is not None:
+                logger.info(f"Intent routed locally ({decision['source']}): {decision.get('actions') or decision['action']} ({decision['confidence']})")
+                return self._intent_for_action(decision["action"], decision.get("actions"))
         # Use the chat_history passed in the state, which will be loaded from DB if available
         chat_history = state.get("chat_history", "")
-        available_tools = list(self.tool_registry.get_tool_names())
-        tools_description = "\n".join([f"- {name}: {self.tool_registry.get_tool_description(name)}"
-                                      for name in available_tools if self.tool_registry.get_tool_description(name)]) or "Không có công cụ nào được mô tả."
-
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", f"""Bạn là một agent định tuyến thông minh. Nhiệm vụ của bạn là phân tích câu hỏi của người dùng và chọn hành động phù hợp nhất.
-
-                Các công cụ/hành động có sẵn:
-                {tools_description}
-                - RAG: Truy xuất thông tin từ tài liệu nội bộ (dùng khi câu hỏi liên quan đến tài liệu, ví dụ: "Tóm tắt slide 5").
-                - DIRECT: Trả lời trực tiếp không cần tài liệu hay công cụ (dùng cho lời chào, cảm ơn, hoặc câu hỏi chung chung).
-
-                Quy trình:
-                1. Phân tích ý định câu hỏi.
-                2. Nếu khớp với công cụ (như "tạo quiz", "tìm trên mạng"), chọn tên công cụ.
-                3. Nếu liên quan đến tài liệu, chọn "RAG".
-                4. Nếu không cần tài liệu/công cụ, chọn "DIRECT".
-                Ví dụ:
-                - "Tạo quiz từ tài liệu" -> 'action': 'Quiz_Generator', 'confidence': 0.95, 'reasoning': 'Yêu cầu tạo quiz rõ ràng'
-                - "Tìm thông tin trên web/Mai là thứ mấy" -> 'action': 'Web_Search', 'confidence': 0.9, 'reasoning': 'Yêu cầu tìm kiếm web'
-                - "Giải thích khái niệm trong slide" -> 'action': 'RAG', 'confidence': 0.85, 'reasoning': 'Liên quan đến tài liệu'
-                - "Xin chào" -> 'action': 'DIRECT', 'confidence': 0.99, 'reasoning': 'Lời chào đơn giản'
-                Output có dạng: 
-                    "action": "[Tên công cụ hoặc RAG hoặc DIRECT]", "confidence": [0.0-1.0], "reasoning": "[Lý do]"
-                Lưu ý : trả về Json
-                """),
-            ("human", "Lịch sử hội thoại:\n{chat_history}\n\nCâu hỏi người dùng:\n{question}")
-        ])
-
-        parser = JsonOutputParser()
-        chain = prompt | self.llm | parser
-        input_dict = {"question": question, "chat_history": chat_history}
+        chain = self._router_chain
+        input_dict = {
+            "question": question, "chat_history": chat_history,
+            # Danh mục công cụ được cache trong registry, chỉ dựng lại khi đăng ký công cụ mới
+            "tools_description": self.tool_registry.get_tools_description(),
+        }
 
         try:
-            result_json = await asyncio.wait_for(chain.ainvoke(input_dict), timeout=20.0)
-            action = result_json.get("action")
-            if action == "RAG":
-                route_decision = "RAG"
-                selected_tool_name = None
-                needs_context = False
-            elif action == "DIRECT":
-                route_decision = "DIRECT"
-                selected_tool_name = None
-                needs_context = False
-            elif self.tool_registry.has_tool(action):
-                route_decision = "TOOL"
-                selected_tool_name = action
-                needs_context = self.tool_registry.get_tool_needs_context(action)
-            else:
-                route_decision = "RAG"
-                selected_tool_name = None
-                needs_context = False
-                logger.warning(f"Invalid action '{action}', defaulting to RAG")
+            with llm_priority("routing"):
+                result_json = await asyncio.wait_for(chain.ainvoke(input_dict), timeout=20.0)
+            actions = result_json.get("actions")
+            return self._intent_for_action(result_json.get("action"), actions if isinstance(actions, list) else None)
         except Exception as e:
             logger.exception(f"Error in intent analysis: {e}")
-            route_decision = "RAG"
-            selected_tool_name = None
-            needs_context = False
-
-        return {
-            "route_decision": route_decision,
-            "selected_tool_name": selected_tool_name,
-            "needs_context_for_tool": needs_context
-        }
+            return {"route_decision": "RAG", "selected_tool_name": None, "selected_tools": None, "needs_context_for_tool": False}
 
+    @tracer.traced("workflow.retrieve")
     async def _retrieve_context_node(self, state: AssistantState) -> Dict[str, Any]:
         question = state["question"]
+        positional = parse_positional_query(question)
+        if positional:
+            found = await self._retrieve_by_position(positional, state.get("partition_keys"))
+            if found:
+                results, report = found
+                self._record_retrieval(state, results, report)
+                packed = pack_chunks(results, formatter=slide_formatter, label="position")
+                return {"context": packed["text"], "sources": packed["chunks"], "retrieval_report": report}
         try:
-            results = await asyncio.wait_for(self.retriever.search(question, top_k=config.RETRIEVER_TOP_K), timeout=15.0)
+            if self.query_expander and self.query_expander.should_expand(question):
+                retrieval = self._search_expanded(question, state.get("partition_keys"))
+            else:
+                retrieval = self.retriever.search_with_report(
+                    question, top_k=config.RETRIEVER_TOP_K, partition_keys=state.get("partition_keys"),
+                    timeout=config.RETRIEVAL_DEADLINE_SECONDS
+                )
+            # Thời hạn mềm: retriever tự bỏ bớt giai đoạn; wait_for chỉ là giới hạn cứng cuối cùng
+            results, report = await asyncio.wait_for(retrieval, timeout=15.0)
+            if report.get("degraded"):
+                logger.warning(f"Degraded retrieval, skipped stages: {report['skipped']}")
+            self._record_retrieval(state, results, report)
             if results:
-                context = "\n\n".join([f"[Nguồn {i+1}]: {doc.get('text', '').strip()}" for i, doc in enumerate(results)])
-                return {"context": context, "sources": results}
-            return {"context": "Không tìm thấy thông tin liên quan.", "sources": []}
+                # Xếp ngữ cảnh theo điểm, bỏ phần chồng lấn giữa các chunk và giới hạn theo ngân sách token
+                packed = pack_chunks(results, label="retrieve")
+                return {"context": packed["text"], "sources": packed["chunks"], "retrieval_report": report}
+            return {"context": "Không tìm thấy thông tin liên quan.", "sources": [], "retrieval_report": report}
         except Exception as e:
             logger.exception(f"Error retrieving context: {e}")
             return {"context": f"Lỗi khi truy xuất: {str(e)}", "sources": []}
-    # Add this in the imports section
 
+    @staticmethod
+    def _record_retrieval(state: AssistantState, results: List[Dict[str, Any]], report: Dict[str, Any]) -> None:
+        """Keeps the raw hits for the question so that tools of this request reuse them."""
+        retrieval = state.get("retrieval")
+        if retrieval is not None:
+            retrieval.record(state["question"], results, top_k=config.RETRIEVER_TOP_K,
+                             partition_keys=state.get("partition_keys"), report=report)
+
+    async def _search_expanded(self, question: str, partition_keys: Optional[List[str]]):
+        """Searches the question and its reformulations in one batch and fuses them with RRF."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + config.RETRIEVAL_DEADLINE_SECONDS
+        # Bước sinh biến thể không được dùng quá nửa thời hạn truy xuất
+        variants = await self.query_expander.expand(
+            question, budget_seconds=min(config.QUERY_EXPANSION_BUDGET_SECONDS, config.RETRIEVAL_DEADLINE_SECONDS / 2)
+        )
+        queries = [question] + variants
+        batch = await self.retriever.search_many(
+            queries, top_k=config.RETRIEVER_TOP_K, partition_keys=partition_keys,
+            timeout=max(0.1, deadline - loop.time())
+        )
+        results = reciprocal_rank_fusion([query_results for query_results, _ in batch], top_k=config.RETRIEVER_TOP_K)
+        report = batch[0][1] if batch else {"completed": [], "skipped": {}}
+        report["degraded"] = any(query_report.get("degraded") for _, query_report in batch)
+        report["expansion"] = {"queries": queries, "fused_results": len(results)}
+        logger.info(f"Query expansion: {len(queries)} queries fused into {len(results)} results")
+        return results, report
+
+    async def _retrieve_by_position(self, positional: Dict[str, Any],
+                                    partition_keys: Optional[List[str]]) -> Optional[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """Fast path for "slide 5" / "trang 3" questions: scalar lookup instead of semantic search."""
+        started = asyncio.get_running_loop().time()
+        try:
+            results = await self.retriever.lookup_by_position(
+                positional["slide_numbers"], positional["source"], partition_keys=partition_keys
+            )
+        except Exception as e:
+            logger.warning(f"Positional lookup failed, falling back to search: {e}")
+            return None
+        if not results:
+            logger.info(f"No chunks for {positional['kind']} {positional['slide_numbers']}, falling back to search")
+            return None
+        report = {
+            "completed": ["positional_lookup"], "skipped": {}, "degraded": False,
+            "elapsed_ms": round((asyncio.get_running_loop().time() - started) * 1000, 1),
+            "position": positional,
+        }
+        return results, report
 
     # Add this method to the LearningAssistant class after _analyze_intent_node
+    @tracer.traced("workflow.emotion")
     async def _analyze_emotion(self, text: str) -> Dict[str, Any]:
         """Analyzes the emotional content of user input."""
-        prompt = PromptTemplate.from_template(
-            """Analyze the emotional state reflected in this text:
-
-            "{text}"
-
-            Identify:
-            1. Cảm xúc chính (ví dụ: vui, buồn, tức giận, bối rối, tò mò, thất vọng, phấn khích)
-            2. Emotional intensity (scale 1-10)
-            3. Key emotional triggers or concerns
-            4. Suggested tone for response
-
-            Return only a JSON with these keys:
-            {{"emotion": "primary_emotion", "intensity": intensity_number, "triggers": "key_triggers", "suggested_tone": "recommended_tone"}}
-            """
-        )
-        
-        chain = prompt | self.llm | JsonOutputParser()
+        if self.emotion_classifier is not None:
+            # Từ điển chạy ngay; embedding của câu hỏi thường đã có trong cache của retriever
+            return await asyncio.to_thread(self.emotion_classifier.classify, text)
+        chain = self._emotion_chain
         
         try:
-            result = await asyncio.wait_for(chain.ainvoke({"text": text}), timeout=10.0)
+            with llm_priority("routing"):
+                result = await asyncio.wait_for(chain.ainvoke({"text": text}), timeout=10.0)
             return result
         except Exception as e:
             logger.warning(f"Emotion analysis failed: {e}")
@@ -238,84 +346,97 @@ class LearningAssistant:
                 "triggers": "unknown",
                 "suggested_tone": "balanced"
             }
+    @tracer.traced("workflow.execute_tool")
     async def _execute_tool_node(self, state: AssistantState) -> Dict[str, Any]:
-        tool_name = state.get("selected_tool_name")
-        if not tool_name:
+        """Runs the selected tools concurrently, each with its own timeout, over the request's shared retrieval."""
+        tool_names = self._selected_tools(state)
+        if not tool_names:
             return {"tool_outputs": {"error": "Không có công cụ nào được chọn."}}
         tool_kwargs = {k: v for k, v in state.items() if v is not None}
+        results = await asyncio.gather(*(self._run_tool(name, tool_kwargs) for name in tool_names))
+        return {"tool_outputs": dict(zip(tool_names, results))}
+
+    @staticmethod
+    def _selected_tools(state: Dict[str, Any]) -> List[str]:
+        tool_name = state.get("selected_tool_name")
+        return state.get("selected_tools") or ([tool_name] if tool_name else [])
+
+    async def _run_tool(self, tool_name: str, tool_kwargs: Dict[str, Any]) -> Any:
+        """Result of one tool; errors and timeouts become an error message so the other tools' results are kept."""
         try:
-            result = await self.tool_registry.execute_tool(tool_name, **tool_kwargs)
-            return {"tool_outputs": {tool_name: result}}
+            return await asyncio.wait_for(
+                self.tool_registry.execute_tool(tool_name, **tool_kwargs), timeout=config.TOOL_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Tool '{tool_name}' timed out")
+            return f"Lỗi: công cụ '{tool_name}' không hoàn thành kịp thời gian cho phép."
         except Exception as e:
-            return {"tool_outputs": {tool_name: f"Lỗi khi thực thi công cụ '{tool_name}': {str(e)}"}}
+            return f"Lỗi khi thực thi công cụ '{tool_name}': {str(e)}"
 
-    async def _generate_response_node(self, state: AssistantState) -> Dict[str, Any]:
+    def _build_response_chain(self, state: AssistantState) -> Tuple[Any, Dict[str, Any]]:
+        """Builds the answer prompt chain for the current state and its inputs."""
         question = state["question"]
         context = state.get("context")
         # Use the chat_history passed in the state
         chat_history = state.get("chat_history", "")
         tool_outputs = state.get("tool_outputs")
         route_decision = state.get("route_decision", "DIRECT")
-        selected_tool_name = state.get("selected_tool_name")
+        tool_names = self._selected_tools(state)
 
-        emotion_data = await self._analyze_emotion(question)
+        # Cảm xúc đã được phân tích một lần trong node analyze
+        emotion_data = state.get("emotion") or {}
         emotion = emotion_data.get("emotion", "neutral")
         emotion_intensity = emotion_data.get("intensity", 5)
         suggested_tone = emotion_data.get("suggested_tone", "balanced")
 
-        system_message = f"""Bạn là EduMentor, một trợ lý học tập AI thông minh và thân thiện.
-
-        Phân tích cảm xúc người dùng: Họ đang thể hiện cảm xúc "{emotion}" với mức độ {emotion_intensity}/10.
-        Hãy điều chỉnh tông giọng của bạn để "{suggested_tone}" khi phản hồi.Nếu người dùng buồn chán hay chán nản với việc học,hãy tiếp thêm động lực cho người dùng.Khi người dùng vui vẻ,hãy chia vui với người dùng"""
-        
-        human_template_parts = ["Câu hỏi người dùng: {question}\n"]
-        input_dict = {"question": question, "chat_history": chat_history}
+        tool_result = None
+        if route_decision == "TOOL" and tool_outputs and tool_names:
+            results = []
+            for name in tool_names:
+                result = tool_outputs.get(name, "Công cụ bị lỗi.")
+                results.append(result if isinstance(result, str) else json.dumps(result, ensure_ascii=False))
+            # Nhiều công cụ: ghép kết quả thành từng phần có tên công cụ để câu trả lời gộp lại
+            tool_result = results[0] if len(results) == 1 else "\n\n".join(
+                f"[{name}]\n{result}" for name, result in zip(tool_names, results)
+            )
+        # Ngữ cảnh, lịch sử và kết quả công cụ dùng chung một ngân sách token
+        context, chat_history, tool_result = pack_prompt_sections(context, chat_history, tool_result)
 
+        input_dict = {
+            "question": question, "chat_history": chat_history,
+            "emotion": emotion, "emotion_intensity": emotion_intensity, "suggested_tone": suggested_tone,
+        }
         if route_decision == "RAG":
-            system_message += "\nHãy trả lời dựa vào ngữ cảnh tài liệu dưới đây."
-            human_template_parts.append("--- Ngữ cảnh ---")
-            human_template_parts.append("{context}")
-            human_template_parts.append("--- Kết thúc ngữ cảnh ---")
+            mode = "rag"
             input_dict["context"] = context or "Không có ngữ cảnh."
-        elif route_decision == "TOOL" and tool_outputs and selected_tool_name:
-            tool_result = tool_outputs.get(selected_tool_name, "Công cụ bị lỗi.")
-            system_message += f"\nSử dụng kết quả từ công cụ '{selected_tool_name}'."
-            human_template_parts.append(f"--- Kết quả từ '{selected_tool_name}' ---")
-            human_template_parts.append("{tool_result}")
-            human_template_parts.append("--- Kết thúc kết quả ---")
-            input_dict["tool_result"] = tool_result
-            if context:
-                human_template_parts.append("\n--- Ngữ cảnh bổ sung ---")
-                human_template_parts.append("{context}")
-                human_template_parts.append("--- Kết thúc ngữ cảnh ---")
-                input_dict["context"] = context
+        elif route_decision == "TOOL" and tool_outputs and tool_names:
+            mode = "tool_context" if context else "tool"
+            input_dict.update(tool_name=", ".join(tool_names), tool_result=tool_result, context=context)
         else:
-            system_message += "\nTrả lời trực tiếp và tự nhiên."
-
-        if chat_history:
-            human_template_parts.append("\n--- Lịch sử hội thoại ---")
-            human_template_parts.append("{chat_history}")
-            human_template_parts.append("--- Kết thúc lịch sử ---")
-
-        human_template = "\n\n".join(human_template_parts) + "\n\nCâu trả lời của EduMentor:"
-        prompt = ChatPromptTemplate.from_messages([("system", system_message), ("human", human_template)])
-        chain = prompt | self.llm | StrOutputParser()
+            mode = "direct"
+        return self._answer_chains[answer_prompt_name(mode, bool(chat_history))], input_dict
 
+    @tracer.traced("workflow.generate")
+    async def _generate_response_node(self, state: AssistantState) -> Dict[str, Any]:
+        chain, input_dict = self._build_response_chain(state)
         try:
             response = await chain.ainvoke(input_dict)
             # We will save history to DB in the main answer method, not here.
             # self.memory.save_context({"question": question}, {"response": response}) # Keep Langchain memory update for now
             return {"response": response}
+        except LimiterRejected:
+            # Quá tải: để API trả 503 thay vì một câu trả lời lỗi
+            raise
         except Exception as e:
             logger.exception(f"Error generating response: {e}")
             return {"response": f"Lỗi khi tạo phản hồi: {str(e)}"}
 
+    @tracer.traced("workflow.format_sources")
     async def _format_sources_node(self, state: AssistantState) -> Dict[str, Any]:
         response = state.get("response", "")
         sources = state.get("sources")
         route_decision = state.get("route_decision")
-        tool_name = state.get("selected_tool_name")
-        tool_needs_context = self.tool_registry.get_tool_needs_context(tool_name) if tool_name else False
+        tool_needs_context = any(self.tool_registry.get_tool_needs_context(name) for name in self._selected_tools(state))
 
         # Only add sources if the response exists and sources were retrieved for RAG or a context-needing tool
         if response and sources and (route_decision == "RAG" or (route_decision == "TOOL" and tool_needs_context)):
@@ -360,78 +481,69 @@ class LearningAssistant:
         # Ensure the return statement is correctly indented within the method
         return {"response": response}
 
+    @tracer.traced("history.save")
     async def _save_chat_history(self, username: str, question: str, response: str):
-        """Saves a question-response pair to MongoDB for the user."""
+        """Records a question-response pair for the user; written to MongoDB in the background."""
         if self.mongo_collection is None or not username:
             logger.warning(f"Cannot save chat history for {username}. MongoDB connection unavailable or username missing.")
             return
+        await self.chat_history.append(username, question, response)
 
-        try:
-            now_utc = datetime.now(timezone.utc)
-            chat_entry = {
-                "user": question,
-                "assistant": response,
-                "timestamp": now_utc
-            }
-            # Use $push to add to the chat_history array and $inc to count
-            self.mongo_collection.update_one(
-                {"_id": username},
-                {
-                    "$push": {"chat_history": chat_entry},
-                    "$inc": {"chat_history_count": 1}, # Increment count
-                    "$set": {"last_activity": now_utc}, # Update last activity
-                    "$setOnInsert": {"_id": username, "username": username} # Ensure user doc exists
-                },
-                upsert=True
-            )
-            logger.info(f"Saved chat history for user: {username}")
-        except Exception as e:
-            logger.error(f"Failed to save chat history for user {username}: {e}")
-
-    async def _load_chat_history(self, username: str, limit: int = 10) -> str:
-        """Loads recent chat history from MongoDB for the user."""
-        if self.mongo_collection is None or not username:
-            return ""
+    @tracer.traced("history.load")
+    async def _load_chat_history(self, username: str, limit: int = config.CHAT_HISTORY_TURNS) -> str:
+        """Recent chat history of the user, from memory (read from MongoDB on first use)."""
+        turns = await self.chat_history.recent(username, limit)
+        return "\n".join(f"User: {entry['user']}\nAssistant: {entry['assistant']}" for entry in turns)
 
-        try:
-            user_data = self.mongo_collection.find_one(
-                {"_id": username},
-                {"chat_history": {"$slice": -limit}} # Get last 'limit' entries
-            )
-            if user_data and "chat_history" in user_data:
-                history_str = "\n".join([
-                    f"User: {entry['user']}\nAssistant: {entry['assistant']}"
-                    for entry in user_data["chat_history"]
-                ])
-                return history_str
-            return ""
-        except Exception as e:
-            logger.error(f"Failed to load chat history for user {username}: {e}")
-            return ""
-
-    # Modify answer method to accept username
-    async def answer(self, question: str, username: Optional[str] = None) -> Dict[str, Any]:
-        if not question or not isinstance(question, str) or not question.strip():
-            return {"response": "Vui lòng cung cấp câu hỏi hợp lệ.", "sources": [], "tool_outputs": {}, "metadata": {"error": "invalid_input"}}
-
-        # Load chat history from MongoDB if username is provided
-        chat_history_str = await self._load_chat_history(username) if username else ""
-        emotion_data = await self._analyze_emotion(question)
-        initial_state = AssistantState(
+    def _initial_state(self, question: str, chat_history: str, username: Optional[str], course: Optional[str]) -> AssistantState:
+        return AssistantState(
             question=question,
-            chat_history=chat_history_str, # Use loaded history
+            chat_history=chat_history,
             context=None,
             response=None,
             sources=None,
             tool_outputs=None,
             route_decision=None,
             selected_tool_name=None,
+            selected_tools=None,
             needs_context_for_tool=None,
-            emotion=emotion_data
+            emotion=None,
+            partition_keys=partition_keys_for(username, course),
+            retrieval_report=None,
+            retrieval=RetrievalContext()
         )
 
+    @staticmethod
+    def _answer_metadata(state: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "route_decision": state.get("route_decision"),
+            "selected_tool": state.get("selected_tool_name"),
+            "selected_tools": state.get("selected_tools"),
+            "emotion": state.get("emotion"),
+            "retrieval": state.get("retrieval_report"),
+            "retrievals": state["retrieval"].stats() if state.get("retrieval") else None
+        }
+
+    @staticmethod
+    def _log_retrievals(state: Dict[str, Any]) -> None:
+        retrieval = state.get("retrieval")
+        if retrieval is not None:
+            logger.info(f"Request retrievals: {retrieval.searches} search(es), {retrieval.reused} reused")
+            current_span().set_attribute("retrieval.searches", retrieval.searches)
+
+    # Modify answer method to accept username
+    async def answer(self, question: str, username: Optional[str] = None, course: Optional[str] = None) -> Dict[str, Any]:
+        """Answers a question, searching only the shared, the user's own and the course's documents."""
+        if not question or not isinstance(question, str) or not question.strip():
+            return {"response": "Vui lòng cung cấp câu hỏi hợp lệ.", "sources": [], "tool_outputs": {}, "metadata": {"error": "invalid_input"}}
+
+        # Load chat history from MongoDB if username is provided
+        chat_history_str = await self._load_chat_history(username) if username else ""
+        initial_state = self._initial_state(question, chat_history_str, username, course)
+
         try:
             final_state = await self.workflow.ainvoke(initial_state, config={"recursion_limit": 15})
+            self._log_retrievals(final_state)
 
             # Save chat history to MongoDB if username is provided and response exists
             final_response = final_state.get("response")
@@ -442,16 +554,93 @@ class LearningAssistant:
                 "response": final_response or "Lỗi không xác định",
                 "sources": final_state.get("sources", []),
                 "tool_outputs": final_state.get("tool_outputs", {}),
-                "metadata": {
-                    "route_decision": final_state.get("route_decision"),
-                    "selected_tool": final_state.get("selected_tool_name"),
-                    "emotion": final_state.get("emotion") 
-                }
+                "metadata": self._answer_metadata(final_state)
             }
+        except LimiterRejected:
+            raise
         except Exception as e:
             logger.exception(f"Error in workflow: {e}")
             return {"response": f"Lỗi hệ thống: {str(e)}", "sources": [], "tool_outputs": {}, "metadata": {"error": "workflow_exception"}}
 
+    async def answer_stream(self, question: str, username: Optional[str] = None,
+                            course: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streams the answer as events: "route" and "sources" as soon as they are known,
+        one "token" per generated chunk, then "sources_text" (the formatted source list)
+        and "done" with the full response. Runs the same nodes and routing as `answer`.
+        """
+        if not question or not isinstance(question, str) or not question.strip():
+            yield {"event": "error", "data": {"message": "Vui lòng cung cấp câu hỏi hợp lệ.", "error": "invalid_input"}}
+            return
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        chat_history_str = await self._load_chat_history(username) if username else ""
+        state: Dict[str, Any] = dict(self._initial_state(question, chat_history_str, username, course))
+
+        try:
+            state.update(await self._analyze_node(state))
+            yield {"event": "route", "data": {
+                "route_decision": state.get("route_decision"),
+                "selected_tool": state.get("selected_tool_name"),
+                "selected_tools": state.get("selected_tools"),
+                "emotion": state.get("emotion")
+            }}
+
+            # Cùng các hàm định tuyến với graph để luồng stream và /ask luôn khớp nhau
+            step = self._route_after_intent(state)
+            if step in ("retrieve_for_rag", "retrieve_for_tool"):
+                state.update(await self._retrieve_context_node(state))
+            if state.get("sources") is not None:
+                yield {"event": "sources", "data": {"sources": state["sources"], "retrieval": state.get("retrieval_report")}}
+            if step in ("retrieve_for_tool", "tool_with_context", "execute_tool_direct"):
+                state.update(await self._execute_tool_node(state))
+                yield {"event": "tool", "data": {"tool": state.get("selected_tool_name"), "tools": self._selected_tools(state)}}
+
+            chain, input_dict = self._build_response_chain(state)
+            parts: List[str] = []
+            # Các bước của generator có thể chạy trong các task khác nhau nên span được kết thúc thủ công
+            generate_span = tracer.start_span("workflow.generate")
+            try:
+                async for chunk in chain.astream(input_dict):
+                    if not parts:
+                        metrics.set_gauge("assistant.stream.first_token_ms", round((loop.time() - started) * 1000, 1))
+                    parts.append(chunk)
+                    yield {"event": "token", "data": chunk}
+            except LimiterRejected as e:
+                generate_span.record_exception(e)
+                raise
+            except Exception as e:
+                generate_span.record_exception(e)
+                logger.exception(f"Error streaming response: {e}")
+                if not parts:
+                    parts.append(f"Lỗi khi tạo phản hồi: {str(e)}")
+                    yield {"event": "token", "data": parts[-1]}
+            finally:
+                generate_span.end()
+            state["response"] = "".join(parts)
+
+            generated = state["response"]
+            state.update(await self._format_sources_node(state))
+            if state["response"] != generated:
+                yield {"event": "sources_text", "data": state["response"][len(generated):]}
+
+            self._log_retrievals(state)
+            # Lưu lịch sử sau khi stream hoàn tất
+            if username and state["response"]:
+                await self._save_chat_history(username, question, state["response"])
+            yield {"event": "done", "data": {
+                "response": state["response"],
+                "sources": state.get("sources") or [],
+                "metadata": self._answer_metadata(state)
+            }}
+        except LimiterRejected as e:
+            logger.warning(f"Rejected stream under LLM overload: {e}")
+            yield {"event": "error", "data": {"message": "Hệ thống đang quá tải, vui lòng thử lại sau.", "error": "overloaded"}}
+        except Exception as e:
+            logger.exception(f"Error in streaming workflow: {e}")
+            yield {"event": "error", "data": {"message": f"Lỗi hệ thống: {str(e)}", "error": "workflow_exception"}}
+
     def close(self):
         if hasattr(self.retriever, 'close'):
             self.retriever.close()
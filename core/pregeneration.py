@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple, TypedDict
+
+from config import settings as config
+from utils.concurrency_limiter import AdaptiveConcurrencyLimiter, priority as llm_priority
+from utils.generation_cache import document_scope, get_generation_cache, normalize_topic
+from utils.metrics import metrics
+from utils.tracing import current_span, tracer
+from vectorstores.base import parse_metadata
+
+logger = logging.getLogger(__name__)
+
+_MARKDOWN_HEADING_RE = re.compile(r"^\s{0,3}(#{1,3})\s+(.+?)\s*#*\s*$")
+# Tiêu đề trong văn bản thuần: "Chương 2: ...", "Phần I", "Bài 3 ...", "1. Giới thiệu", "2.1 Hồi quy tuyến tính"
+_CHAPTER_RE = re.compile(r"^(?:chương|phần|bài|chapter|part|section|lesson)\s+[\w.]+\b", re.IGNORECASE | re.UNICODE)
+_NUMBERED_RE = re.compile(r"^\d+(?:\.\d+)*\.?\s+\w", re.UNICODE)
+# Số thứ tự ở đầu tiêu đề ("Chương 2:", "II.", "2.1"); nhóm `label` là phần có tên gọi ("Chương 2")
+_NUMBERING_RE = re.compile(
+    r"^(?P<label>(?:(?:chương|phần|bài|chapter|part|section|lesson)\s+)?[\dIVXivx]+(?:\.\d+)*)(?!\w)[.:)\-–]?\s*",
+    re.IGNORECASE | re.UNICODE
+)
+# Tiêu đề không phải chủ đề học
+_GENERIC_TOPICS = {
+    "mục lục", "nội dung", "giới thiệu", "tổng quan", "kết luận", "tài liệu tham khảo", "câu hỏi", "bài tập",
+    "cảm ơn", "q&a", "table of contents", "contents", "outline", "agenda", "introduction", "conclusion",
+    "references", "questions", "thank you", "thanks",
+}
+_MIN_TOPIC_CHARS = 4
+_MAX_TOPIC_CHARS = 80
+
+
+class PregenerationJob(TypedDict):
+    source: str
+    owner: str
+
+
+def _clean_heading(text: str) -> str:
+    text = re.sub(r"[*_`]+", "", text).strip()
+    return text.rstrip(":：-–").strip()
+
+
+def _is_topic(text: str) -> bool:
+    if not _MIN_TOPIC_CHARS <= len(text) <= _MAX_TOPIC_CHARS or text.endswith((".", "?", "!")):
+        return False
+    # Bỏ số thứ tự ở đầu khi so với danh sách tiêu đề chung chung
+    bare = _NUMBERING_RE.sub("", text)
+    return normalize_topic(bare or text) not in _GENERIC_TOPICS and any(ch.isalpha() for ch in text)
+
+
+def document_topics(chunks: Sequence[Dict[str, Any]], max_topics: int = 5) -> List[str]:
+    """
+    Main topics of a document from its chunks (in document order): markdown headings,
+    chapter/numbered headings in plain text and the title line of each slide/page.
+    Higher-level headings are preferred; the result keeps document order.
+    """
+    candidates: List[Tuple[int, int, str]] = []
+    seen = set()
+
+    def add(level: int, text: str) -> None:
+        text = _clean_heading(text)
+        key = normalize_topic(text)
+        if key and key not in seen and _is_topic(text):
+            seen.add(key)
+            candidates.append((level, len(candidates), text))
+
+    for chunk in chunks:
+        metadata = parse_metadata(chunk.get("metadata"))
+        lines = [line.strip() for line in (chunk.get("text") or "").splitlines() if line.strip()]
+        for line in lines:
+            heading = _MARKDOWN_HEADING_RE.match(line)
+            if heading:
+                add(len(heading.group(1)), heading.group(2))
+            elif _CHAPTER_RE.match(line):
+                add(1, line)
+            elif _NUMBERED_RE.match(line) and len(line) <= _MAX_TOPIC_CHARS:
+                add(3, line)
+        # Dòng đầu của mỗi slide/trang thường là tiêu đề của nó
+        if lines and metadata.get("slide_number") is not None and metadata.get("start_index") in (0, None):
+            add(2, lines[0].lstrip("#").strip())
+
+    best = sorted(candidates)[:max_topics]
+    return [text for _, _, text in sorted(best, key=lambda item: item[1])]
+
+
+def topic_aliases(topic: str) -> List[str]:
+    """
+    Ways a student names a topic: the full heading, the title without its numbering and
+    the chapter label ("Chương 2: Hồi quy tuyến tính" → "Hồi quy tuyến tính", "Chương 2").
+    """
+    aliases = [topic]
+    numbering = _NUMBERING_RE.match(topic)
+    if numbering:
+        bare = topic[numbering.end():].strip()
+        if len(bare) >= _MIN_TOPIC_CHARS:
+            aliases.append(bare)
+        if not numbering.group("label")[0].isdigit() and not re.fullmatch(r"[IVXivx]+", numbering.group("label")):
+            aliases.append(numbering.group("label"))
+    return list(dict.fromkeys(aliases))
+
+
+class Pregenerator:
+    """
+    Low-priority post-indexing pipeline: after a document is indexed, derives its main
+    topics and pre-generates the configured tools' artifacts (summary, mind map, flashcards)
+    for each one, so the generation cache already holds them when a student asks.
+
+    Jobs run one at a time on the event loop, their LLM calls use the "background" limiter
+    priority, and the worker pauses between generations while interactive load is high.
+    """
+
+    def __init__(self, assistant, limiter: Optional[AdaptiveConcurrencyLimiter] = None,
+                 tools: Optional[Sequence[str]] = None, max_topics: int = config.PREGENERATION_MAX_TOPICS,
+                 max_load: float = config.PREGENERATION_MAX_LOAD, pause: float = config.PREGENERATION_PAUSE_SECONDS,
+                 max_pending: int = config.PREGENERATION_MAX_PENDING):
+        self.assistant = assistant
+        self.limiter = limiter
+        self.tools = list(tools if tools is not None else config.PREGENERATION_TOOLS)
+        self.max_topics = max_topics
+        self.max_load = max_load
+        self.pause = pause
+        self.max_pending = max_pending
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        """Starts the worker on the running event loop."""
+        if self._worker is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._worker = self._loop.create_task(self._run())
+        logger.info(f"Pre-generation worker started (tools: {', '.join(self.tools)})")
+
+    async def stop(self) -> None:
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+
+    def submit(self, source: str, owner: str) -> bool:
+        """
+        Queues a freshly indexed document. Safe to call from any thread (indexing runs in
+        a worker thread); returns False when the worker is not running.
+        """
+        if self._worker is None or self._loop is None or self._loop.is_closed():
+            return False
+        self._loop.call_soon_threadsafe(self._enqueue, PregenerationJob(source=source, owner=owner))
+        return True
+
+    def _enqueue(self, job: PregenerationJob) -> None:
+        try:
+            self._queue.put_nowait(job)
+            metrics.set_gauge("pregeneration.pending", self._queue.qsize())
+        except asyncio.QueueFull:
+            # Sinh trước chỉ là tối ưu: bỏ việc khi hàng đợi đầy thay vì dồn tải
+            metrics.increment("pregeneration.dropped")
+            logger.warning(f"Pre-generation queue full, skipping '{job['source']}'")
+
+    async def _run(self) -> None:
+        while True:
+            job = await self._queue.get()
+            metrics.set_gauge("pregeneration.pending", self._queue.qsize())
+            try:
+                await self.pregenerate(job["source"], job["owner"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"Pre-generation failed for '{job['source']}': {e}")
+            finally:
+                self._queue.task_done()
+
+    def interactive_load_high(self) -> bool:
+        """Whether interactive calls are waiting for, or hold most of, the LLM limiter."""
+        return self.limiter is not None and self.limiter.busy("routing", self.max_load)
+
+    async def _wait_for_quiet(self) -> None:
+        paused = False
+        while self.interactive_load_high():
+            if not paused:
+                paused = True
+                metrics.increment("pregeneration.paused")
+                logger.debug("Pre-generation paused: interactive load is high")
+            await asyncio.sleep(self.pause)
+
+    async def _document_chunks(self, source: str, owner: str) -> List[Dict[str, Any]]:
+        vector_store = self.assistant.retriever.vector_store
+        if vector_store is None:
+            return []
+        records = await asyncio.to_thread(vector_store.query, {"source": source, "owner": owner}, 10000)
+
+        def position(record: Dict[str, Any]) -> Tuple[int, int]:
+            metadata = parse_metadata(record.get("metadata"))
+            return int(metadata.get("slide_number") or 0), int(metadata.get("start_index") or 0)
+        return sorted(records, key=position)
+
+    async def pregenerate(self, source: str, owner: str) -> Dict[str, Any]:
+        """Pre-generates every configured artifact for the main topics of `source`."""
+        tools = [name for name in self.tools if self.assistant.tool_registry.has_tool(name)]
+        with tracer.trace_request("pregenerate"), llm_priority("background"):
+            current_span().set_attribute("source", source)
+            chunks = await self._document_chunks(source, owner)
+            topics = document_topics(chunks, self.max_topics)
+            logger.info(f"Pre-generating {tools} for {len(topics)} topic(s) of '{source}': {topics}")
+            if not topics:
+                return {"source": source, "topics": topics, "runs": 0}
+            # Bản sinh trước được lưu theo (tài liệu, chủ đề); yêu cầu của người dùng tìm lại qua các chunk nó truy xuất được
+            fingerprint = await asyncio.to_thread(
+                get_generation_cache().register_document, source, owner,
+                [chunk.get("id") for chunk in chunks], {topic: topic_aliases(topic) for topic in topics}
+            )
+            # Tìm trong phân vùng chứa tài liệu (và phân vùng dùng chung) như một người đọc tài liệu này
+            partition_keys = list(dict.fromkeys([config.SHARED_PARTITION_KEY, owner]))
+            runs = 0
+            for topic in topics:
+                for name in tools:
+                    await self._wait_for_quiet()
+                    try:
+                        with document_scope(fingerprint):
+                            await self.assistant.tool_registry.execute_tool(name, question=topic, partition_keys=partition_keys)
+                        runs += 1
+                        metrics.increment("pregeneration.runs")
+                    except Exception as e:
+                        metrics.increment("pregeneration.failed")
+                        logger.warning(f"Pre-generation of {name} for '{topic}' failed: {e}")
+        return {"source": source, "topics": topics, "runs": runs}
+
+
+def create_pregenerator(assistant, limiter: Optional[AdaptiveConcurrencyLimiter] = None) -> Optional[Pregenerator]:
+    """The configured pre-generator, or None when disabled (it only helps when generations are cached)."""
+    if not config.PREGENERATION_ENABLED:
+        return None
+    if get_generation_cache() is None:
+        logger.warning("Pre-generation disabled: the generation cache is off")
+        return None
+    return Pregenerator(assistant, limiter)
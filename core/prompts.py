@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+from typing import Dict, List, Tuple, Union
+
+from langchain.prompts import ChatPromptTemplate, PromptTemplate
+from langchain_core.prompts import BasePromptTemplate
+
+logger = logging.getLogger(__name__)
+
+# Mẫu văn bản (PromptTemplate) hoặc danh sách (vai trò, nội dung) cho ChatPromptTemplate
+Template = Union[str, List[Tuple[str, str]]]
+
+
+class PromptRegistry:
+    """
+    Compiles every prompt template once, at import/startup, so that a request only
+    substitutes variables. Each prompt is versioned by a hash of its text: caches keyed
+    on `version(name)` stop matching as soon as the prompt changes.
+    """
+
+    def __init__(self):
+        self._templates: Dict[str, BasePromptTemplate] = {}
+        self._versions: Dict[str, str] = {}
+
+    def register(self, name: str, template: Template) -> BasePromptTemplate:
+        if isinstance(template, str):
+            compiled = PromptTemplate.from_template(template)
+        else:
+            compiled = ChatPromptTemplate.from_messages(template)
+        version = hashlib.sha1(json.dumps(template, ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+        if name in self._versions and self._versions[name] != version:
+            logger.warning(f"Prompt '{name}' re-registered with different text ({self._versions[name]} -> {version})")
+        self._templates[name] = compiled
+        self._versions[name] = version
+        return compiled
+
+    def has(self, name: str) -> bool:
+        return name in self._templates
+
+    def get(self, name: str) -> BasePromptTemplate:
+        return self._templates[name]
+
+    def version(self, name: str) -> str:
+        return self._versions[name]
+
+    def versions(self) -> Dict[str, str]:
+        return dict(self._versions)
+
+    def format(self, name: str, **variables) -> str:
+        """The prompt `name` as a single string, with `variables` substituted."""
+        return self._templates[name].format(**variables)
+
+
+# Registry dùng chung cho toàn bộ tiến trình
+prompts = PromptRegistry()
+
+
+ROUTER = prompts.register("router", [
+    ("system", """Bạn là một agent định tuyến thông minh. Nhiệm vụ của bạn là phân tích câu hỏi của người dùng và chọn hành động phù hợp nhất.
+
+                Các công cụ/hành động có sẵn:
+                {tools_description}
+                - RAG: Truy xuất thông tin từ tài liệu nội bộ (dùng khi câu hỏi liên quan đến tài liệu, ví dụ: "Tóm tắt slide 5").
+                - DIRECT: Trả lời trực tiếp không cần tài liệu hay công cụ (dùng cho lời chào, cảm ơn, hoặc câu hỏi chung chung).
+
+                Quy trình:
+                1. Phân tích ý định câu hỏi.
+                2. Nếu khớp với công cụ (như "tạo quiz", "tìm trên mạng"), chọn tên công cụ.
+                3. Nếu liên quan đến tài liệu, chọn "RAG".
+                4. Nếu không cần tài liệu/công cụ, chọn "DIRECT".
+                5. Nếu yêu cầu gồm nhiều việc cần các công cụ khác nhau (như "giải thích X và tạo quiz"), thêm 'actions': danh sách tên các công cụ theo thứ tự; 'action' là công cụ đầu tiên.
+                Ví dụ:
+                - "Tạo quiz từ tài liệu" -> 'action': 'Quiz_Generator', 'confidence': 0.95, 'reasoning': 'Yêu cầu tạo quiz rõ ràng'
+                - "Tìm thông tin trên web/Mai là thứ mấy" -> 'action': 'Web_Search', 'confidence': 0.9, 'reasoning': 'Yêu cầu tìm kiếm web'
+                - "Giải thích khái niệm trong slide" -> 'action': 'RAG', 'confidence': 0.85, 'reasoning': 'Liên quan đến tài liệu'
+                - "Xin chào" -> 'action': 'DIRECT', 'confidence': 0.99, 'reasoning': 'Lời chào đơn giản'
+                - "Giải thích overfitting và tạo quiz" -> 'action': 'Concept_Explainer', 'actions': ['Concept_Explainer', 'Quiz_Generator'], 'confidence': 0.9, 'reasoning': 'Hai yêu cầu: giải thích và tạo quiz'
+                Output có dạng:
+                    "action": "[Tên công cụ hoặc RAG hoặc DIRECT]", "actions": [Tùy chọn, chỉ khi cần nhiều công cụ], "confidence": [0.0-1.0], "reasoning": "[Lý do]"
+                Lưu ý : trả về Json
+                """),
+    ("human", "Lịch sử hội thoại:\n{chat_history}\n\nCâu hỏi người dùng:\n{question}"),
+])
+
+EMOTION = prompts.register("emotion", """Analyze the emotional state reflected in this text:
+
+            "{text}"
+
+            Identify:
+            1. Cảm xúc chính (ví dụ: vui, buồn, tức giận, bối rối, tò mò, thất vọng, phấn khích)
+            2. Emotional intensity (scale 1-10)
+            3. Key emotional triggers or concerns
+            4. Suggested tone for response
+
+            Return only a JSON with these keys:
+            {{"emotion": "primary_emotion", "intensity": intensity_number, "triggers": "key_triggers", "suggested_tone": "recommended_tone"}}
+            """)
+
+QUERY_EXPANSION = prompts.register(
+    "query_expansion",
+    "Viết lại câu hỏi sau thành {n} truy vấn tìm kiếm ngắn, khác nhau, cùng ý nghĩa "
+    "(có thể dùng thuật ngữ tiếng Anh). Mỗi truy vấn một dòng, không đánh số, không giải thích.\n\n"
+    "Câu hỏi: {question}"
+)
+
+_ANSWER_SYSTEM = """Bạn là EduMentor, một trợ lý học tập AI thông minh và thân thiện.
+
+        Phân tích cảm xúc người dùng: Họ đang thể hiện cảm xúc "{emotion}" với mức độ {emotion_intensity}/10.
+        Hãy điều chỉnh tông giọng của bạn để "{suggested_tone}" khi phản hồi.Nếu người dùng buồn chán hay chán nản với việc học,hãy tiếp thêm động lực cho người dùng.Khi người dùng vui vẻ,hãy chia vui với người dùng"""
+
+_CONTEXT_SECTION = ["--- Ngữ cảnh ---", "{context}", "--- Kết thúc ngữ cảnh ---"]
+_TOOL_SECTION = ["--- Kết quả từ '{tool_name}' ---", "{tool_result}", "--- Kết thúc kết quả ---"]
+_EXTRA_CONTEXT_SECTION = ["\n--- Ngữ cảnh bổ sung ---", "{context}", "--- Kết thúc ngữ cảnh ---"]
+_HISTORY_SECTION = ["\n--- Lịch sử hội thoại ---", "{chat_history}", "--- Kết thúc lịch sử ---"]
+
+# Chỉ dẫn hệ thống và các phần của prompt trả lời theo từng tuyến
+_ANSWER_MODES: Dict[str, Tuple[str, List[str]]] = {
+    "rag": ("\nHãy trả lời dựa vào ngữ cảnh tài liệu dưới đây.", _CONTEXT_SECTION),
+    "tool": ("\nSử dụng kết quả từ công cụ '{tool_name}'.", _TOOL_SECTION),
+    "tool_context": ("\nSử dụng kết quả từ công cụ '{tool_name}'.", _TOOL_SECTION + _EXTRA_CONTEXT_SECTION),
+    "direct": ("\nTrả lời trực tiếp và tự nhiên.", []),
+}
+
+
+def answer_prompt_name(mode: str, with_history: bool) -> str:
+    return f"answer.{mode}" + (".history" if with_history else "")
+
+
+ANSWER_PROMPTS = [answer_prompt_name(mode, with_history) for mode in _ANSWER_MODES for with_history in (False, True)]
+
+
+# Mọi biến thể của prompt trả lời được biên dịch sẵn; mỗi request chỉ chọn biến thể và điền biến
+for _mode, (_instruction, _sections) in _ANSWER_MODES.items():
+    for _with_history in (False, True):
+        _human = "\n\n".join(["Câu hỏi người dùng: {question}\n"] + _sections + (_HISTORY_SECTION if _with_history else []))
+        prompts.register(answer_prompt_name(_mode, _with_history), [
+            ("system", _ANSWER_SYSTEM + _instruction),
+            ("human", _human + "\n\nCâu trả lời của EduMentor:"),
+        ])
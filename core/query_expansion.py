@@ -0,0 +1,151 @@
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+from typing import Any, Dict, List, Optional, Sequence
+
+from langchain_core.output_parsers import StrOutputParser
+
+from config import settings as config
+from core.prompts import prompts
+from utils.metrics import metrics
+from utils.concurrency_limiter import priority as llm_priority
+
+logger = logging.getLogger(__name__)
+
+# Từ viết tắt / thuật ngữ thường gặp trong tài liệu học tập, dùng cho biến thể cục bộ (không cần LLM)
+SYNONYMS: Dict[str, List[str]] = {
+    "ai": ["trí tuệ nhân tạo", "artificial intelligence"],
+    "trí tuệ nhân tạo": ["ai"],
+    "ml": ["học máy", "machine learning"],
+    "học máy": ["machine learning"],
+    "machine learning": ["học máy"],
+    "dl": ["học sâu", "deep learning"],
+    "học sâu": ["deep learning"],
+    "deep learning": ["học sâu"],
+    "nn": ["mạng nơ-ron", "neural network"],
+    "mạng nơ-ron": ["neural network"],
+    "mạng neural": ["mạng nơ-ron", "neural network"],
+    "neural network": ["mạng nơ-ron"],
+    "csdl": ["cơ sở dữ liệu", "database"],
+    "cơ sở dữ liệu": ["database"],
+    "ctdl": ["cấu trúc dữ liệu", "data structure"],
+    "cấu trúc dữ liệu": ["data structure"],
+    "thuật toán": ["algorithm"],
+    "xác suất": ["probability"],
+}
+
+# Cụm hỏi không mang nội dung tìm kiếm
+_QUESTION_PHRASES = re.compile(
+    r"\b(là gì|là sao|như thế nào|thế nào|tại sao|vì sao|giải thích|cho (tôi|em|mình) (biết|hỏi)|"
+    r"hãy|giúp (tôi|em|mình)|what is|what are|explain|how does|how do|why)\b|[?!.]",
+    re.IGNORECASE | re.UNICODE,
+)
+
+
+def strip_diacritics(text: str) -> str:
+    """Removes Vietnamese diacritics ("mạng nơ-ron" -> "mang no-ron")."""
+    normalized = unicodedata.normalize("NFD", text)
+    stripped = "".join(ch for ch in normalized if unicodedata.category(ch) != "Mn")
+    return stripped.replace("đ", "d").replace("Đ", "D")
+
+
+def local_variants(question: str, max_variants: int = 3) -> List[str]:
+    """Cheap reformulations: keyword-only, synonym/abbreviation swaps and the diacritic-free form."""
+    variants: List[str] = []
+    keywords = re.sub(r"\s+", " ", _QUESTION_PHRASES.sub(" ", question)).strip()
+    if keywords and keywords.lower() != question.strip().lower():
+        variants.append(keywords)
+
+    lowered = keywords.lower()
+    for term, replacements in SYNONYMS.items():
+        # Từ viết tắt chỉ khớp khi viết hoa ("AI"), tránh nhầm với từ thường ("ai" = "người nào")
+        abbreviation = len(term) <= 4 and term.isascii()
+        text, flags = (keywords, 0) if abbreviation else (lowered, re.IGNORECASE)
+        pattern = rf"(?<!\w){re.escape(term.upper() if abbreviation else term)}(?!\w)"
+        if re.search(pattern, text, flags):
+            for replacement in replacements:
+                variants.append(re.sub(pattern, replacement, text, flags=flags))
+            break
+
+    plain = strip_diacritics(keywords)
+    if plain != keywords:
+        variants.append(plain)
+
+    seen = {question.strip().lower()}
+    unique = []
+    for variant in variants:
+        if variant and variant.lower() not in seen:
+            seen.add(variant.lower())
+            unique.append(variant)
+    return unique[:max_variants]
+
+
+class QueryExpander:
+    """Generates reformulations of a question: local variants first, the LLM only when enabled."""
+
+    def __init__(self, llm: Any = None, use_llm: bool = config.QUERY_EXPANSION_LLM,
+                 max_variants: int = config.QUERY_EXPANSION_MAX_VARIANTS):
+        self.llm = llm
+        self.use_llm = use_llm and llm is not None
+        self.max_variants = max_variants
+        self._llm_chain = None
+        if self.use_llm:
+            self._llm_chain = prompts.get("query_expansion") | llm | StrOutputParser()
+
+    def should_expand(self, question: str) -> bool:
+        # Chỉ mở rộng câu hỏi ngắn/mơ hồ; câu hỏi dài thường đã đủ cụ thể
+        return len(question.split()) <= config.QUERY_EXPANSION_MAX_WORDS
+
+    async def expand(self, question: str, budget_seconds: float = config.QUERY_EXPANSION_BUDGET_SECONDS) -> List[str]:
+        """Reformulations of `question` (the question itself excluded), produced within the budget."""
+        started = time.monotonic()
+        variants = local_variants(question, self.max_variants)
+        metrics.increment("query_expansion.local_variants", len(variants))
+
+        remaining = budget_seconds - (time.monotonic() - started)
+        if self._llm_chain is not None and len(variants) < self.max_variants and remaining > 0:
+            try:
+                with llm_priority("routing"):
+                    text = await asyncio.wait_for(
+                        self._llm_chain.ainvoke({"question": question, "n": self.max_variants - len(variants)}),
+                        timeout=remaining
+                    )
+                llm_variants = [line.strip(" -•*\t") for line in text.splitlines() if line.strip(" -•*\t")]
+                known = {question.lower(), *(v.lower() for v in variants)}
+                variants += [v for v in llm_variants if v.lower() not in known]
+                metrics.increment("query_expansion.llm_calls")
+            except asyncio.TimeoutError:
+                metrics.increment("query_expansion.llm_timeouts")
+                logger.info("Query expansion: LLM variants skipped, budget exhausted")
+            except Exception as e:
+                logger.warning(f"Query expansion: LLM variants failed: {e}")
+        return variants[:self.max_variants]
+
+
+def reciprocal_rank_fusion(result_lists: Sequence[List[Dict[str, Any]]], k: int = 60,
+                           top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Fuses ranked result lists by reciprocal rank (sum of 1 / (k + rank)), deduplicated
+    by chunk id (or text). Each fused result is its best-ranked copy; "score" becomes the
+    fused score and the retriever's score is kept as "retrieval_score".
+    """
+    fused: Dict[Any, Dict[str, Any]] = {}
+    for results in result_lists:
+        for rank, result in enumerate(results):
+            key = result.get("id", result.get("text"))
+            entry = fused.get(key)
+            if entry is None:
+                entry = fused[key] = {"result": dict(result), "rrf": 0.0, "best_rank": rank}
+            elif rank < entry["best_rank"]:
+                entry["result"], entry["best_rank"] = dict(result), rank
+            entry["rrf"] += 1.0 / (k + rank + 1)
+
+    ranked = sorted(fused.values(), key=lambda entry: entry["rrf"], reverse=True)
+    output = []
+    for entry in ranked[:top_k] if top_k else ranked:
+        entry["result"]["retrieval_score"] = entry["result"].get("score")
+        entry["result"]["score"] = entry["rrf"]
+        output.append(entry["result"])
+    return output
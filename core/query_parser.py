@@ -0,0 +1,44 @@
+import re
+from typing import List, Optional, TypedDict
+
+# Giới hạn số slide trong một khoảng để tránh "slide 1-1000" quét toàn bộ tài liệu
+MAX_POSITIONS = 20
+
+_POSITION_RE = re.compile(
+    r"\b(?P<kind>slides?|trang|pages?)\s*(?:số\s*)?(?P<start>\d{1,4})"
+    r"(?:\s*(?:-|–|đến|tới|to)\s*(?P<end>\d{1,4}))?"
+    r"(?P<more>(?:\s*(?:,|và|and)\s*\d{1,4})*)",
+    re.IGNORECASE | re.UNICODE,
+)
+_QUOTED_SOURCE_RE = re.compile(r"[\"“'‘](?P<name>[^\"”'’]+?\.(?:pdf|docx|txt|pptx?))[\"”'’]", re.IGNORECASE)
+_SOURCE_RE = re.compile(r"(?P<name>[\w\-.()]+\.(?:pdf|docx|txt|pptx?))\b", re.IGNORECASE | re.UNICODE)
+
+
+class PositionalQuery(TypedDict):
+    kind: str
+    slide_numbers: List[int]
+    source: Optional[str]
+
+
+def parse_positional_query(question: str) -> Optional[PositionalQuery]:
+    """
+    Detects slide/page references such as "Tóm tắt slide 5", "trang 3-4 của bai_giang.pdf"
+    or "slides 2, 5 và 7". Returns None when the question does not name a position.
+    """
+    if not question:
+        return None
+    match = _POSITION_RE.search(question)
+    if not match:
+        return None
+
+    start = int(match.group("start"))
+    end = int(match.group("end")) if match.group("end") else start
+    if end < start:
+        start, end = end, start
+    numbers = list(range(start, min(end, start + MAX_POSITIONS - 1) + 1))
+    numbers += [int(n) for n in re.findall(r"\d+", match.group("more") or "")]
+    numbers = sorted(set(numbers))[:MAX_POSITIONS]
+
+    source_match = _QUOTED_SOURCE_RE.search(question) or _SOURCE_RE.search(question)
+    kind = "page" if match.group("kind").lower() in ("trang", "page", "pages") else "slide"
+    return PositionalQuery(kind=kind, slide_numbers=numbers, source=source_match.group("name") if source_match else None)
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import settings as config
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# (truy vấn, top_k, partition keys, bộ lọc) của một lần tìm kiếm
+SearchKey = Tuple[str, int, Optional[Tuple[str, ...]], Optional[str]]
+
+
+class RetrievalContext:
+    """
+    The retrievals of one request, as structured hits keyed by their search parameters.
+    The graph records what it retrieved; tools get chunks through `search`, which only
+    runs a new search when the request has no result (finished or in flight) for the
+    same query, top_k, partitions and filters.
+    """
+
+    def __init__(self, default_top_k: int = config.RETRIEVER_TOP_K):
+        self.default_top_k = default_top_k
+        self._entries: Dict[SearchKey, asyncio.Future] = {}
+        self.searches = 0
+        self.reused = 0
+
+    def _key(self, query: str, top_k: Optional[int], partition_keys: Optional[List[str]],
+             filter_metadata: Optional[Dict[str, Any]]) -> SearchKey:
+        return (
+            query.strip(),
+            top_k or self.default_top_k,
+            tuple(sorted(set(partition_keys))) if partition_keys is not None else None,
+            json.dumps(filter_metadata, sort_keys=True, default=str) if filter_metadata else None,
+        )
+
+    def record(self, query: str, hits: List[Dict[str, Any]], top_k: Optional[int] = None,
+               partition_keys: Optional[List[str]] = None, filter_metadata: Optional[Dict[str, Any]] = None,
+               report: Optional[Dict[str, Any]] = None) -> None:
+        """Stores hits retrieved outside `search` (by the graph) under their search parameters."""
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(([dict(hit) for hit in hits], report or {}))
+        self._entries[self._key(query, top_k, partition_keys, filter_metadata)] = future
+        self.searches += 1
+        metrics.increment("retrieval_context.searches")
+
+    async def search(self, retriever, query: str, top_k: Optional[int] = None,
+                     partition_keys: Optional[List[str]] = None,
+                     filter_metadata: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """The hits for these parameters: reused from this request if available, searched otherwise."""
+        key = self._key(query, top_k, partition_keys, filter_metadata)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.searches += 1
+            metrics.increment("retrieval_context.searches")
+            entry = asyncio.ensure_future(retriever.search_with_report(
+                query, top_k=top_k or self.default_top_k, filter_metadata=filter_metadata, partition_keys=partition_keys
+            ))
+            self._entries[key] = entry
+            # Lỗi không được giữ lại: lần gọi sau tìm kiếm lại
+            entry.add_done_callback(lambda t, k=key: self._forget_failed(k, t))
+        else:
+            self.reused += 1
+            metrics.increment("retrieval_context.reused")
+            logger.debug(f"Reusing retrieval for '{query[:50]}'")
+        # Một caller bị hủy không được hủy tìm kiếm dùng chung với caller khác
+        hits, _ = await asyncio.shield(entry)
+        return [dict(hit) for hit in hits]
+
+    def _forget_failed(self, key: SearchKey, task: asyncio.Future) -> None:
+        if (task.cancelled() or task.exception() is not None) and self._entries.get(key) is task:
+            del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"searches": self.searches, "reused": self.reused}
@@ -1,6 +1,6 @@
 import os
+import hashlib
 from typing import List, Dict, Optional, Any
-from pymilvus import Collection, connections, FieldSchema, CollectionSchema, DataType, utility
 from sentence_transformers import SentenceTransformer
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from mistralai import Mistral
@@ -10,16 +10,18 @@ import json
 import docx2txt
 import tempfile
 from docx import Document
+from config import settings as config
+from vectorstores import VectorStore, create_vector_store
  
 
 load_dotenv()
 
 class DocumentIndexer:
     def __init__(self, collection_name: str, model_name: str = "all-MiniLM-L6-v2", 
-                 host: str = "localhost", port: str = "19530", chunk_size: int = 500, chunk_overlap: int = 50):
+                 host: str = "localhost", port: str = "19530", chunk_size: int = 500, chunk_overlap: int = 50,
+                 vector_store: Optional[VectorStore] = None):
         self.milvus_host = host
         self.milvus_port = port
-        connections.connect(host=host, port=port)
         self.collection_name = collection_name
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
@@ -28,22 +30,20 @@ class DocumentIndexer:
         self.text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=len, add_start_index=True
         )
+        # Chỉ đóng vector store do chính indexer tạo ra
+        self._owns_vector_store = vector_store is None
+        self.vector_store = vector_store or create_vector_store(collection_name, host=host, port=port,
+                                                                alias=f"{config.MILVUS_CONNECTION_ALIAS}_indexer")
         self._setup_collection()
 
     def _setup_collection(self):
-        if utility.has_collection(self.collection_name):
-            self.collection = Collection(self.collection_name)
-        else:
-            fields = [
-                FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=False),
-                FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=65535),
-                FieldSchema(name="source", dtype=DataType.VARCHAR, max_length=255),
-                FieldSchema(name="metadata", dtype=DataType.VARCHAR, max_length=65535),
-                FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=self.embedding_dim)
-            ]
-            schema = CollectionSchema(fields=fields, description=f"Collection for {self.collection_name}")
-            self.collection = Collection(name=self.collection_name, schema=schema)
-            self.collection.create_index(field_name="embedding", index_params={"metric_type": "L2", "index_type": "HNSW", "params": {"M": 8, "efConstruction": 64}})
+        self.vector_store.ensure_collection(self.embedding_dim)
+
+    @staticmethod
+    def _chunk_id(source: str, position: int, text: str) -> int:
+        """Stable 63-bit id per chunk, unique across documents (Milvus INT64 primary key)."""
+        digest = hashlib.blake2b(f"{source}\x00{position}\x00{text}".encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big") & ((1 << 63) - 1)
 
     def _chunk_documents(self, text: str, source_path: str, doc_metadata: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         langchain_docs = self.text_splitter.create_documents([text])
@@ -60,11 +60,14 @@ class DocumentIndexer:
         return chunks_data
 
     def index_document(self, file_path: str, file_type: Optional[str] = None, 
-                   chunk_size: Optional[int] = None, doc_metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+                   chunk_size: Optional[int] = None, doc_metadata: Optional[Dict[str, Any]] = None,
+                   owner: Optional[str] = None) -> Dict[str, Any]:
         try:
             file_ext = os.path.splitext(file_path)[1].lower()
             base_metadata = doc_metadata or {"title": "Unknown"}
             base_metadata["filename"] = os.path.basename(file_path)
+            owner = owner or config.SHARED_PARTITION_KEY
+            base_metadata["owner"] = owner
 
             # Đọc nội dung theo loại file
             if file_ext == '.pdf':
@@ -94,12 +97,14 @@ class DocumentIndexer:
 
             # Lập chỉ mục chung
             vectors = self.model.encode([chunk["text"] for chunk in chunks_data], batch_size=32).tolist()
+            source = os.path.basename(file_path)
             entities = [
                 {
-                    "id": i,
+                    "id": self._chunk_id(source, i, chunk["text"]),
                     "text": chunk["text"],
-                    "source": os.path.basename(file_path),
+                    "source": source,
                     "metadata": json.dumps(chunk["metadata"], ensure_ascii=False),
+                    "owner": owner,
                     "embedding": vector
                 }
                 for i, (chunk, vector) in enumerate(zip(chunks_data, vectors))
@@ -107,10 +112,13 @@ class DocumentIndexer:
             ]
             
             if entities:
-                self.collection.insert(entities)
-                self.collection.flush()
+                self.vector_store.insert(entities)
                 return {"success": True, "documents_added": len(entities)}
             return {"success": False, "documents_added": 0, "error": "No content to index"}
         except Exception as e:
             print(f"Error indexing document: {str(e)}")
-            return {"success": False, "documents_added": 0, "error": str(e)}
\ No newline at end of file
+            return {"success": False, "documents_added": 0, "error": str(e)}
+
+    def close(self):
+        if self.vector_store and self._owns_vector_store:
+            self.vector_store.close()
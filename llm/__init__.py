@@ -0,0 +1,55 @@
+# llm/__init__.py
+from langchain_core.language_models import BaseLLM
+
+from .fake_llm import FakeLLM
+from .limited_llm import LimitedLLM
+from .policy import CallPolicy, DeadlineExceeded, PolicyLLM, request_deadline
+from config import settings as config
+from utils.concurrency_limiter import get_llm_limiter
+
+
+def create_llm(backend: str = None, model_name: str = None, api_key: str = None, temperature: float = None) -> BaseLLM:
+    """
+    Creates the configured LLM backend ("gemini" or "fake"), behind the shared concurrency
+    limiter when LLM_LIMITER_ENABLED and the retry/hedging/deadline policy. Every backend
+    is a LangChain text LLM, so callers use `ainvoke`/`astream` or compose it into chains unchanged.
+    """
+    llm = _create_backend(backend, model_name, api_key, temperature)
+    model = getattr(llm, "model", None)
+    if config.LLM_LIMITER_ENABLED:
+        # Mỗi lần thử lại hoặc gửi dự phòng chiếm một chỗ riêng trong limiter
+        llm = LimitedLLM(llm=llm, limiter=get_llm_limiter(), model=model)
+    policy = CallPolicy(
+        max_retries=config.LLM_MAX_RETRIES,
+        backoff_base=config.LLM_RETRY_BACKOFF_SECONDS,
+        backoff_cap=config.LLM_RETRY_BACKOFF_CAP_SECONDS,
+        hedge=config.LLM_HEDGE_ENABLED,
+        hedge_min_samples=config.LLM_HEDGE_MIN_SAMPLES,
+        hedge_min_delay=config.LLM_HEDGE_MIN_DELAY_SECONDS
+    )
+    return PolicyLLM(llm=llm, policy=policy, model=model)
+
+
+def _create_backend(backend: str, model_name: str, api_key: str, temperature: float) -> BaseLLM:
+    backend = (backend or config.LLM_BACKEND).lower()
+    temperature = config.LLM_TEMPERATURE if temperature is None else temperature
+    if backend == "fake":
+        return FakeLLM(
+            latency_ms=config.FAKE_LLM_LATENCY_MS,
+            latency_jitter_ms=config.FAKE_LLM_LATENCY_JITTER_MS,
+            latency_distribution=config.FAKE_LLM_LATENCY_DISTRIBUTION,
+            tokens_per_second=config.FAKE_LLM_TOKENS_PER_SECOND,
+            failure_rate=config.FAKE_LLM_FAILURE_RATE,
+            seed=config.FAKE_LLM_SEED
+        )
+    if backend == "gemini":
+        # Import trễ để chạy với backend giả không cần cài langchain_google_genai
+        from langchain_google_genai import GoogleGenerativeAI
+        return GoogleGenerativeAI(
+            model=model_name or config.LLM_MODEL_NAME,
+            google_api_key=api_key or config.GOOGLE_API_KEY,
+            temperature=temperature,
+            # Một lần gọi: thử lại do CallPolicy đảm nhận để limiter thấy mọi lỗi 429
+            max_retries=1
+        )
+    raise ValueError(f"Unknown LLM backend: {backend}")
@@ -0,0 +1,71 @@
+import argparse
+import asyncio
+import time
+from typing import Any, Dict, List, Sequence
+
+from config import settings as config
+
+# Câu hỏi mẫu phủ các tuyến chính: RAG, DIRECT và các công cụ sinh JSON
+DEFAULT_QUESTIONS = [
+    "Entropy trong cây quyết định là gì?",
+    "Thuật toán BFS hoạt động như thế nào?",
+    "Xin chào",
+    "Tạo quiz 5 câu về tìm kiếm theo chiều rộng",
+    "Tạo flashcard về các thuật toán tìm kiếm",
+    "Vẽ sơ đồ tư duy về học máy",
+]
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def run(assistant: Any, questions: Sequence[str], requests: int, concurrency: int) -> Dict[str, Any]:
+    """Sends `requests` questions through `assistant.answer` with at most `concurrency` in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(i: int) -> None:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await assistant.answer(questions[i % len(questions)])
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "throughput": round(requests / elapsed, 2) if elapsed else 0.0,
+        "p50": round(_percentile(latencies, 0.5), 3),
+        "p95": round(_percentile(latencies, 0.95), 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure end-to-end /ask throughput offline with the fake LLM backend")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--backend", default="fake", help="LLM backend (fake by default; gemini hits the real API)")
+    args = parser.parse_args()
+
+    config.LLM_BACKEND = args.backend
+    from core.learning_assistant_v2 import LearningAssistant
+
+    assistant = LearningAssistant(mongo_collection=None)
+    report = asyncio.run(run(assistant, DEFAULT_QUESTIONS, args.requests, args.concurrency))
+    print(f"Backend: {args.backend}, vector store: {config.VECTOR_STORE_BACKEND}")
+    print(f"{report['requests']} requests in {report['seconds']}s ({report['errors']} errors)")
+    print(f"Throughput: {report['throughput']} req/s, latency p50 {report['p50']}s, p95 {report['p95']}s")
+
+
+if __name__ == "__main__":
+    main()
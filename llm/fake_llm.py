@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import json
+import math
+import random
+import re
+import time
+import zlib
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+from pydantic import PrivateAttr
+
+# Từ dùng để ghép câu trả lời giả (chỉ cần độ dài và số token giống thật)
+_FILLER = (
+    "khái niệm này được trình bày trong tài liệu với các ý chính sau đây gồm định nghĩa ví dụ minh họa "
+    "ứng dụng thực tế và những điểm cần lưu ý khi ôn tập để hiểu rõ bản chất vấn đề"
+).split()
+
+
+class FakeLLM(LLM):
+    """
+    Deterministic local stand-in for the Gemini backend, for load tests and offline benchmarks.
+
+    Answers after a sampled time-to-first-token (`latency_distribution` of "constant",
+    "uniform", "normal" or "lognormal" around `latency_ms`), then emits tokens at
+    `tokens_per_second`. Router, emotion, quiz, flashcard, mind map and query expansion
+    prompts get well-formed templated outputs; everything else gets filler text.
+    The same prompt and seed always give the same output; latencies and simulated
+    failures (`failure_rate`) come from a seeded sequence in call order.
+    """
+
+    model: str = "fake"
+    latency_ms: float = 800.0
+    latency_jitter_ms: float = 200.0
+    latency_distribution: str = "lognormal"
+    tokens_per_second: float = 60.0
+    response_words: int = 120
+    failure_rate: float = 0.0
+    seed: int = 0
+
+    # Độ trễ và lỗi giả lập lấy từ một dãy riêng theo thứ tự gọi: lần thử lại hoặc request dự phòng
+    # với cùng prompt có độ trễ khác, như API thật
+    _calls: random.Random = PrivateAttr(default=None)
+
+    @property
+    def _llm_type(self) -> str:
+        return "edumentor-fake"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model": self.model, "latency_ms": self.latency_ms, "tokens_per_second": self.tokens_per_second}
+
+    def _rng(self, prompt: str) -> random.Random:
+        digest = hashlib.blake2b(f"{self.seed}\x00{prompt}".encode("utf-8"), digest_size=8).digest()
+        return random.Random(int.from_bytes(digest, "big"))
+
+    def _call_rng(self) -> random.Random:
+        if self._calls is None:
+            self._calls = random.Random(self.seed)
+        return self._calls
+
+    def _first_token_delay(self) -> float:
+        rng = self._call_rng()
+        mean, jitter = self.latency_ms, self.latency_jitter_ms
+        if self.latency_distribution == "constant" or jitter <= 0:
+            delay = mean
+        elif self.latency_distribution == "uniform":
+            delay = rng.uniform(mean - jitter, mean + jitter)
+        elif self.latency_distribution == "normal":
+            delay = rng.gauss(mean, jitter)
+        else:
+            # Lognormal có đuôi dài như độ trễ thật của API; tham số hóa theo trung bình và độ lệch chuẩn
+            sigma2 = math.log(1 + (jitter / mean) ** 2) if mean > 0 else 0.0
+            delay = rng.lognormvariate(math.log(max(mean, 1e-3)) - sigma2 / 2, math.sqrt(sigma2))
+        return max(0.0, delay) / 1000
+
+    def _respond(self, prompt: str, rng: random.Random) -> str:
+        if self.failure_rate and self._call_rng().random() < self.failure_rate:
+            raise ConnectionError("FakeLLM: simulated transient failure")
+        if "agent định tuyến" in prompt:
+            return json.dumps(_route(prompt), ensure_ascii=False)
+        if "Analyze the emotional state" in prompt:
+            return json.dumps({"emotion": "neutral", "intensity": 5, "triggers": "none", "suggested_tone": "balanced"})
+        if '"quiz_id"' in prompt:
+            return json.dumps(_quiz(prompt), ensure_ascii=False)
+        if '"deck_id"' in prompt:
+            return json.dumps(_flashcards(prompt), ensure_ascii=False)
+        if "sơ đồ tư duy" in prompt:
+            topic = _topic(prompt)
+            return f"# 🧠 {topic}\n" + "".join(f"- 📌 Nhánh {i}: ý chính {i} về {topic}\n  - Chi tiết {i}.1\n" for i in range(1, 4))
+        match = re.search(r"thành (\d+) truy vấn tìm kiếm", prompt)
+        if match:
+            question = prompt.rsplit("Câu hỏi:", 1)[-1].strip()
+            return "\n".join(f"{question} {word}" for word in rng.sample(_FILLER, int(match.group(1))))
+        return " ".join(rng.choice(_FILLER) for _ in range(self.response_words)).capitalize() + "."
+
+    def _tokens(self, text: str) -> List[str]:
+        return re.findall(r"\S+\s*|\s+", text)
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        rng = self._rng(prompt)
+        text = self._respond(prompt, rng)
+        time.sleep(self._first_token_delay() + len(self._tokens(text)) / self.tokens_per_second)
+        return text
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        rng = self._rng(prompt)
+        text = self._respond(prompt, rng)
+        await asyncio.sleep(self._first_token_delay() + len(self._tokens(text)) / self.tokens_per_second)
+        return text
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        rng = self._rng(prompt)
+        text = self._respond(prompt, rng)
+        time.sleep(self._first_token_delay())
+        for token in self._tokens(text):
+            time.sleep(1 / self.tokens_per_second)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        rng = self._rng(prompt)
+        text = self._respond(prompt, rng)
+        await asyncio.sleep(self._first_token_delay())
+        for token in self._tokens(text):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            chunk = GenerationChunk(text=token)
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+
+def _topic(prompt: str) -> str:
+    match = re.search(r'chủ đề "([^"]+)"', prompt)
+    return match.group(1) if match else "Chủ đề"
+
+
+def _route(prompt: str) -> Dict[str, Any]:
+    from core.intent_router import RULES
+    question = prompt.rsplit("Câu hỏi người dùng:", 1)[-1].strip()
+    for action, pattern in RULES:
+        if pattern.search(question):
+            return {"action": action, "confidence": 0.9, "reasoning": "fake: khớp từ khóa"}
+    return {"action": "RAG", "confidence": 0.7, "reasoning": "fake: mặc định"}
+
+
+def _quiz(prompt: str) -> Dict[str, Any]:
+    match = re.search(r"gồm (\d+) câu hỏi", prompt)
+    count, topic = int(match.group(1)) if match else 5, _topic(prompt)
+    return {
+        "quiz_id": f"quiz_fake_{zlib.crc32(topic.encode('utf-8'))}",
+        "questions": [
+            {"id": i, "question_text": f"Câu hỏi {i} về {topic}?",
+             "options": [f"Lựa chọn {c}" for c in "ABCD"], "correct_answer_index": i % 4}
+            for i in range(1, count + 1)
+        ],
+    }
+
+
+def _flashcards(prompt: str) -> Dict[str, Any]:
+    topic = _topic(prompt)
+    return {
+        "deck_id": f"flashcard_fake_{zlib.crc32(topic.encode('utf-8'))}",
+        "topic": topic,
+        "cards": [{"id": i, "front": f"Thuật ngữ {i} của {topic}", "back": f"Định nghĩa {i}.", "source_slide": i} for i in range(1, 11)],
+    }
@@ -0,0 +1,52 @@
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseLLM
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+
+class LimitedLLM(LLM):
+    """
+    Wraps an LLM so that every async call (and every stream, for its whole duration)
+    holds a slot of an AdaptiveConcurrencyLimiter, at the caller's current priority.
+    Sync calls are passed through unlimited.
+    """
+
+    llm: BaseLLM
+    limiter: Any
+    model: Optional[str] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return f"limited-{self.llm._llm_type}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model": self.model, "limiter": self.limiter.name}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return self.llm.invoke(prompt, stop=stop, **kwargs)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        for text in self.llm.stream(prompt, stop=stop, **kwargs):
+            chunk = GenerationChunk(text=text)
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        async with self.limiter.slot():
+            return await self.llm.ainvoke(prompt, stop=stop, **kwargs)
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        async with self.limiter.slot():
+            async for text in self.llm.astream(prompt, stop=stop, **kwargs):
+                chunk = GenerationChunk(text=text)
+                if run_manager:
+                    await run_manager.on_llm_new_token(text, chunk=chunk)
+                yield chunk
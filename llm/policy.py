@@ -0,0 +1,249 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, TypeVar
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseLLM
+from langchain_core.language_models.llms import LLM
+from langchain_core.outputs import GenerationChunk
+
+from utils.concurrency_limiter import LimiterRejected, current_priority, is_rate_limited
+from utils.metrics import metrics
+from utils.tracing import current_span, tracer
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Thời điểm (time.monotonic) mà request hiện tại phải xong; None là không giới hạn
+_deadline: ContextVar[Optional[float]] = ContextVar("llm_deadline", default=None)
+
+_TRANSIENT_NAMES = {"ServiceUnavailable", "InternalServerError", "ServerError", "DeadlineExceeded",
+                    "ReadTimeout", "ConnectTimeout", "RemoteProtocolError", "ConnectError"}
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """The request's deadline passed; existing `except asyncio.TimeoutError` handlers catch it."""
+
+
+@contextlib.contextmanager
+def request_deadline(seconds: Optional[float]) -> Iterator[None]:
+    """LLM calls made inside the block (and in tasks it starts) finish within `seconds`, or raise DeadlineExceeded."""
+    deadline = None if seconds is None else time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None and (deadline is None or outer < deadline):
+        deadline = outer
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def deadline_remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Errors worth retrying: throttling, connection problems, timeouts and 5xx responses."""
+    if isinstance(exc, (DeadlineExceeded, LimiterRejected)):
+        return False
+    if is_rate_limited(exc) or isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    return status in (500, 502, 503, 504) or type(exc).__name__ in _TRANSIENT_NAMES
+
+
+class CallPolicy:
+    """
+    Retries transient LLM errors with full-jitter exponential backoff and, when enabled,
+    hedges a call that has not answered after the recent p95 latency of its priority with
+    a duplicate, keeping the first success. Every attempt, hedge and backoff sleep stays
+    within the current request deadline.
+    """
+
+    def __init__(self, max_retries: int = 2, backoff_base: float = 0.5, backoff_cap: float = 8.0,
+                 hedge: bool = False, hedge_min_samples: int = 20, hedge_min_delay: float = 1.0, window: int = 200):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.window = window
+        self._latencies: Dict[str, Deque[float]] = {}
+
+    def _record(self, priority: str, seconds: float) -> None:
+        self._latencies.setdefault(priority, deque(maxlen=self.window)).append(seconds)
+
+    def p95(self, priority: str) -> Optional[float]:
+        samples = sorted(self._latencies.get(priority, ()))
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+    def hedge_delay(self, priority: str) -> Optional[float]:
+        """Seconds to wait before hedging a call of `priority`, or None to not hedge it."""
+        if not self.hedge or priority == "background":
+            return None
+        p95 = self.p95(priority)
+        if p95 is None:
+            return None
+        delay = max(p95, self.hedge_min_delay)
+        remaining = deadline_remaining()
+        return delay if remaining is None or remaining > delay else None
+
+    async def bounded(self, awaitable: Awaitable[T]) -> T:
+        """Awaits `awaitable` within the remaining request deadline."""
+        remaining = deadline_remaining()
+        if remaining is None:
+            return await awaitable
+        if remaining <= 0:
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            metrics.increment("llm_policy.deadline_exceeded")
+            raise DeadlineExceeded("Request deadline exceeded before the LLM call")
+        try:
+            return await asyncio.wait_for(awaitable, remaining)
+        except asyncio.TimeoutError:
+            if deadline_remaining() <= 0:
+                metrics.increment("llm_policy.deadline_exceeded")
+                raise DeadlineExceeded("Request deadline exceeded during the LLM call") from None
+            raise
+
+    async def backoff(self, exc: Exception, attempt: int) -> None:
+        """Sleeps before retry number `attempt + 1`, or re-raises `exc` when no retry is allowed."""
+        if attempt >= self.max_retries or not is_transient(exc):
+            if attempt:
+                metrics.increment("llm_policy.gave_up")
+            raise exc
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        remaining = deadline_remaining()
+        if remaining is not None and delay >= remaining:
+            metrics.increment("llm_policy.gave_up")
+            raise exc
+        metrics.increment("llm_policy.retries")
+        logger.info(f"LLM call failed ({type(exc).__name__}: {exc}); retry {attempt + 1} in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+    async def _hedged(self, call: Callable[[], Awaitable[T]], delay: float) -> T:
+        primary = asyncio.ensure_future(call())
+        pending = {primary}
+        errors: List[BaseException] = []
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if not done:
+                metrics.increment("llm_policy.hedges")
+                current_span().set_attribute("llm.hedged", True)
+                pending.add(asyncio.ensure_future(call()))
+            while done or pending:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            metrics.increment("llm_policy.hedge_wins")
+                        return task.result()
+                    errors.append(task.exception())
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Ưu tiên lỗi của lời gọi chính (lời gọi dự phòng có thể chỉ bị limiter từ chối)
+            raise primary.exception() if primary.done() and primary.exception() else errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def run(self, call: Callable[[], Awaitable[T]]) -> T:
+        """Runs `call` (a fresh LLM request per invocation) under the retry, hedging and deadline policy."""
+        priority = current_priority()
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            delay = self.hedge_delay(priority)
+            try:
+                result = await self.bounded(call() if delay is None else self._hedged(call, delay))
+            except Exception as e:
+                await self.backoff(e, attempt)
+                attempt += 1
+                current_span().set_attribute("llm.retries", attempt)
+                continue
+            self._record(priority, time.monotonic() - started)
+            return result
+
+
+class PolicyLLM(LLM):
+    """
+    Wraps an LLM with a CallPolicy. Streams are retried only until their first token,
+    and are never hedged. Sync calls are passed through.
+    """
+
+    llm: BaseLLM
+    policy: Any
+    model: Optional[str] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return f"policy-{self.llm._llm_type}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model": self.model, "max_retries": self.policy.max_retries, "hedge": self.policy.hedge}
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None,
+              run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        return self.llm.invoke(prompt, stop=stop, **kwargs)
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        for text in self.llm.stream(prompt, stop=stop, **kwargs):
+            chunk = GenerationChunk(text=text)
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None,
+                     run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> str:
+        with tracer.span("llm.call", model=self.model or "", priority=current_priority(), prompt_chars=len(prompt)):
+            return await self.policy.run(lambda: self.llm.ainvoke(prompt, stop=stop, **kwargs))
+
+    async def _astream(self, prompt: str, stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> AsyncIterator[GenerationChunk]:
+        # Generator có thể được tiêu thụ qua nhiều task khác nhau: span không được đặt làm span hiện tại
+        span = tracer.start_span("llm.stream", model=self.model or "", priority=current_priority(), prompt_chars=len(prompt))
+        attempt = 0
+        try:
+            while True:
+                stream = self.llm.astream(prompt, stop=stop, **kwargs).__aiter__()
+                streamed = False
+                try:
+                    while True:
+                        try:
+                            text = await self.policy.bounded(stream.__anext__())
+                        except StopAsyncIteration:
+                            return
+                        if not streamed:
+                            span.set_attribute("llm.first_token_ms", round(span.duration_ms, 1))
+                        streamed = True
+                        chunk = GenerationChunk(text=text)
+                        if run_manager:
+                            await run_manager.on_llm_new_token(text, chunk=chunk)
+                        yield chunk
+                except Exception as e:
+                    # Đã gửi token cho client thì không thể thử lại
+                    if streamed:
+                        raise
+                    await self.policy.backoff(e, attempt)
+                    attempt += 1
+                    span.set_attribute("llm.retries", attempt)
+                finally:
+                    await stream.aclose()
+        except Exception as e:
+            span.record_exception(e)
+            raise
+        finally:
+            span.end()
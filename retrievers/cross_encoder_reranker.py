@@ -0,0 +1,120 @@
+import logging
+import time
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from config import settings as config
+from utils.lru_cache import LRUCache
+from utils.metrics import metrics
+from utils.single_flight import make_key
+
+logger = logging.getLogger(__name__)
+
+# Hệ số làm mượt cho ước lượng độ trễ mỗi cặp (query, chunk)
+LATENCY_EWMA_ALPHA = 0.2
+
+
+class CrossEncoderReranker:
+    """
+    Rescores (query, chunk) pairs with a local cross-encoder on CPU.
+
+    Scores are cached per (query hash, chunk id). Before scoring, the cost of
+    the uncached pairs is estimated from an EWMA of the per-pair latency; when
+    it would exceed `budget_ms` the call returns None and the caller keeps its
+    bi-encoder scores.
+    """
+
+    def __init__(self, model_name: str, backend: str = "auto", top_n: int = 8,
+                 budget_ms: float = 150.0, cache_size: int = 4096, batch_size: int = 16):
+        self.model_name = model_name
+        self.top_n = top_n
+        self.budget_ms = budget_ms
+        self.batch_size = batch_size
+        self.cache = LRUCache("cross_encoder", max_size=cache_size)
+        self.ms_per_pair: Optional[float] = None
+        self.model = self._load(model_name, backend)
+        if self.model is not None:
+            # Chạy thử một lần để khởi tạo ước lượng độ trễ (lần đầu luôn chậm hơn)
+            self._predict([("warm up", "warm up")])
+
+    @property
+    def available(self) -> bool:
+        return self.model is not None
+
+    def _load(self, model_name: str, backend: str):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError:
+            logger.warning("CrossEncoderReranker: sentence_transformers.CrossEncoder unavailable; reranking disabled.")
+            return None
+
+        if backend in ("auto", "onnx"):
+            try:
+                model = CrossEncoder(model_name, device="cpu", backend="onnx")
+                logger.info(f"CrossEncoderReranker: loaded {model_name} with ONNX Runtime")
+                return model
+            except Exception as e:  # Bản sentence-transformers cũ hoặc thiếu onnxruntime
+                if backend == "onnx":
+                    logger.warning(f"CrossEncoderReranker: ONNX backend failed ({e}); falling back to PyTorch.")
+        try:
+            model = CrossEncoder(model_name, device="cpu")
+        except Exception as e:
+            logger.error(f"CrossEncoderReranker: could not load {model_name}: {e}")
+            return None
+        try:
+            import torch
+            # Lượng tử hóa động int8 cho các lớp Linear, nhanh hơn đáng kể trên CPU
+            model.model = torch.quantization.quantize_dynamic(model.model, {torch.nn.Linear}, dtype=torch.qint8)
+            logger.info(f"CrossEncoderReranker: loaded {model_name} with int8 dynamic quantization")
+        except Exception as e:
+            logger.info(f"CrossEncoderReranker: loaded {model_name} without quantization ({e})")
+        return model
+
+    def _predict(self, pairs: List[Tuple[str, str]]) -> np.ndarray:
+        started = time.perf_counter()
+        scores = np.asarray(self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False), dtype=np.float32)
+        per_pair = (time.perf_counter() - started) * 1000 / max(len(pairs), 1)
+        self.ms_per_pair = per_pair if self.ms_per_pair is None else (
+            LATENCY_EWMA_ALPHA * per_pair + (1 - LATENCY_EWMA_ALPHA) * self.ms_per_pair)
+        metrics.set_gauge("reranker.ms_per_pair", round(self.ms_per_pair, 3))
+        return scores
+
+    def score(self, query: str, candidates: Sequence[Tuple[object, str]],
+              budget_ms: Optional[float] = None) -> Optional[List[float]]:
+        """
+        Cross-encoder scores (sigmoid, 0..1) for (chunk_id, text) candidates,
+        or None when the model is unavailable or the budget would be exceeded.
+        """
+        if not self.available or not candidates:
+            return None
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        query_hash = make_key(query)
+        scores: List[Optional[float]] = [self.cache.get((query_hash, chunk_id)) for chunk_id, _ in candidates]
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        if missing:
+            estimated_ms = len(missing) * (self.ms_per_pair or 0.0)
+            if estimated_ms > budget_ms:
+                metrics.increment("reranker.budget_skips")
+                return None
+            logits = self._predict([(query, candidates[i][1]) for i in missing])
+            for i, logit in zip(missing, logits):
+                scores[i] = float(1.0 / (1.0 + np.exp(-logit)))
+                self.cache.put((query_hash, candidates[i][0]), scores[i])
+        metrics.increment("reranker.calls")
+        return scores
+
+
+def create_reranker() -> Optional[CrossEncoderReranker]:
+    """Builds the reranker from settings; None when CROSS_ENCODER_MODEL is not set or fails to load."""
+    if not config.CROSS_ENCODER_MODEL:
+        return None
+    reranker = CrossEncoderReranker(
+        config.CROSS_ENCODER_MODEL,
+        backend=config.CROSS_ENCODER_BACKEND,
+        top_n=config.CROSS_ENCODER_TOP_N,
+        budget_ms=config.CROSS_ENCODER_BUDGET_MS,
+        cache_size=config.CROSS_ENCODER_CACHE_SIZE,
+    )
+    return reranker if reranker.available else None
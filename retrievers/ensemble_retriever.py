@@ -1,19 +1,42 @@
+import os
 import re
+import copy
 import json
+import time
+import logging
 import asyncio
+import threading
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Dict, Optional, Any
-from pymilvus import Collection, connections, utility
-from sentence_transformers import SentenceTransformer, util
+from typing import List, Dict, Optional, Any, Tuple
+from sentence_transformers import SentenceTransformer
 from rank_bm25 import BM25Okapi
+from utils.single_flight import SingleFlight, make_key
+from utils.metrics import metrics
+from utils.lru_cache import LRUCache
+from utils.tracing import tracer
+from config import settings as config
+from vectorstores import VectorStore, VectorStoreUnavailable, create_vector_store
+from vectorstores.base import matches_filters, record_value, parse_metadata
+from retrievers.cross_encoder_reranker import CrossEncoderReranker, create_reranker
+from retrievers.mmr import mmr_select
+
+logger = logging.getLogger(__name__)
+
+# Hậu tố ngẫu nhiên mà /upload thêm vào tên file lưu trữ: "bai_giang_1a2b3c4d.pptx"
+_UPLOAD_SUFFIX_RE = re.compile(r"_[0-9a-f]{8}(?=\.[^.]+$|$)")
+
+# Các trường metadata có posting list trong chỉ mục BM25
+BM25_FILTER_FIELDS = ("source", "doc_type", "slide_number", "owner")
 
 class EnsembleRetriever:
-    """Retrieves documents using vector search (Milvus) and BM25  search."""
+    """Retrieves documents using vector search (pluggable vector store) and BM25  search."""
     
     def __init__(self, collection_name: str, model_name: str = "all-MiniLM-L6-v2",
                  host: str = "localhost", port: str = "19530", vector_weight: float = 0.7,
                  bm25_weight: float = 0.3, top_k: int = 4, max_docs_bm25: int = 10000, 
-                 batch_size_load: int = 1000):
+                 batch_size_load: int = 1000, vector_store: Optional[VectorStore] = None,
+                 reranker: Optional[CrossEncoderReranker] = None, mmr_lambda: float = config.MMR_LAMBDA):
  
         self.collection_name = collection_name
         self.host = host
@@ -21,54 +44,124 @@ class EnsembleRetriever:
         self.vector_weight = vector_weight
         self.bm25_weight = bm25_weight
         self.top_k = top_k
+        self.mmr_lambda = mmr_lambda
         self.max_docs_bm25 = max_docs_bm25
         self.batch_size_load = batch_size_load
-        self.collection = None
+        self.vector_store = vector_store
+        self._owns_vector_store = vector_store is None
         self.bm25 = None
         self.bm25_docs = []
+        # field -> giá trị -> mảng chỉ số tài liệu (đã sắp xếp) trong bm25_docs
+        self.bm25_postings: Dict[str, Dict[str, np.ndarray]] = {}
+        # Tăng mỗi khi chỉ mục được nạp lại, dùng làm một phần khóa cho các cache/coalescing
+        self.index_version = 0
+        # False khi vector store chưa sẵn sàng lúc khởi động; BM25 sẽ được nạp lại ở lần search sau
+        self._bm25_loaded = False
+        # True từ khi có tài liệu mới được index cho tới khi BM25/posting list được nạp lại
+        self._postings_stale = False
+        self._bm25_lock = threading.Lock()
+        self._search_flight = SingleFlight("retriever_search")
+        # Executor dùng chung: nhánh quá hạn tiếp tục chạy nền thay vì chặn lại khi thoát khối with
+        self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retriever")
+        self._rerank_ms: Optional[float] = None
+        # Truy vấn được encode một lần cho cả vector search lẫn rerank; chunk id là hash nội dung nên cache an toàn
+        self._query_embeddings = LRUCache("query_embeddings", max_size=1024)
+        self._chunk_embeddings = LRUCache("chunk_embeddings", max_size=8192)
 
         # Load SentenceTransformer model
         self.model = SentenceTransformer(model_name)
+        # Cross-encoder tùy chọn cho top-N ứng viên (None nếu CROSS_ENCODER_MODEL không được cấu hình)
+        self.reranker = reranker if reranker is not None else create_reranker()
 
-        # Connect to Milvus and initialize BM25
+        # Connect to the vector store and initialize BM25
         self._setup()
 
     def _setup(self):
-        """Simplified setup for Milvus and BM25."""
-        connections.connect(host=self.host, port=self.port)
-        if utility.has_collection(self.collection_name):
-            self.collection = Collection(self.collection_name)
-            self.collection.load()
-            self._initialize_bm25()
+        """Simplified setup for the vector store and BM25."""
+        if self.vector_store is None:
+            self.vector_store = create_vector_store(self.collection_name, host=self.host, port=self.port,
+                                                    alias=f"{config.MILVUS_CONNECTION_ALIAS}_retriever")
+        self._try_initialize_bm25()
+
+    def _try_initialize_bm25(self):
+        """Loads BM25 if the store is reachable; a down store only degrades retrieval."""
+        with self._bm25_lock:
+            if self._bm25_loaded or not self.vector_store.is_ready:
+                return
+            try:
+                self._initialize_bm25()
+                self._bm25_loaded = True
+            except VectorStoreUnavailable as e:
+                metrics.increment("retriever.bm25_load_failures")
+                logger.warning(f"Could not load BM25 corpus, vector store unavailable: {e}")
 
     def _initialize_bm25(self):
         """Loads documents and initializes BM25 index."""
-        if not self.collection:
+        if not self.vector_store or not self.vector_store.is_ready:
             return
         
-        expr = "id >= 0"
         offset = 0
         fetched_docs = []
         
         while len(fetched_docs) < self.max_docs_bm25:
-            results = self.collection.query(
-                expr=expr, output_fields=["id", "text", "metadata"],
-                limit=self.batch_size_load, offset=offset
-            )
+            results = self.vector_store.query(limit=self.batch_size_load, offset=offset)
             if not results:
                 break
             fetched_docs.extend(
-                {"id": item["id"], "text": item["text"], "metadata": item.get("metadata", "{}")}
+                {"id": item["id"], "text": item["text"], "metadata": item.get("metadata", "{}"),
+                 "owner": record_value(item, "owner")}
                 for item in results if isinstance(item["text"], str)
             )
             offset += len(results)
         
         if fetched_docs:
-            self.bm25_docs = fetched_docs[:self.max_docs_bm25]
-            tokenized_corpus = [self._preprocess_text(doc["text"]) for doc in self.bm25_docs]
-            valid_corpus = [tokens for tokens in tokenized_corpus if tokens]
-            if valid_corpus:
-                self.bm25 = BM25Okapi(valid_corpus)
+            # Giữ bm25_docs thẳng hàng với corpus: bỏ các tài liệu không có token nào
+            docs_with_tokens = [(doc, self._preprocess_text(doc["text"])) for doc in fetched_docs[:self.max_docs_bm25]]
+            docs_with_tokens = [(doc, tokens) for doc, tokens in docs_with_tokens if tokens]
+            docs = [doc for doc, _ in docs_with_tokens]
+            bm25 = BM25Okapi([tokens for _, tokens in docs_with_tokens]) if docs_with_tokens else None
+            # Dựng xong mới thay, để search đang chạy không thấy chỉ mục dựng dở khi nạp lại
+            postings = self._build_bm25_postings(docs)
+            self.bm25_docs, self.bm25, self.bm25_postings = docs, bm25, postings
+        self.index_version += 1
+
+    def refresh_index(self) -> None:
+        """
+        Reloads the BM25 corpus and positional posting lists after documents were indexed
+        (bumping index_version, so coalesced/cached searches over the old corpus stop matching).
+        Until the reload succeeds, positional lookups go to the vector store.
+        """
+        self._postings_stale = True
+        with self._bm25_lock:
+            try:
+                self._initialize_bm25()
+                self._bm25_loaded = True
+                self._postings_stale = False
+            except VectorStoreUnavailable as e:
+                metrics.increment("retriever.bm25_load_failures")
+                logger.warning(f"Could not reload BM25 corpus after indexing, vector store unavailable: {e}")
+
+    @staticmethod
+    def _build_bm25_postings(docs: List[Dict[str, Any]]) -> Dict[str, Dict[str, np.ndarray]]:
+        """Builds per-field posting lists so filtered BM25 only scores matching documents."""
+        postings: Dict[str, Dict[str, List[int]]] = {field: {} for field in BM25_FILTER_FIELDS}
+        for i, doc in enumerate(docs):
+            metadata = parse_metadata(doc["metadata"])
+            doc["metadata_dict"] = metadata
+            values = {field: metadata.get(field) for field in BM25_FILTER_FIELDS}
+            values["owner"] = doc["owner"]
+            for field, value in values.items():
+                if value is not None:
+                    postings[field].setdefault(EnsembleRetriever._posting_key(value), []).append(i)
+        return {
+            field: {value: np.asarray(indices, dtype=np.int64) for value, indices in by_value.items()}
+            for field, by_value in postings.items()
+        }
+
+    @staticmethod
+    def _posting_key(value: Any) -> str:
+        # "5" và 5 phải khớp cùng một posting list
+        return str(value)
 
     def _preprocess_text(self, text: str) -> List[str]:
         """Preprocesses text for BM25."""
@@ -77,122 +170,368 @@ class EnsembleRetriever:
         tokens = re.findall(r'\b\w+\b', text.lower())
         return [token for token in tokens if token.isalnum()]
 
-    async def search(self, query: str, top_k: Optional[int] = None, filter_metadata: Optional[Dict] = None) -> List[Dict[str, Any]]:
-        """Performs ensemble search asynchronously."""
+    async def search(self, query: str, top_k: Optional[int] = None, filter_metadata: Optional[Dict] = None,
+                     partition_keys: Optional[List[str]] = None, timeout: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Performs ensemble search asynchronously, sharing identical in-flight searches.
+        When partition_keys is given, only chunks owned by those partitions are searched.
+        """
+        results, _ = await self.search_with_report(query, top_k, filter_metadata, partition_keys, timeout)
+        return results
+
+    async def search_with_report(self, query: str, top_k: Optional[int] = None, filter_metadata: Optional[Dict] = None,
+                                 partition_keys: Optional[List[str]] = None,
+                                 timeout: Optional[float] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Like `search`, but degrades instead of failing when `timeout` (seconds) runs short:
+        reranking is skipped and whichever of vector/BM25 finished is used. Returns the
+        results and a report of the completed and skipped stages.
+        """
         if not query or not isinstance(query, str):
-            return []
+            return [], {"completed": [], "skipped": {}, "degraded": False, "elapsed_ms": 0.0}
 
         effective_top_k = top_k or self.top_k
-        loop = asyncio.get_running_loop()
-        
-        with ThreadPoolExecutor() as executor:
-            vector_task = None
-            if self.collection:
-                vector_task = loop.run_in_executor(executor, self._vector_search_sync, query, effective_top_k, filter_metadata)
-            
-            bm25_task = None
-            if self.bm25:
-                bm25_task = loop.run_in_executor(executor, self._bm25_search_sync, query, effective_top_k)
-
-            results = await asyncio.gather(
-                vector_task if vector_task else asyncio.sleep(0, result=[]),
-                bm25_task if bm25_task else asyncio.sleep(0, result=[])
+        if partition_keys is not None:
+            partition_keys = sorted(set(partition_keys))
+        deadline = time.monotonic() + timeout if timeout else None
+        # Thời hạn làm tròn theo giây là một phần của khóa: caller không thời hạn không nhận kết quả bị cắt bớt
+        key = make_key(query, effective_top_k, filter_metadata, partition_keys, self.index_version,
+                       round(timeout) if timeout else None)
+        with tracer.span("retriever.search", queries=1, top_k=effective_top_k) as span:
+            [(results, report)] = await self._search_flight.do(
+                key, lambda: self._search_batch_uncoalesced([query], effective_top_k, filter_metadata, partition_keys, deadline)
             )
+            span.set_attribute("degraded", report.get("degraded", False))
+        # Mỗi caller nhận bản sao riêng để không làm hỏng kết quả dùng chung
+        return [dict(result) for result in results], copy.deepcopy(report)
 
-        vector_results = results[0]
-        bm25_results = results[1]
-        
-        if not vector_results and not bm25_results:
+    async def search_many(self, queries: List[str], top_k: Optional[int] = None, filter_metadata: Optional[Dict] = None,
+                          partition_keys: Optional[List[str]] = None,
+                          timeout: Optional[float] = None) -> List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """
+        Searches several queries in one batch: the queries are embedded together, sent to the
+        vector store as a single multi-vector search and scored by BM25 in one pass.
+        Returns (results, report) per query, in the order given.
+        """
+        queries = [query for query in queries if query and isinstance(query, str)]
+        if not queries:
+            return []
+        effective_top_k = top_k or self.top_k
+        if partition_keys is not None:
+            partition_keys = sorted(set(partition_keys))
+        deadline = time.monotonic() + timeout if timeout else None
+        key = make_key("many", queries, effective_top_k, filter_metadata, partition_keys, self.index_version,
+                       round(timeout) if timeout else None)
+        with tracer.span("retriever.search", queries=len(queries), top_k=effective_top_k):
+            batch = await self._search_flight.do(
+                key, lambda: self._search_batch_uncoalesced(queries, effective_top_k, filter_metadata, partition_keys, deadline)
+            )
+        return [([dict(result) for result in results], copy.deepcopy(report)) for results, report in batch]
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Normalized query embeddings, encoded in one batch and cached across searches."""
+        embeddings = {query: self._query_embeddings.get(query) for query in dict.fromkeys(queries)}
+        missing = [query for query, embedding in embeddings.items() if embedding is None]
+        if missing:
+            with tracer.span("retriever.embed", texts=len(missing)):
+                vectors = self.model.encode(missing, batch_size=32, normalize_embeddings=True)
+            for query, vector in zip(missing, vectors):
+                embeddings[query] = np.asarray(vector, dtype=np.float32)
+                self._query_embeddings.put(query, embeddings[query])
+        return np.stack([embeddings[query] for query in queries])
+
+    def _encode_chunks(self, results: List[Dict[str, Any]]) -> np.ndarray:
+        """Normalized chunk embeddings for rerank/MMR, cached by chunk id (ids are content hashes)."""
+        embeddings = [self._chunk_embeddings.get(result["id"]) for result in results]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            with tracer.span("retriever.embed", texts=len(missing)):
+                vectors = self.model.encode([results[i]["text"] for i in missing], batch_size=32, normalize_embeddings=True)
+            for i, vector in zip(missing, vectors):
+                embeddings[i] = np.asarray(vector, dtype=np.float32)
+                self._chunk_embeddings.put(results[i]["id"], embeddings[i])
+        return np.stack(embeddings)
+
+    @tracer.traced("retriever.positional_lookup")
+    async def lookup_by_position(self, slide_numbers: List[int], source: Optional[str] = None,
+                                 partition_keys: Optional[List[str]] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Direct scalar lookup of the chunks on the given slides/pages, in document order.
+        Uses the in-memory posting lists first and the vector store's scalar query as a fallback;
+        `source` matches file names case-insensitively, with or without the extension.
+        """
+        if not slide_numbers:
             return []
+        loop = asyncio.get_running_loop()
+        if not self._bm25_loaded:
+            await loop.run_in_executor(self._executor, self._try_initialize_bm25)
 
-        combined_results = self._combine_results(vector_results, bm25_results)
-        return self._rerank_results(query, combined_results)[:effective_top_k]
+        # Posting list chưa có tài liệu vừa index thì tra thẳng vector store
+        records = [] if self._postings_stale else self._lookup_in_postings(slide_numbers, source, partition_keys)
+        if not records and self.vector_store and self.vector_store.is_ready:
+            filters: Dict[str, Any] = {"slide_number": list(slide_numbers)}
+            if partition_keys is not None:
+                filters["owner"] = list(partition_keys)
+            try:
+                found = await loop.run_in_executor(self._executor, lambda: self.vector_store.query(filters, limit=limit * 4))
+                records = [record for record in found if self._source_matches(parse_metadata(record.get("metadata")), source)]
+            except VectorStoreUnavailable as e:
+                logger.warning(f"Positional lookup unavailable: {e}")
+                # Store lỗi: posting list cũ (nếu đang bị bỏ qua) còn hơn không có gì
+                records = self._lookup_in_postings(slide_numbers, source, partition_keys) if self._postings_stale else []
 
-    def _vector_search_sync(self, query: str, top_k: int, filter_metadata: Optional[Dict] = None) -> List[Dict[str, Any]]:
+        metrics.increment("retriever.positional_lookups")
+        if not records:
+            metrics.increment("retriever.positional_misses")
+            return []
+        records.sort(key=lambda record: self._document_position(parse_metadata(record.get("metadata"))))
+        return [self._format_result({**record, "sources": ["position"]}, 1.0) for record in records[:limit]]
 
-        if not self.collection or not isinstance(self.collection, Collection):
-            print("Warning: Milvus collection not available for vector search.") # Added warning
+    def _lookup_in_postings(self, slide_numbers: List[int], source: Optional[str],
+                            partition_keys: Optional[List[str]]) -> List[Dict[str, Any]]:
+        by_slide = self.bm25_postings.get("slide_number", {})
+        lists = [by_slide[self._posting_key(n)] for n in slide_numbers if self._posting_key(n) in by_slide]
+        if not lists:
             return []
+        indices = np.unique(np.concatenate(lists))
+        if partition_keys is not None:
+            indices = np.intersect1d(indices, self._bm25_candidates(None, partition_keys), assume_unique=True)
+        return [
+            {"id": doc["id"], "text": doc["text"], "metadata": doc["metadata"]}
+            for doc in (self.bm25_docs[i] for i in indices)
+            if self._source_matches(doc["metadata_dict"], source)
+        ]
+
+    @staticmethod
+    def _source_matches(metadata: Dict[str, Any], wanted: Optional[str]) -> bool:
+        """
+        Whether the chunk belongs to the document the user named: the stored source, the
+        uploaded file's original name, or the stored name without the random upload suffix.
+        """
+        if not wanted:
+            return True
+        wanted = wanted.lower()
+        wanted_stem = os.path.splitext(wanted)[0]
+        source = str(metadata.get("source") or "").lower()
+        names = {source, str(metadata.get("original_filename") or "").lower(), _UPLOAD_SUFFIX_RE.sub("", source)}
+        return any(name and (name == wanted or os.path.splitext(name)[0] == wanted_stem) for name in names)
+
+    @staticmethod
+    def _document_position(metadata: Dict[str, Any]) -> Tuple[str, int, int]:
+        slide_number = metadata.get("slide_number")
+        return (str(metadata.get("source", "")),
+                int(slide_number) if str(slide_number).isdigit() else 0,
+                int(metadata.get("start_index", 0) or 0))
+
+    async def _search_batch_uncoalesced(self, queries: List[str], effective_top_k: int, filter_metadata: Optional[Dict],
+                                        partition_keys: Optional[List[str]],
+                                        deadline: Optional[float] = None) -> List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        # Trạng thái các nhánh vector/BM25 là chung cho cả lô; mỗi truy vấn có báo cáo riêng từ đây
+        branch_report: Dict[str, Any] = {"completed": [], "skipped": {}}
+
+        def remaining() -> Optional[float]:
+            return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+        # MMR cần một tập ứng viên rộng hơn top_k để có lựa chọn thay thế cho các đoạn trùng lặp
+        candidate_k = effective_top_k * 2 if self.mmr_lambda < 1.0 else effective_top_k
+        if not self._bm25_loaded:
+            await loop.run_in_executor(self._executor, tracer.in_context("retriever.bm25_load", self._try_initialize_bm25))
 
-        # Generate query embedding
-        query_embedding = self.model.encode(query, normalize_embeddings=True)
-        search_params = {"metric_type": "L2", "params": {"nprobe": 10}}
-
-
-        expr = "id >= 0"
-        if filter_metadata is not None and filter_metadata:  # Check for non-empty dict
-            expr_parts = [expr]
-            for key, value in filter_metadata.items():
-                
-                safe_value = json.dumps(value) 
-                expr_parts.append(f"metadata['{key}'] == {safe_value}")
-                # Or using json_contains if value is complex or you need partial match:
-                # expr_parts.append(f"json_contains(metadata, '{{\"{key}\": {safe_value}}}')")
-            expr = " and ".join(expr_parts)
-            print(f"Using filter expression: {expr}") # Debugging print
-
-        # Perform vector search
-        try: # Add try-except for robustness
-            results = self.collection.search(
-                data=[query_embedding.tolist()],  # Convert numpy array to list
-                anns_field="embedding",          # Field storing embeddings in Milvus
-                param=search_params,             # Search parameters
-                limit=top_k,                     # Limit to top_k results
-                expr=expr,                       # Filter expression
-                output_fields=["id", "text", "metadata"]  # Fields to return
+        tasks: Dict[str, asyncio.Future] = {}
+        if self.vector_store and self.vector_store.is_ready:
+            tasks["vector"] = loop.run_in_executor(
+                self._executor, tracer.in_context("retriever.vector", self._vector_search_sync, queries=len(queries)),
+                queries, candidate_k, filter_metadata, partition_keys
             )
+        else:
+            branch_report["skipped"]["vector"] = "unavailable"
+        if self.bm25:
+            tasks["bm25"] = loop.run_in_executor(
+                self._executor, tracer.in_context(
+                    "retriever.bm25",
+                    lambda: [self._bm25_search_sync(query, candidate_k, filter_metadata, partition_keys) for query in queries],
+                    queries=len(queries)
+                )
+            )
+
+        stage_results: Dict[str, List[List[Dict[str, Any]]]] = {}
+        if tasks:
+            done, pending = await asyncio.wait(tasks.values(), timeout=remaining())
+            if not done:
+                # Hết thời hạn mà chưa nhánh nào xong: lấy nhánh xong đầu tiên thay vì thất bại
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for stage, task in tasks.items():
+                if task in pending:
+                    # Luồng trong executor không hủy được; kết quả muộn bị bỏ qua
+                    task.add_done_callback(lambda t: t.exception())
+                    branch_report["skipped"][stage] = "deadline"
+                    continue
+                error = task.exception()
+                if isinstance(error, VectorStoreUnavailable):
+                    # Chế độ suy giảm: chỉ dùng BM25 và ghi nhận vào metrics thay vì trả về rỗng im lặng
+                    logger.warning(f"Vector search unavailable, using BM25 only: {error}")
+                    branch_report["skipped"][stage] = "unavailable"
+                elif error is not None:
+                    raise error
+                else:
+                    stage_results[stage] = task.result()
+                    branch_report["completed"].append(stage)
+
+        empty = [[] for _ in queries]
+        per_query = list(zip(stage_results.get("vector", empty), stage_results.get("bm25", empty)))
+        if (not any(vector or bm25 for vector, bm25 in per_query)
+                and branch_report["skipped"].get("vector") == "unavailable" and "vector" in tasks):
+            raise VectorStoreUnavailable("Vector search failed and BM25 returned no results")
+
+        return await asyncio.gather(*(
+            self._finish_query(query, vector_results, bm25_results, effective_top_k,
+                               copy.deepcopy(branch_report), remaining, started)
+            for query, (vector_results, bm25_results) in zip(queries, per_query)
+        ))
+
+    async def _finish_query(self, query: str, vector_results: List[Dict[str, Any]], bm25_results: List[Dict[str, Any]],
+                            effective_top_k: int, report: Dict[str, Any], remaining,
+                            started: float) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Fuses and reranks one query's branch results, skipping rerank when the deadline is close."""
+
+        def finish(results: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+            report["degraded"] = bool(report["skipped"])
+            report["elapsed_ms"] = round((time.monotonic() - started) * 1000, 1)
+            if report["degraded"]:
+                metrics.increment("retriever.degraded_searches")
+            return results, report
+
+        if not vector_results and not bm25_results:
+            return finish([])
+
+        combined_results = self._combine_results(vector_results, bm25_results, effective_top_k * 2)
+        time_left = remaining()
+        if time_left is not None and self._rerank_ms is not None and time_left * 1000 < self._rerank_ms:
+            report["skipped"]["rerank"] = "deadline"
+            return finish([self._format_result(result, result["score"]) for result in combined_results[:effective_top_k]])
+
+        # Rerank tốn CPU (encode + cross-encoder), không chạy trên event loop
+        budget_ms = None if time_left is None else time_left * 1000 - (self._rerank_ms or 0.0)
+        reranked = await asyncio.get_running_loop().run_in_executor(
+            self._executor, tracer.in_context("retriever.rerank", self._rerank_results, candidates=len(combined_results)), query, combined_results, effective_top_k, budget_ms, report
+        )
+        return finish(reranked[:effective_top_k])
+
+    def _vector_search_sync(self, queries: List[str], top_k: int, filter_metadata: Optional[Dict] = None,
+                            partition_keys: Optional[List[str]] = None) -> List[List[Dict[str, Any]]]:
+        """Vector search for a batch of queries in a single vector store call."""
+        if not self.vector_store or not self.vector_store.is_ready:
+            metrics.increment("retriever.vector_skipped")
+            logger.warning("Vector store not available for vector search")
+            return [[] for _ in queries]
+
+        # Generate query embeddings (one batch, cached)
+        query_embeddings = self.encode_queries(queries)
+
+        filters = dict(filter_metadata or {})
+        if partition_keys is not None:
+            # Lọc theo partition key để backend chỉ quét các phân vùng của người gọi
+            filters["owner"] = list(partition_keys)
+
+        # Perform vector search; VectorStoreUnavailable is handled by the caller (BM25-only fallback)
+        try:
+            batch_hits = self.vector_store.search_batch(query_embeddings.tolist(), top_k, filters=filters or None)
+        except VectorStoreUnavailable:
+            raise
         except Exception as e:
-            print(f"Error during Milvus search: {e}") # Log the error
-            return []
+            metrics.increment("retriever.vector_errors")
+            logger.error(f"Error during vector search: {e}")
+            return [[] for _ in queries]
 
+        if not any(batch_hits):
+            logger.debug("Vector search returned no hits (possibly due to filter)")
 
-        # Process search results
-        output = []
-        if results and len(results) > 0 and len(results[0]) > 0:
-            for hit in results[0]:
-                score = 1.0 / (1.0 + hit.distance) if hit.distance >= 0 else 1.0
-                # --- FIX ---
-                text_content = getattr(hit.entity, 'text', '') # Default to empty string if 'text' attribute missing
-                metadata_content = getattr(hit.entity, 'metadata', '{}') # Default to empty JSON string if 'metadata' attribute missing
-                # --- END OF FIX ---
-
-                output.append({
-                    "id": hit.id,
-                    "text": text_content,           # Use the retrieved text
-                    "score": score,                 # Similarity score
-                    "source": "vector",             # Source indicator
-                    "metadata": metadata_content    # Use the retrieved metadata
-                })
-        elif results and len(results) > 0 and len(results[0]) == 0:
-             print("Vector search returned results structure, but no hits found (possibly due to filter).") # More info
-        elif not results:
-             print("Vector search returned None or empty results.") # More info
-
-
-        return output
-
-    def _bm25_search_sync(self, query: str, top_k: int) -> List[Dict[str, Any]]:
-        """Synchronous BM25 search."""
+        return [
+            [
+                {
+                    "id": hit["id"],
+                    "text": hit.get("text", ""),
+                    "score": 1.0 / (1.0 + hit["distance"]) if hit["distance"] >= 0 else 1.0,  # Similarity score
+                    "source": "vector",
+                    "metadata": hit.get("metadata", "{}")
+                }
+                for hit in hits
+            ]
+            for hits in batch_hits
+        ]
+
+    def _bm25_search_sync(self, query: str, top_k: int, filter_metadata: Optional[Dict] = None,
+                          partition_keys: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Synchronous BM25 search; filters restrict scoring to the matching documents."""
         if not self.bm25 or not self.bm25_docs:
             return []
         
         tokenized_query = self._preprocess_text(query)
         if not tokenized_query:
             return []
-        
-        bm25_scores = self.bm25.get_scores(tokenized_query)
-        top_indices = sorted(
-            [i for i, score in enumerate(bm25_scores) if score > 0],
-            key=lambda i: bm25_scores[i], reverse=True
-        )[:top_k]
 
-        return [
-            {"id": self.bm25_docs[i]["id"], "text": self.bm25_docs[i]["text"], 
-             "score": bm25_scores[i], "source": "bm25", "metadata": self.bm25_docs[i]["metadata"]}
-            for i in top_indices if i < len(self.bm25_docs)
-        ]
+        candidates = self._bm25_candidates(filter_metadata, partition_keys)
+        if candidates is None:
+            doc_indices = np.arange(len(self.bm25_docs))
+            bm25_scores = np.asarray(self.bm25.get_scores(tokenized_query))
+        elif len(candidates) == 0:
+            return []
+        else:
+            doc_indices = candidates
+            bm25_scores = np.asarray(self.bm25.get_batch_scores(tokenized_query, candidates.tolist()))
+
+        positive = np.nonzero(bm25_scores > 0)[0]
+        top_positions = positive[np.argsort(-bm25_scores[positive], kind="stable")][:top_k]
 
-    def _combine_results(self, vector_results: List[Dict[str, Any]], bm25_results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = []
+        for pos in top_positions:
+            doc = self.bm25_docs[doc_indices[pos]]
+            results.append({"id": doc["id"], "text": doc["text"], "score": float(bm25_scores[pos]),
+                            "source": "bm25", "metadata": doc["metadata"]})
+        return results
+
+    def _bm25_candidates(self, filter_metadata: Optional[Dict] = None,
+                         partition_keys: Optional[List[str]] = None) -> Optional[np.ndarray]:
+        """
+        Intersects posting lists for the requested filters.
+        Returns None when no filter applies (score the whole corpus).
+        """
+        candidates: Optional[np.ndarray] = None
+
+        def intersect(current: Optional[np.ndarray], indices: np.ndarray) -> np.ndarray:
+            return indices if current is None else np.intersect1d(current, indices, assume_unique=True)
+
+        def union(field: str, values: Any) -> np.ndarray:
+            # Giá trị dạng danh sách là phép IN: hợp các posting list, như matches_filters của vector store
+            postings = self.bm25_postings.get(field, {})
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            lists = [postings[self._posting_key(value)] for value in values if self._posting_key(value) in postings]
+            return np.unique(np.concatenate(lists)) if lists else np.empty(0, dtype=np.int64)
+
+        if partition_keys is not None:
+            candidates = intersect(candidates, union("owner", partition_keys))
+
+        unindexed = {}
+        for key, value in (filter_metadata or {}).items():
+            if key in self.bm25_postings:
+                candidates = intersect(candidates, union(key, value))
+            else:
+                unindexed[key] = value
+
+        if unindexed:
+            # Trường không có posting list: lọc tuần tự trên metadata (chậm hơn nhưng vẫn đúng), cùng ngữ nghĩa với vector store
+            pool = candidates if candidates is not None else np.arange(len(self.bm25_docs))
+            candidates = np.asarray(
+                [i for i in pool if matches_filters({**self.bm25_docs[i], "metadata": self.bm25_docs[i]["metadata_dict"]}, unindexed)],
+                dtype=np.int64
+            )
+        return candidates
+
+    def _combine_results(self, vector_results: List[Dict[str, Any]], bm25_results: List[Dict[str, Any]],
+                         limit: Optional[int] = None) -> List[Dict[str, Any]]:
         """Combines vector and BM25 results."""
         combined_dict: Dict[Any, Dict] = {}
         max_vec_score = max([r["score"] for r in vector_results] + [1e-9])
@@ -216,32 +555,84 @@ class EnsembleRetriever:
                 }
         combined_list = list(combined_dict.values())
         combined_list.sort(key=lambda x: x["score"], reverse=True)
-        return combined_list[:self.top_k * 2]
+        return combined_list[:limit or self.top_k * 2]
 
-    def _rerank_results(self, query: str, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """Reranks results using semantic similarity."""
+    def _format_result(self, result: Dict[str, Any], score: float) -> Dict[str, Any]:
+        metadata = result["metadata"] if isinstance(result["metadata"], dict) else json.loads(result["metadata"] or "{}")
+        return {
+            "id": result["id"], "text": result["text"], "score": score, "source": ", ".join(result["sources"]),
+            "metadata": result["metadata"], "title": metadata.get("title", "N/A"),
+            "slide_number": metadata.get("slide_number", None), "timestamp": metadata.get("timestamp", None)
+        }
+
+    def _rerank_results(self, query: str, results: List[Dict[str, Any]], top_k: Optional[int] = None,
+                        budget_ms: Optional[float] = None, report: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        Reranks results using semantic similarity, then the cross-encoder on the top-N if enabled,
+        and finally picks `top_k` diverse results with MMR. `budget_ms` caps the cross-encoder.
+        """
         if not results:
             return []
-        
-        texts = [result["text"] for result in results]
-        query_embedding = self.model.encode(query, normalize_embeddings=True)
-        text_embeddings = self.model.encode(texts, batch_size=32, normalize_embeddings=True)
-        similarities = util.cos_sim(query_embedding, text_embeddings)[0].cpu().tolist()
+        report = report if report is not None else {"completed": [], "skipped": {}}
+        started = time.perf_counter()
+
+        # Embedding truy vấn đã có từ vector search, embedding chunk được cache theo id
+        query_embedding = self.encode_queries([query])[0]
+        text_embeddings = self._encode_chunks(results)
+        similarities = (text_embeddings @ query_embedding).tolist()
 
         processed_results = []
         for i, result in enumerate(results):
-            final_score = 0.6 * similarities[i] + 0.4 * result["score"]
-            metadata = result["metadata"] if isinstance(result["metadata"], dict) else json.loads(result["metadata"] or "{}")
-            processed_results.append({
-                "text": result["text"], "score": final_score, "source": ", ".join(result["sources"]),
-                "metadata": result["metadata"], "title": metadata.get("title", "N/A"),
-                "slide_number": metadata.get("slide_number", None), "timestamp": metadata.get("timestamp", None)
-            })
+            processed = self._format_result(result, 0.6 * similarities[i] + 0.4 * result["score"])
+            processed["_row"] = i
+            processed_results.append(processed)
         processed_results.sort(key=lambda x: x["score"], reverse=True)
+        # Ước lượng thời gian rerank (EWMA) để quyết định bỏ qua khi sắp hết thời hạn
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._rerank_ms = elapsed_ms if self._rerank_ms is None else 0.2 * elapsed_ms + 0.8 * self._rerank_ms
+        report["completed"].append("rerank")
+
+        if self.reranker:
+            reranked = self._cross_encoder_rerank(query, processed_results, budget_ms)
+            if reranked is None:
+                report["skipped"]["cross_encoder"] = "budget"
+            else:
+                processed_results = reranked
+                report["completed"].append("cross_encoder")
+
+        # Dùng lại embedding đã tính cho rerank, không encode thêm lần nào
+        rows = [result.pop("_row") for result in processed_results]
+        top_k = top_k or self.top_k
+        if self.mmr_lambda < 1.0 and len(processed_results) > top_k:
+            if "cross_encoder" in report["completed"]:
+                # Top-N mang điểm cross-encoder (sigmoid), phần còn lại mang điểm blend: hai thang đo khác nhau,
+                # nên MMR dùng độ liên quan theo thứ hạng để phần đuôi không vượt lên trên top-N đã chấm lại
+                relevance = np.linspace(1.0, 0.0, len(processed_results), dtype=np.float32)
+            else:
+                relevance = np.asarray([result["score"] for result in processed_results], dtype=np.float32)
+            selected = mmr_select(text_embeddings[rows], relevance, top_k, self.mmr_lambda)
+            processed_results = [processed_results[i] for i in selected]
+            report["completed"].append("mmr")
         return processed_results
 
+    def _cross_encoder_rerank(self, query: str, results: List[Dict[str, Any]],
+                              budget_ms: Optional[float] = None) -> Optional[List[Dict[str, Any]]]:
+        """Reorders the top-N results by cross-encoder score; None if it does not fit the budget."""
+        head, tail = results[:self.reranker.top_n], results[self.reranker.top_n:]
+        if budget_ms is not None:
+            budget_ms = min(budget_ms, self.reranker.budget_ms)
+        with tracer.span("retriever.cross_encoder", candidates=len(head)) as span:
+            scores = self.reranker.score(query, [(result["id"], result["text"]) for result in head], budget_ms=budget_ms)
+            span.set_attribute("skipped", scores is None)
+        if scores is None:
+            return None
+        for result, score in zip(head, scores):
+            result["score"] = score
+        head.sort(key=lambda x: x["score"], reverse=True)
+        # Phần còn lại không được chấm lại nên luôn đứng sau top-N
+        return head + tail
+
     def close(self):
- 
-        if self.collection:
-            self.collection.release()
-        connections.disconnect("default")
\ No newline at end of file
+        self._executor.shutdown(wait=False)
+        if self.vector_store and self._owns_vector_store:
+            self.vector_store.close()
\ No newline at end of file
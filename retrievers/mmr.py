@@ -0,0 +1,37 @@
+from typing import List
+
+import numpy as np
+
+
+def mmr_select(embeddings: np.ndarray, relevance: np.ndarray, k: int, lambda_mult: float = 0.7) -> List[int]:
+    """
+    Maximal marginal relevance over L2-normalized candidate embeddings.
+
+    Greedily picks the candidate maximizing
+    `lambda_mult * relevance - (1 - lambda_mult) * max_similarity_to_selected`
+    and returns the chosen row indices in selection order. The pairwise
+    similarity matrix is computed once; each step is a vector update.
+    """
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+    k = min(k, n)
+    relevance = np.asarray(relevance, dtype=np.float32)
+    # Đưa điểm liên quan về [0, 1] để cùng thang đo với cosine similarity
+    spread = float(relevance.max() - relevance.min())
+    relevance = (relevance - relevance.min()) / spread if spread > 0 else np.ones(n, dtype=np.float32)
+
+    similarity = embeddings @ embeddings.T
+    max_similarity = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected: List[int] = []
+
+    for _ in range(k):
+        redundancy = np.where(np.isfinite(max_similarity), max_similarity, 0.0)
+        mmr = lambda_mult * relevance - (1.0 - lambda_mult) * redundancy
+        mmr[~available] = -np.inf
+        choice = int(np.argmax(mmr))
+        selected.append(choice)
+        available[choice] = False
+        max_similarity = np.maximum(max_similarity, similarity[choice])
+    return selected
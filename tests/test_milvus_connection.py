@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+pytest.importorskip("pymilvus")
+
+from vectorstores import milvus_connection
+from vectorstores.milvus_connection import MilvusConnection
+
+
+class FakeConnections:
+    def __init__(self):
+        self.connects = 0
+
+    def connect(self, **kwargs):
+        self.connects += 1
+
+    def disconnect(self, alias):
+        pass
+
+
+class FakeUtility:
+    def __init__(self, failures):
+        # Số lần kiểm tra sức khỏe liên tiếp thất bại trước khi máy chủ trả lời lại
+        self.failures = failures
+
+    def get_server_version(self, using=None, timeout=None):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("server unreachable")
+        return "v2"
+
+
+@pytest.fixture
+def fakes(monkeypatch):
+    connections, utility = FakeConnections(), FakeUtility(failures=0)
+    monkeypatch.setattr(milvus_connection, "connections", connections)
+    monkeypatch.setattr(milvus_connection, "utility", utility)
+    return connections, utility
+
+
+def run_with_deadline(fn, seconds=5.0):
+    thread = threading.Thread(target=fn, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    return not thread.is_alive()
+
+
+def test_on_reconnect_callback_with_transient_error_does_not_deadlock(fakes):
+    connections, utility = fakes
+    connection = MilvusConnection("test", "localhost", "19530", max_retries=2, backoff_base=0.0, backoff_max=0.0)
+    attempts = []
+
+    def fail_once():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("connection reset during has_collection")
+        return True
+
+    def on_reconnect():
+        # Như MilvusVectorStore._open_existing: lời gọi có bảo vệ, lỗi tạm thời kích hoạt _recover lần nữa
+        utility.failures = 1
+        connection.call("has_collection", fail_once)
+
+    connection.start_health_probe(interval=0, on_reconnect=on_reconnect)
+    # Probe và lần kiểm tra trong _recover đều thất bại: probe kết nối lại và chạy callback
+    utility.failures = 2
+    assert run_with_deadline(connection.probe)
+    assert len(attempts) == 2
+    # Nếu lock vẫn bị giữ, lần khôi phục kế tiếp sẽ treo
+    assert run_with_deadline(lambda: connection.reconnect())
+    assert connection.healthy
+
+
+def test_on_reconnect_callback_error_does_not_break_reconnect(fakes):
+    connection = MilvusConnection("test", "localhost", "19530", max_retries=0, backoff_base=0.0)
+
+    def on_reconnect():
+        raise RuntimeError("collection missing")
+
+    connection.start_health_probe(interval=0, on_reconnect=on_reconnect)
+    assert connection.reconnect() is True
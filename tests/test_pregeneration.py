@@ -0,0 +1,112 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("langchain")
+
+from config import settings as config
+from core.pregeneration import Pregenerator, topic_aliases
+from tools.summary_generator import SummaryGeneratorTool
+from tools.tool_registry import ToolRegistry
+from utils import generation_cache
+from utils.generation_cache import GenerationCache
+
+
+def chunk(chunk_id, text, slide):
+    return {"id": chunk_id, "text": text, "metadata": json.dumps({"source": "ml.pdf", "slide_number": slide, "start_index": 0})}
+
+
+DOCUMENT = [
+    chunk(1, "Chương 1: Học máy cơ bản\nHọc máy là ...", 1),
+    chunk(2, "Chương 2: Hồi quy tuyến tính\nMô hình y = ax + b.", 2),
+    chunk(3, "Hàm mất mát bình phương của hồi quy tuyến tính.", 3),
+]
+OTHER_DOCUMENT = [{"id": 99, "text": "Hồi quy tuyến tính trong kinh tế lượng.", "metadata": json.dumps({"source": "kt.pdf"})}]
+
+
+class FakeLLM:
+    model = "test-model"
+
+    def __init__(self):
+        self.prompts = []
+
+    async def ainvoke(self, prompt):
+        self.prompts.append(prompt)
+        return f"summary #{len(self.prompts)}"
+
+
+class FakeStore:
+    def query(self, filters, limit):
+        return list(DOCUMENT)
+
+
+class FakeRetriever:
+    index_version = 1
+    vector_store = FakeStore()
+
+    def __init__(self):
+        self.results = DOCUMENT
+
+    async def search(self, query, top_k=None, partition_keys=None):
+        return list(self.results)
+
+
+class FakeAssistant:
+    def __init__(self):
+        self.llm = FakeLLM()
+        self.retriever = FakeRetriever()
+        self.tool_registry = ToolRegistry(self)
+        self.tool_registry.register_tool(SummaryGeneratorTool())
+
+
+@pytest.fixture
+def assistant(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "GENERATION_CACHE_ENABLED", True)
+    cache = GenerationCache(str(tmp_path / "generations.sqlite3"))
+    monkeypatch.setattr(generation_cache, "_cache", cache)
+    yield FakeAssistant()
+    cache.close()
+
+
+def test_topic_aliases():
+    assert topic_aliases("Chương 2: Hồi quy tuyến tính") == ["Chương 2: Hồi quy tuyến tính", "Hồi quy tuyến tính", "Chương 2"]
+    assert topic_aliases("Hồi quy tuyến tính") == ["Hồi quy tuyến tính"]
+
+
+def test_pregenerated_summary_is_served_to_user_request(assistant):
+    async def scenario():
+        report = await Pregenerator(assistant, tools=["Summary_Generator"]).pregenerate("ml.pdf", "course:ml")
+        assert "Chương 2: Hồi quy tuyến tính" in report["topics"]
+        generated = len(assistant.llm.prompts)
+
+        # Câu hỏi đầy đủ của học sinh, phân vùng riêng và tập chunk truy xuất khác với lúc sinh trước
+        assistant.retriever.results = DOCUMENT[1:]
+        answer = await assistant.tool_registry.execute_tool(
+            "Summary_Generator", question="Tóm tắt giúp em chương 2: Hồi quy tuyến tính",
+            partition_keys=[config.SHARED_PARTITION_KEY, "course:ml", "alice"]
+        )
+        assert len(assistant.llm.prompts) == generated
+        assert answer.startswith("summary #")
+
+        # Tên ngắn của chủ đề cũng khớp
+        await assistant.tool_registry.execute_tool("Summary_Generator", question="Tóm tắt hồi quy tuyến tính")
+        assert len(assistant.llm.prompts) == generated
+    asyncio.run(scenario())
+
+
+def test_pregenerated_summary_needs_the_document_and_the_whole_request(assistant):
+    async def scenario():
+        await Pregenerator(assistant, tools=["Summary_Generator"]).pregenerate("ml.pdf", "course:ml")
+        generated = len(assistant.llm.prompts)
+
+        # Yêu cầu hỏi thêm nội dung khác chủ đề
+        assistant.retriever.results = DOCUMENT[1:]
+        await assistant.tool_registry.execute_tool("Summary_Generator", question="Tóm tắt hồi quy tuyến tính và hồi quy logistic")
+        assert len(assistant.llm.prompts) == generated + 1
+
+        # Người hỏi không truy xuất được chunk nào của tài liệu đã sinh trước
+        assistant.retriever.results = OTHER_DOCUMENT
+        await assistant.tool_registry.execute_tool("Summary_Generator", question="Tóm tắt hồi quy tuyến tính")
+        assert len(assistant.llm.prompts) == generated + 2
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import uuid
+
+import pytest
+
+from config import settings as config
+from vectorstores import LocalVectorStore
+from vectorstores.conformance import CHECKS, check_search_filters, run_conformance
+
+
+def milvus_reachable() -> bool:
+    try:
+        from pymilvus import connections
+    except ImportError:
+        return False
+    alias = f"conformance_probe_{uuid.uuid4().hex[:8]}"
+    try:
+        connections.connect(alias=alias, host=config.MILVUS_HOST, port=config.MILVUS_PORT, timeout=2)
+        return True
+    except Exception:
+        return False
+    finally:
+        try:
+            connections.disconnect(alias)
+        except Exception:
+            pass
+
+
+@pytest.fixture(params=["local", "local_faiss", "milvus"])
+def backend(request, tmp_path):
+    """(store_factory, cleanup) for a fresh, empty store of each backend."""
+    if request.param == "milvus":
+        if not milvus_reachable():
+            pytest.skip(f"Milvus not reachable at {config.MILVUS_HOST}:{config.MILVUS_PORT}")
+        from pymilvus import utility
+        from vectorstores.milvus_store import MilvusVectorStore
+        name = f"conformance_{uuid.uuid4().hex[:8]}"
+        return (lambda: MilvusVectorStore(name, host=config.MILVUS_HOST, port=config.MILVUS_PORT, alias=f"{name}_alias"),
+                lambda store: utility.drop_collection(name, using=store.alias))
+    if request.param == "local_faiss":
+        pytest.importorskip("faiss")
+    return lambda: LocalVectorStore(str(tmp_path / "store"), use_faiss=request.param == "local_faiss"), None
+
+
+# Các bước phụ thuộc thứ tự: mỗi test chạy các bước trước nó trên một store mới rồi tới bước của mình
+@pytest.mark.parametrize("check_count", range(1, len(CHECKS) + 1), ids=[check.__name__ for check in CHECKS])
+def test_conformance(backend, check_count):
+    store_factory, cleanup = backend
+    run_conformance(store_factory, cleanup=cleanup, checks=CHECKS[:check_count])
+
+
+@pytest.mark.parametrize("use_faiss", [False, True], ids=["numpy", "faiss"])
+def test_local_store_reopens_from_disk(tmp_path, use_faiss):
+    if use_faiss:
+        pytest.importorskip("faiss")
+    path = str(tmp_path / "store")
+    run_conformance(lambda: LocalVectorStore(path, use_faiss=use_faiss))
+    reopened = LocalVectorStore(path, use_faiss=use_faiss)
+    assert reopened.stats()["count"] == 18
+    check_search_filters(reopened)
@@ -1,12 +1,27 @@
 # --- START OF FILE tools/base_tool.py ---
 
+import asyncio
+import json
+import logging
+import sqlite3
 from abc import ABC, abstractmethod
-from typing import Any, TYPE_CHECKING
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, TYPE_CHECKING
+
+from config import settings as config
+from core.prompts import prompts
+from core.query_parser import parse_positional_query
+from utils.generation_cache import (
+    GenerationCache, context_fingerprint, current_document, document_key_fingerprint, get_generation_cache
+)
+from utils.json_repair import loads_llm_json
+from utils.metrics import metrics
 
 # Use TYPE_CHECKING to avoid circular import for type hints
 if TYPE_CHECKING:
     from core.learning_assistant_v2 import LearningAssistant
 
+logger = logging.getLogger(__name__)
+
 class BaseTool(ABC):
     """Base class for all tools in the learning assistant"""
 
@@ -22,6 +37,14 @@ class BaseTool(ABC):
         """Return a description of the tool for the router agent"""
         pass
 
+    @property
+    def examples(self) -> List[str]:
+        """
+        Example user requests that should be routed to this tool.
+        Used by the local intent router; tools without examples are only reachable through the LLM router.
+        """
+        return []
+
     @property
     def needs_context(self) -> bool:
         """
@@ -30,6 +53,129 @@ class BaseTool(ABC):
         """
         return True
 
+    @property
+    def single_flight(self) -> bool:
+        """
+        Whether concurrent identical executions may share one run.
+        Override to False for tools whose execution mutates state.
+        """
+        return True
+
+    @property
+    def user_scoped(self) -> bool:
+        """
+        Whether the result depends on (or is saved for) the calling user.
+        User-scoped tools only share in-flight runs between calls of the same user.
+        """
+        return False
+
+    @property
+    def prompt_version(self) -> str:
+        """
+        Version of the tool's generation prompt, part of the generation cache key. Derived
+        from the registered prompt text, so older generations stop matching when it changes.
+        """
+        return prompts.version(self.name) if prompts.has(self.name) else "1"
+
+    async def retrieve(self, assistant: 'LearningAssistant', query: str, kwargs: Dict[str, Any],
+                       top_k: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Retrieved chunks for `query`. Inside a request (kwargs["retrieval"]), chunks the graph
+        already retrieved with the same parameters are reused instead of searching again.
+        Requests naming slides/pages ("Tạo quiz từ slide 3") use exactly those chunks.
+        """
+        positional = parse_positional_query(query)
+        if positional:
+            try:
+                found = await assistant.retriever.lookup_by_position(
+                    positional["slide_numbers"], positional["source"], partition_keys=kwargs.get("partition_keys")
+                )
+                if found:
+                    return found
+            except Exception:
+                # Không tra được theo vị trí thì tìm theo ngữ nghĩa như bình thường
+                metrics.increment("tools.positional_lookup_failed")
+        retrieval = kwargs.get("retrieval")
+        if retrieval is None:
+            return await assistant.retriever.search(query, top_k=top_k, partition_keys=kwargs.get("partition_keys"))
+        return await retrieval.search(assistant.retriever, query, top_k=top_k, partition_keys=kwargs.get("partition_keys"))
+
+    async def generate_cached(self, assistant: 'LearningAssistant', topic: str, generate: Callable[[], Awaitable[Any]],
+                              chunks: Optional[Sequence[Dict[str, Any]]] = None, context_text: Optional[str] = None,
+                              options: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Runs `generate` (the LLM call) through the persistent generation cache, keyed by
+        tool, topic, retrieved chunks (or context text), prompt version and model. On a miss,
+        a generation pre-generated for a document topic the request names is served instead;
+        inside `document_scope` (pre-generation) the key is the document and the topic.
+        `options["fresh"]` skips the lookup and stores the new generation. SQLite runs in a
+        worker thread; a cache error counts as a miss (or a skipped store), never a tool failure.
+        """
+        cache = get_generation_cache()
+        if cache is None:
+            return await generate()
+        model = getattr(getattr(assistant, "llm", None), "model", None) or config.LLM_MODEL_NAME
+        document = current_document()
+        fingerprint = document_key_fingerprint(document) if document else context_fingerprint(chunks, context_text)
+        key = cache.make_key(self.name, topic, fingerprint, self.prompt_version, model)
+        if (options or {}).get("fresh"):
+            metrics.increment("generation_cache.bypassed")
+        else:
+            cached = await self._cache_get(cache, key)
+            if cached is None and document is None and chunks:
+                cached = await self._pregenerated(cache, topic, chunks, model)
+            if cached is not None:
+                return cached
+        result = await generate()
+        try:
+            await asyncio.to_thread(cache.put, key, result, tool=self.name)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            metrics.increment("generation_cache.errors")
+            logger.warning(f"{self.name}: could not store generation in cache: {e}")
+        return result
+
+    async def _cache_get(self, cache: GenerationCache, key: str) -> Any:
+        try:
+            return await asyncio.to_thread(cache.get, key)
+        except (sqlite3.Error, ValueError) as e:  # ValueError: bản ghi JSON hỏng
+            metrics.increment("generation_cache.errors")
+            logger.warning(f"{self.name}: generation cache lookup failed, generating: {e}")
+            return None
+
+    async def _pregenerated(self, cache: GenerationCache, request: str, chunks: Sequence[Dict[str, Any]],
+                            model: str) -> Any:
+        """The generation pre-generated for the document topic named by `request`, if any."""
+        try:
+            document = await asyncio.to_thread(cache.match_document_topic, request, [chunk.get("id") for chunk in chunks])
+        except sqlite3.Error as e:
+            metrics.increment("generation_cache.errors")
+            logger.warning(f"{self.name}: document topic lookup failed: {e}")
+            return None
+        if document is None:
+            return None
+        key = cache.make_key(self.name, document["topic"], document_key_fingerprint(document["fingerprint"]),
+                             self.prompt_version, model)
+        cached = await self._cache_get(cache, key)
+        if cached is not None:
+            metrics.increment("generation_cache.pregenerated_hits")
+            logger.info(f"{self.name}: serving pre-generated '{document['topic']}' of '{document['source']}'")
+        return cached
+
+    async def generate_json(self, assistant: 'LearningAssistant', prompt: str, regenerations: int = 1) -> Any:
+        """
+        Asks the LLM for a JSON response and parses it, repairing malformed output first;
+        the whole generation is repeated (up to `regenerations` times) only when repair fails.
+        Raises json.JSONDecodeError when every attempt is unparseable.
+        """
+        for attempt in range(regenerations + 1):
+            response = await assistant.llm.ainvoke(prompt)
+            try:
+                return loads_llm_json(response)
+            except json.JSONDecodeError:
+                if attempt == regenerations:
+                    raise
+                metrics.increment("json_repair.regenerations")
+
     @abstractmethod
     async def execute(self, assistant: 'LearningAssistant', **kwargs) -> Any:
         """
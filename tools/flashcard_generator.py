@@ -4,6 +4,9 @@ import re  # Thêm import re cho regular expressions
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, OperationFailure
 from .base_tool import BaseTool
+from core.prompts import prompts
+from typing import List
+from core.context_packer import pack_chunks, slide_formatter
 
 # MongoDB Configuration (Consistent with other tools)
 MONGO_HOST = "localhost"
@@ -11,6 +14,49 @@ MONGO_PORT = 27017
 MONGO_DB_NAME = "edumentor"
 MONGO_COLLECTION_NAME = "edumentor"  # User requested collection name
 
+prompts.register("Flashcard_Generator", """Dựa trên thông tin sau, tạo bộ flashcard học tập cho chủ đề "{topic}".
+Thông tin: {context_text}
+
+Tạo 10 flashcard, mỗi flashcard có định dạng:
+FLASHCARD #[số]:
+Mặt trước: [Câu hỏi hoặc thuật ngữ]
+Mặt sau: [Câu trả lời hoặc định nghĩa, kèm số slide nếu có]
+
+Yêu cầu:
+- Trả về kết quả dưới dạng một đối tượng JSON duy nhất.
+- Đối tượng JSON phải có một key là "deck_id" với giá trị là một chuỗi ID duy nhất (ví dụ: flashcard_{topic}_timestamp).
+- Đối tượng JSON phải có một key là "topic" chứa tên chủ đề đã cho.
+- Đối tượng JSON phải có một key là "cards" chứa một danh sách (list) các đối tượng flashcard.
+- Mỗi đối tượng flashcard trong danh sách "cards" phải có các key:
+    - "id": một số nguyên duy nhất cho thẻ trong bộ này (bắt đầu từ 1).
+    - "front": chuỗi chứa nội dung mặt trước (câu hỏi/thuật ngữ).
+    - "back": chuỗi chứa nội dung mặt sau (câu trả lời/định nghĩa).
+    - "source_slide": (Tùy chọn) số slide nguồn nếu có thể xác định.
+- Đảm bảo JSON hợp lệ và chỉ trả về đối tượng JSON, không có văn bản giải thích nào khác xung quanh nó.
+
+Ví dụ cấu trúc JSON mong muốn:
+{{
+  "deck_id": "flashcard_bayesnet_1700000000",
+  "topic": "Bayesian Networks",
+  "cards": [
+    {{
+      "id": 1,
+      "front": "What is a Bayesian Network?",
+      "back": "A probabilistic graphical model representing variables and their conditional dependencies via a directed acyclic graph.",
+      "source_slide": 2
+    }},
+    {{
+      "id": 2,
+      "front": "What are the two main components?",
+      "back": "1. A Directed Acyclic Graph (DAG). 2. A set of Conditional Probability Tables (CPTs).",
+       "source_slide": 3
+    }}
+    // ... thêm các thẻ khác ...
+  ]
+}}
+""")
+
+
 class FlashcardGeneratorTool(BaseTool):
     def __init__(self):
         super().__init__()
@@ -42,6 +88,20 @@ class FlashcardGeneratorTool(BaseTool):
     @property
     def description(self) -> str:
         return "Tạo flashcards cho một chủ đề."
+
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Tạo flashcard về các thuật toán tìm kiếm",
+            "Làm thẻ ghi nhớ cho chương 2",
+            "Tạo bộ thẻ học từ vựng về mạng máy tính",
+            "Create flashcards for probability terms",
+        ]
+
+    @property
+    def user_scoped(self) -> bool:
+        # Bộ flashcard được lưu vào hồ sơ của từng người dùng
+        return True
     
     async def execute(self, assistant, **kwargs):
         topic = kwargs.get("question", "")
@@ -52,71 +112,30 @@ class FlashcardGeneratorTool(BaseTool):
             return "Vui lòng cung cấp chủ đề để tạo flashcard."
         
         try:
-            context = await assistant.retriever.search(topic)
+            context = await self.retrieve(assistant, topic, kwargs)
             if not context:
                 return f"Không tìm thấy thông tin về '{topic}' để tạo flashcard."
             
-            context_text = "\n\n".join([f"Slide {doc.get('slide_number', 'N/A')}: {doc['text']}" for doc in context])
-            prompt = f"""Dựa trên thông tin sau, tạo bộ flashcard học tập cho chủ đề "{topic}".
-            Thông tin: {context_text}
-            
-            Tạo 10 flashcard, mỗi flashcard có định dạng:
-            FLASHCARD #[số]:
-            Mặt trước: [Câu hỏi hoặc thuật ngữ]
-            Mặt sau: [Câu trả lời hoặc định nghĩa, kèm số slide nếu có]
-
-            Yêu cầu:
-            - Trả về kết quả dưới dạng một đối tượng JSON duy nhất.
-            - Đối tượng JSON phải có một key là "deck_id" với giá trị là một chuỗi ID duy nhất (ví dụ: flashcard_{topic}_timestamp).
-            - Đối tượng JSON phải có một key là "topic" chứa tên chủ đề đã cho.
-            - Đối tượng JSON phải có một key là "cards" chứa một danh sách (list) các đối tượng flashcard.
-            - Mỗi đối tượng flashcard trong danh sách "cards" phải có các key:
-                - "id": một số nguyên duy nhất cho thẻ trong bộ này (bắt đầu từ 1).
-                - "front": chuỗi chứa nội dung mặt trước (câu hỏi/thuật ngữ).
-                - "back": chuỗi chứa nội dung mặt sau (câu trả lời/định nghĩa).
-                - "source_slide": (Tùy chọn) số slide nguồn nếu có thể xác định.
-            - Đảm bảo JSON hợp lệ và chỉ trả về đối tượng JSON, không có văn bản giải thích nào khác xung quanh nó.
-
-            Ví dụ cấu trúc JSON mong muốn:
-            {{
-              "deck_id": "flashcard_bayesnet_1700000000",
-              "topic": "Bayesian Networks",
-              "cards": [
-                {{
-                  "id": 1,
-                  "front": "What is a Bayesian Network?",
-                  "back": "A probabilistic graphical model representing variables and their conditional dependencies via a directed acyclic graph.",
-                  "source_slide": 2
-                }},
-                {{
-                  "id": 2,
-                  "front": "What are the two main components?",
-                  "back": "1. A Directed Acyclic Graph (DAG). 2. A set of Conditional Probability Tables (CPTs).",
-                   "source_slide": 3
-                }}
-                // ... thêm các thẻ khác ...
-              ]
-            }}
-            """
-
-            # Use asynchronous invoke for LLM
-            response_content = await assistant.llm.ainvoke(prompt)
-            # Clean potential markdown code fences ```json ... ```
-            cleaned_response = re.sub(r'^```json\s*|\s*```$', '', response_content, flags=re.MULTILINE).strip()
-
-            # Parse the JSON response
+            context_text = pack_chunks(context, formatter=slide_formatter, label=self.name)["text"]
+            prompt = prompts.format(self.name, topic=topic, context_text=context_text)
+
+            async def generate():
+                # Parse the JSON response (repaired if malformed, regenerated if unrepairable)
+                data = await self.generate_json(assistant, prompt)
+                # Basic validation (before caching, so invalid decks are never served from the cache)
+                if not isinstance(data, dict) or "cards" not in data or not isinstance(data["cards"], list):
+                    raise ValueError("Invalid JSON format for flashcards.")
+                return data
+
             try:
-                flashcard_data = json.loads(cleaned_response)
-                 # Basic validation
-                if not isinstance(flashcard_data, dict) or "cards" not in flashcard_data or not isinstance(flashcard_data["cards"], list):
-                     raise ValueError("Invalid JSON format for flashcards.")
+                flashcard_data = await self.generate_cached(assistant, topic, generate, chunks=context, options=options)
                 if "deck_id" not in flashcard_data:
                     flashcard_data["deck_id"] = f"flashcard_{topic.replace(' ','_')}_{int(datetime.now().timestamp())}"
                 if "topic" not in flashcard_data:
                     flashcard_data["topic"] = topic
 
             except json.JSONDecodeError as e:
-                 print(f"Error parsing flashcard JSON: {e}\nResponse: {cleaned_response}")
+                 print(f"Error parsing flashcard JSON: {e}\nResponse: {e.doc}")
                  return {"error": f"Lỗi khi xử lý phản hồi JSON từ AI: {e}"} # Return error dict
 
             # Lưu flashcards (dưới dạng dict) vào MongoDB nếu có username
@@ -2,10 +2,50 @@ from datetime import datetime
 import re  # Thêm import re để sử dụng regular expressions
 import logging  # Thêm logging để dễ debug
 from .base_tool import BaseTool
+from core.prompts import prompts
+from typing import List
+from core.context_packer import pack_chunks, slide_formatter
 
 # Tạo logger
 logger = logging.getLogger(__name__)
 
+prompts.register("Mind_Map_Creator", """Dựa trên thông tin sau, tạo sơ đồ tư duy trực quan và phong phú cho chủ đề "{topic}".
+Thông tin: {context_text}
+
+Sơ đồ tư duy nên có:
+1. Chủ đề chính ở trung tâm với emoji đại diện phù hợp
+2. Các nhánh chính (khái niệm chính) với icon/emoji phù hợp với mỗi nhánh
+3. Các nhánh phụ (khái niệm phụ, kèm số slide nếu có)
+4. Mối quan hệ giữa các khái niệm (thể hiện qua cấu trúc lồng nhau)
+5. Thông tin ngắn gọn, súc tích về mỗi khái niệm
+
+Yêu cầu định dạng:
+- Trả về kết quả dưới dạng một chuỗi Markdown hợp lệ cho Markmap.
+- Sử dụng dấu `#` cho chủ đề chính và PHẢI kèm emoji phù hợp.
+- Sử dụng dấu `-` hoặc `*` và thụt lề (2 dấu cách) để thể hiện các cấp độ nhánh.
+- Thêm emoji hoặc icon phù hợp trước mỗi nhánh chính để tăng tính trực quan.
+- Thêm các mô tả ngắn gọn cho mỗi nhánh để làm rõ khái niệm (nên viết sau dấu `:` hoặc trong ngoặc).
+- Thêm định dạng in đậm hoặc in nghiêng cho các khái niệm quan trọng.
+- Sử dụng liên kết Markdown (nếu có thông tin slide) cho các tham chiếu: [Tên khái niệm](Slide X).
+
+Ví dụ định dạng Markdown (PHẢI theo chính xác định dạng này, với emoji/icon cho mỗi nhánh):
+```markdown
+# 🧠 Chủ đề chính
+- 📊 Nhánh chính 1: Khái niệm cốt lõi
+  - 📌 Nhánh phụ 1.1: *Giải thích súc tích*
+  - 🔍 Nhánh phụ 1.2: **Điểm quan trọng**
+    - Chi tiết bổ sung (Slide 3)
+- 🛠️ Nhánh chính 2: Công cụ và ứng dụng
+  - 📱 Nhánh phụ 2.1: Ứng dụng thực tiễn
+    - 📘 [Tham khảo thêm](Slide 5)
+- 📝 Nhánh chính 3: Tóm tắt và kết luận
+```
+
+Định dạng này sẽ tạo ra sơ đồ tư duy trực quan với các emoji giúp người dùng dễ dàng hiểu và nhớ các khái niệm.
+Chỉ trả về markdown thuần túy, không kèm theo text giới thiệu hay giải thích khác.
+""")
+
+
 class MindMapCreatorTool(BaseTool):
     @property
     def name(self) -> str:
@@ -14,6 +54,15 @@ class MindMapCreatorTool(BaseTool):
     @property
     def description(self) -> str:
         return "Tạo sơ đồ tư duy cho một chủ đề."
+
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Vẽ sơ đồ tư duy về học máy",
+            "Tạo mind map cho chương tìm kiếm",
+            "Lập sơ đồ tư duy các khái niệm xác suất",
+            "Create a mind map of search algorithms",
+        ]
     
     async def execute(self, assistant, **kwargs):
         topic = kwargs.get("question", "")
@@ -22,53 +71,21 @@ class MindMapCreatorTool(BaseTool):
         
         try:
             logger.info(f"Mind Map Creator: Retrieving context for '{topic}'...")
-            context = await assistant.retriever.search(topic)
+            context = await self.retrieve(assistant, topic, kwargs)
             if not context:
                 logger.warning(f"Mind Map Creator: No documents found for '{topic}'.")
                 return f"Không tìm thấy thông tin về '{topic}' để tạo sơ đồ tư duy."
             
             # Thêm thông tin slide vào context nếu có
-            context_text = "\n\n".join([f"Slide {doc.get('slide_number', 'N/A')}: {doc['text']}" for doc in context])
+            context_text = pack_chunks(context, formatter=slide_formatter, label=self.name)["text"]
             logger.info(f"Mind Map Creator: Retrieved {len(context)} chunks for '{topic}'.")
             
-            prompt = f"""Dựa trên thông tin sau, tạo sơ đồ tư duy trực quan và phong phú cho chủ đề "{topic}".
-            Thông tin: {context_text}
-            
-            Sơ đồ tư duy nên có:
-            1. Chủ đề chính ở trung tâm với emoji đại diện phù hợp
-            2. Các nhánh chính (khái niệm chính) với icon/emoji phù hợp với mỗi nhánh
-            3. Các nhánh phụ (khái niệm phụ, kèm số slide nếu có)
-            4. Mối quan hệ giữa các khái niệm (thể hiện qua cấu trúc lồng nhau)
-            5. Thông tin ngắn gọn, súc tích về mỗi khái niệm
-            
-            Yêu cầu định dạng:
-            - Trả về kết quả dưới dạng một chuỗi Markdown hợp lệ cho Markmap.
-            - Sử dụng dấu `#` cho chủ đề chính và PHẢI kèm emoji phù hợp.
-            - Sử dụng dấu `-` hoặc `*` và thụt lề (2 dấu cách) để thể hiện các cấp độ nhánh.
-            - Thêm emoji hoặc icon phù hợp trước mỗi nhánh chính để tăng tính trực quan.
-            - Thêm các mô tả ngắn gọn cho mỗi nhánh để làm rõ khái niệm (nên viết sau dấu `:` hoặc trong ngoặc).
-            - Thêm định dạng in đậm hoặc in nghiêng cho các khái niệm quan trọng.
-            - Sử dụng liên kết Markdown (nếu có thông tin slide) cho các tham chiếu: [Tên khái niệm](Slide X).
-            
-            Ví dụ định dạng Markdown (PHẢI theo chính xác định dạng này, với emoji/icon cho mỗi nhánh):
-            ```markdown
-            # 🧠 Chủ đề chính
-            - 📊 Nhánh chính 1: Khái niệm cốt lõi
-              - 📌 Nhánh phụ 1.1: *Giải thích súc tích*
-              - 🔍 Nhánh phụ 1.2: **Điểm quan trọng**
-                - Chi tiết bổ sung (Slide 3)
-            - 🛠️ Nhánh chính 2: Công cụ và ứng dụng
-              - 📱 Nhánh phụ 2.1: Ứng dụng thực tiễn
-                - 📘 [Tham khảo thêm](Slide 5)
-            - 📝 Nhánh chính 3: Tóm tắt và kết luận
-            ```
-            
-            Định dạng này sẽ tạo ra sơ đồ tư duy trực quan với các emoji giúp người dùng dễ dàng hiểu và nhớ các khái niệm.
-            Chỉ trả về markdown thuần túy, không kèm theo text giới thiệu hay giải thích khác.
-            """
+            prompt = prompts.format(self.name, topic=topic, context_text=context_text)
 
             logger.info(f"Mind Map Creator: Calling LLM for '{topic}'...")
-            response = await assistant.llm.ainvoke(prompt)  # Use async invoke
+            response = await self.generate_cached(  # Use async invoke
+                assistant, topic, lambda: assistant.llm.ainvoke(prompt), chunks=context, options=kwargs.get("options")
+            )
             markdown_content = response  # Assuming model returns content directly
             logger.info(f"Mind Map Creator: Mind map generated for '{topic}'.")
             # Basic check if it looks like markdown
@@ -55,11 +55,25 @@ class ProgressTrackerTool(BaseTool):
     def description(self) -> str:
         return "Theo dõi hoặc cập nhật tiến độ học tập và tài liệu của người dùng."
 
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Xem tiến độ học tập của tôi",
+            "Cập nhật tiến độ: tôi đã học xong chương 3",
+            "Tôi đã học được bao nhiêu bài rồi?",
+            "Show my learning progress",
+        ]
+
     @property
     def needs_context(self) -> bool:
         """Progress tracker doesn't need document context."""
         return False
 
+    @property
+    def single_flight(self) -> bool:
+        """Progress updates mutate user data and must never be coalesced."""
+        return False
+
     async def execute(self, assistant: 'LearningAssistant', **kwargs) -> Dict:
         """
         Xử lý yêu cầu và trả về kết quả dưới dạng từ điển (không phải JSON string)
@@ -4,6 +4,8 @@ import asyncio
 import json # Import json module
 import logging
 from .base_tool import BaseTool
+from core.prompts import prompts
+from core.context_packer import pack_chunks, plain_formatter
 from typing import TYPE_CHECKING, Any, Dict, List # Thêm Dict, List
 import re
 import datetime
@@ -15,6 +17,45 @@ if TYPE_CHECKING:
 # Logger setup (assuming global config is sufficient)
 logger = logging.getLogger(__name__)
 
+prompts.register("Quiz_Generator", """Dựa trên thông tin ngữ cảnh sau đây về chủ đề "{topic}", hãy tạo một bài kiểm tra trắc nghiệm gồm {num_questions} câu hỏi.
+
+Ngữ cảnh:
+{context_str}
+
+Yêu cầu:
+- Trả về kết quả dưới dạng một đối tượng JSON duy nhất.
+- Đối tượng JSON phải có một key là "quiz_id" với giá trị là một chuỗi ID duy nhất (ví dụ: sử dụng timestamp hoặc UUID).
+- Đối tượng JSON phải có một key là "questions" chứa một danh sách (list) các đối tượng câu hỏi.
+- Mỗi đối tượng câu hỏi trong danh sách phải có các key sau:
+    - "id": một số nguyên duy nhất cho câu hỏi trong quiz này (bắt đầu từ 1).
+    - "question_text": chuỗi chứa nội dung câu hỏi.
+    - "options": một danh sách (list) gồm 4 chuỗi, đại diện cho các lựa chọn (A, B, C, D).
+    - "correct_answer_index": một số nguyên (0, 1, 2, hoặc 3) chỉ định chỉ số của đáp án đúng trong danh sách "options".
+- Câu hỏi nên bao quát các khía cạnh quan trọng của chủ đề trong ngữ cảnh.
+- Đảm bảo JSON hợp lệ và chỉ trả về đối tượng JSON, không có văn bản giải thích nào khác xung quanh nó.
+
+Ví dụ cấu trúc JSON mong muốn:
+{{
+  "quiz_id": "quiz_1700000000",
+  "questions": [
+    {{
+      "id": 1,
+      "question_text": "Câu hỏi ví dụ 1 là gì?",
+      "options": ["Lựa chọn A", "Lựa chọn B", "Lựa chọn C", "Lựa chọn D"],
+      "correct_answer_index": 0
+    }},
+    {{
+      "id": 2,
+      "question_text": "Câu hỏi ví dụ 2 liên quan đến gì?",
+      "options": ["Đáp án 1", "Đáp án 2", "Đáp án 3", "Đáp án 4"],
+      "correct_answer_index": 2
+    }}
+    // ... thêm các câu hỏi khác ...
+  ]
+}}
+""")
+
+
 class QuizGenerator(BaseTool):
     @property
     def name(self) -> str:
@@ -24,6 +65,16 @@ class QuizGenerator(BaseTool):
     def description(self) -> str:
         return "Tạo câu hỏi trắc nghiệm (quiz) về một chủ đề cụ thể dưới dạng JSON."
 
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Tạo quiz về mạng nơ-ron",
+            "Cho tôi 5 câu hỏi trắc nghiệm về xác suất",
+            "Kiểm tra kiến thức của tôi về học máy",
+            "Làm bài test ngắn về cấu trúc dữ liệu",
+            "Generate a quiz about sorting algorithms",
+        ]
+
     # needs_context defaults to True in BaseTool
 
     async def execute(self, assistant: 'LearningAssistant', **kwargs) -> Dict[str, Any]: # Return Dict (JSON)
@@ -51,11 +102,11 @@ class QuizGenerator(BaseTool):
         if not context_str and self.needs_context:
             logger.warning(f"QuizGenerator: Context not provided for '{topic}', retrieving...")
             try:
-                retrieved_docs = await assistant.retriever.search(topic)
+                retrieved_docs = await self.retrieve(assistant, topic, kwargs)
                 if not retrieved_docs:
                     logger.warning(f"QuizGenerator: No documents found for '{topic}'.")
                     return {"error": f"Không tìm thấy thông tin về '{topic}' để tạo bài kiểm tra."}
-                context_str = "\n\n".join([doc.get('text', '') for doc in retrieved_docs])
+                context_str = pack_chunks(retrieved_docs, formatter=plain_formatter, label=self.name)["text"]
             except Exception as e:
                 logger.error(f"QuizGenerator: Error retrieving context: {e}")
                 return {"error": f"Lỗi khi truy xuất thông tin cho '{topic}': {e}"}
@@ -64,56 +115,12 @@ class QuizGenerator(BaseTool):
              return {"error": f"Lỗi: Thiếu ngữ cảnh cần thiết để tạo quiz cho '{topic}'."}
 
         # Updated prompt requesting JSON output
-        prompt_template = f"""Dựa trên thông tin ngữ cảnh sau đây về chủ đề "{topic}", hãy tạo một bài kiểm tra trắc nghiệm gồm {num_questions} câu hỏi.
-
-        Ngữ cảnh:
-        {context_str}
-
-        Yêu cầu:
-        - Trả về kết quả dưới dạng một đối tượng JSON duy nhất.
-        - Đối tượng JSON phải có một key là "quiz_id" với giá trị là một chuỗi ID duy nhất (ví dụ: sử dụng timestamp hoặc UUID).
-        - Đối tượng JSON phải có một key là "questions" chứa một danh sách (list) các đối tượng câu hỏi.
-        - Mỗi đối tượng câu hỏi trong danh sách phải có các key sau:
-            - "id": một số nguyên duy nhất cho câu hỏi trong quiz này (bắt đầu từ 1).
-            - "question_text": chuỗi chứa nội dung câu hỏi.
-            - "options": một danh sách (list) gồm 4 chuỗi, đại diện cho các lựa chọn (A, B, C, D).
-            - "correct_answer_index": một số nguyên (0, 1, 2, hoặc 3) chỉ định chỉ số của đáp án đúng trong danh sách "options".
-        - Câu hỏi nên bao quát các khía cạnh quan trọng của chủ đề trong ngữ cảnh.
-        - Đảm bảo JSON hợp lệ và chỉ trả về đối tượng JSON, không có văn bản giải thích nào khác xung quanh nó.
-
-        Ví dụ cấu trúc JSON mong muốn:
-        {{
-          "quiz_id": "quiz_1700000000",
-          "questions": [
-            {{
-              "id": 1,
-              "question_text": "Câu hỏi ví dụ 1 là gì?",
-              "options": ["Lựa chọn A", "Lựa chọn B", "Lựa chọn C", "Lựa chọn D"],
-              "correct_answer_index": 0
-            }},
-            {{
-              "id": 2,
-              "question_text": "Câu hỏi ví dụ 2 liên quan đến gì?",
-              "options": ["Đáp án 1", "Đáp án 2", "Đáp án 3", "Đáp án 4"],
-              "correct_answer_index": 2
-            }}
-            // ... thêm các câu hỏi khác ...
-          ]
-        }}
-        """
+        prompt_template = prompts.format(self.name, topic=topic, num_questions=num_questions, context_str=context_str)
 
         try:
             logger.info(f"QuizGenerator: Calling LLM to generate JSON quiz for '{topic}'...")
-            response_content = await assistant.llm.ainvoke(prompt_template)
-            
-            # Clean potential markdown code fences ```json ... ```
-            cleaned_response = re.sub(r'^```json\s*|\s*```$', '', response_content, flags=re.MULTILINE).strip()
-
-            logger.debug(f"QuizGenerator: Raw LLM response:\n{response_content}")
-            logger.debug(f"QuizGenerator: Cleaned LLM response:\n{cleaned_response}")
-
-            # Parse the JSON response
-            quiz_data = json.loads(cleaned_response)
+            # Parse the JSON response (repaired if malformed, regenerated if unrepairable)
+            quiz_data = await self.generate_json(assistant, prompt_template)
             
             # Basic validation (can be expanded)
             if not isinstance(quiz_data, dict) or "questions" not in quiz_data or not isinstance(quiz_data["questions"], list):
@@ -128,7 +135,7 @@ class QuizGenerator(BaseTool):
             return quiz_data # Return the parsed dictionary
 
         except json.JSONDecodeError as e:
-            logger.error(f"QuizGenerator: Failed to parse JSON response from LLM: {e}\nResponse: {cleaned_response}")
+            logger.error(f"QuizGenerator: Failed to parse JSON response from LLM: {e}\nResponse: {e.doc}")
             return {"error": f"Lỗi khi xử lý phản hồi từ AI để tạo quiz: {e}"}
         except Exception as e:
             logger.exception(f"QuizGenerator: Error during LLM call or processing for '{topic}': {e}")
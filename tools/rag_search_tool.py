@@ -1,4 +1,6 @@
 from .base_tool import BaseTool
+from typing import List
+from core.context_packer import pack_chunks, plain_formatter
 
 class RAGSearchTool(BaseTool):
     @property
@@ -8,6 +10,15 @@ class RAGSearchTool(BaseTool):
     @property
     def description(self) -> str:
         return "Tìm kiếm thông tin trong tài liệu nội bộ."
+
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Tìm trong tài liệu phần nói về cây quyết định",
+            "Tài liệu có nhắc đến thuật toán A* không?",
+            "Trong bài giảng, định nghĩa của entropy là gì?",
+            "Search the lecture notes for gradient descent",
+        ]
     
     async def execute(self, assistant, **kwargs):
         """Hàm tìm kiếm RAG nội bộ"""
@@ -19,5 +30,5 @@ class RAGSearchTool(BaseTool):
             return context
         
         # Nếu không, thực hiện tìm kiếm
-        results = await assistant.retriever.search(question)
-        return "\n\n".join([doc["text"] for doc in results])
\ No newline at end of file
+        results = await self.retrieve(assistant, question, kwargs)
+        return pack_chunks(results, formatter=plain_formatter, label=self.name)["text"]
\ No newline at end of file
@@ -3,7 +3,9 @@ from datetime import datetime, timezone # Import timezone
 from pymongo import MongoClient
 from pymongo.errors import ConnectionFailure, OperationFailure
 from .base_tool import BaseTool
-from typing import TYPE_CHECKING, Any, Dict # Import Dict
+from core.prompts import prompts
+from core.context_packer import pack_chunks, plain_formatter
+from typing import TYPE_CHECKING, Any, Dict, List # Import Dict
 from utils.user_data_manager import UserDataManager  # Import UserDataManager
 
 if TYPE_CHECKING:
@@ -17,6 +19,22 @@ MONGO_PORT = 27017
 MONGO_DB_NAME = "edumentor"
 MONGO_COLLECTION_NAME = "stats" # Thống nhất sử dụng collection stats
 
+prompts.register("Study_Plan_Creator", """Dựa trên thông tin ngữ cảnh sau đây về chủ đề "{subject}", hãy tạo một kế hoạch học tập chi tiết.
+
+Ngữ cảnh:
+{context_str}
+
+Yêu cầu kế hoạch học tập:
+- **Mục tiêu:** Nêu rõ mục tiêu cần đạt được sau khi hoàn thành kế hoạch.
+- **Chủ đề con:** Chia nhỏ chủ đề chính thành các phần nhỏ hơn, dễ quản lý.
+- **Thời gian dự kiến:** Ước lượng thời gian cho mỗi chủ đề con (ví dụ: 2 giờ, 1 ngày).
+- **Tài nguyên đề xuất:** Gợi ý các tài liệu, video, bài viết liên quan (nếu có trong ngữ cảnh).
+- **Hoạt động/Bài tập:** Đề xuất các hoạt động thực hành hoặc bài tập để củng cố kiến thức.
+- **Đánh giá:** Gợi ý cách tự đánh giá tiến độ (ví dụ: làm quiz, hoàn thành bài tập).
+
+Trình bày kế hoạch một cách rõ ràng, có cấu trúc, sử dụng markdown (bullet points, bold).""")
+
+
 class StudyPlanCreatorTool(BaseTool):
     def __init__(self):
         super().__init__()
@@ -52,14 +70,29 @@ class StudyPlanCreatorTool(BaseTool):
     def description(self) -> str:
         return "Tạo kế hoạch học tập cho một chủ đề và lưu vào hồ sơ người dùng (yêu cầu username)."
 
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Lập kế hoạch học tập môn trí tuệ nhân tạo trong 4 tuần",
+            "Tạo lộ trình học Python cho người mới",
+            "Giúp tôi lên lịch ôn thi cuối kỳ",
+            "Make a study plan for linear algebra",
+        ]
+
     @property
     def needs_context(self) -> bool:
         # Needs context about the subject to create a relevant plan
         return True
 
+    @property
+    def user_scoped(self) -> bool:
+        # Kế hoạch được lưu vào hồ sơ của từng người dùng
+        return True
+
     async def execute(self, assistant: 'LearningAssistant', **kwargs) -> str:
         subject = kwargs.get("question", "").strip()
         context_str = kwargs.get("context", "") # Context from the graph
+        context_chunks = kwargs.get("sources") # Chunks behind the graph context (generation cache key)
         options = kwargs.get("options", {})
         username = options.get("username", "").strip()
 
@@ -77,35 +110,27 @@ class StudyPlanCreatorTool(BaseTool):
              # This case should ideally be handled by the graph ensuring context is retrieved
              logger.warning(f"StudyPlanCreator: Context not provided for '{subject}'. Attempting retrieval.")
              try:
-                 context_docs = await assistant.retriever.search(subject)
+                 context_docs = await self.retrieve(assistant, subject, kwargs)
                  if not context_docs:
                      logger.warning(f"StudyPlanCreator: No documents found for '{subject}'. Cannot create plan without context.")
                      return f"Không tìm thấy thông tin về '{subject}' để tạo kế hoạch học tập."
-                 context_str = "\n\n".join([doc.get('text', '') for doc in context_docs])
+                 context_str = pack_chunks(context_docs, formatter=plain_formatter, label=self.name)["text"]
+                 context_chunks = context_docs
              except Exception as e:
                  logger.exception(f"StudyPlanCreator: Error retrieving context for '{subject}': {e}")
                  return f"Lỗi khi tìm thông tin cho '{subject}': {str(e)}"
 
         # Prompt for LLM to generate the plan
-        prompt = f"""Dựa trên thông tin ngữ cảnh sau đây về chủ đề "{subject}", hãy tạo một kế hoạch học tập chi tiết.
-
-        Ngữ cảnh:
-        {context_str}
-
-        Yêu cầu kế hoạch học tập:
-        - **Mục tiêu:** Nêu rõ mục tiêu cần đạt được sau khi hoàn thành kế hoạch.
-        - **Chủ đề con:** Chia nhỏ chủ đề chính thành các phần nhỏ hơn, dễ quản lý.
-        - **Thời gian dự kiến:** Ước lượng thời gian cho mỗi chủ đề con (ví dụ: 2 giờ, 1 ngày).
-        - **Tài nguyên đề xuất:** Gợi ý các tài liệu, video, bài viết liên quan (nếu có trong ngữ cảnh).
-        - **Hoạt động/Bài tập:** Đề xuất các hoạt động thực hành hoặc bài tập để củng cố kiến thức.
-        - **Đánh giá:** Gợi ý cách tự đánh giá tiến độ (ví dụ: làm quiz, hoàn thành bài tập).
-
-        Trình bày kế hoạch một cách rõ ràng, có cấu trúc, sử dụng markdown (bullet points, bold)."""
+        prompt = prompts.format(self.name, subject=subject, context_str=context_str)
 
         try:
             logger.info(f"StudyPlanCreator: Generating plan for '{subject}'...")
             # Use ainvoke for async call
-            response = await assistant.llm.ainvoke(prompt)
+            # Kế hoạch không phụ thuộc người dùng nên dùng chung cache; việc lưu vào hồ sơ vẫn theo từng người
+            response = await self.generate_cached(
+                assistant, subject, lambda: assistant.llm.ainvoke(prompt),
+                chunks=context_chunks, context_text=context_str, options=options
+            )
             plan_content = response # Adjust if response structure is different (e.g., response.content)
             logger.info(f"StudyPlanCreator: Plan generated for '{subject}'.")
 
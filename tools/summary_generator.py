@@ -1,10 +1,26 @@
 from datetime import datetime
 from .base_tool import BaseTool
+from core.prompts import prompts
+from typing import List
+from core.context_packer import pack_chunks, plain_formatter
 import logging
 
 # Thêm logger
 logger = logging.getLogger(__name__)
 
+prompts.register("Summary_Generator", """Dựa trên thông tin sau, tạo bản tóm tắt ngắn gọn và dễ hiểu về chủ đề "{topic}".
+Thông tin: {context_text}
+
+Bản tóm tắt nên bao gồm:
+1. Định nghĩa và khái niệm chính
+2. Các điểm quan trọng nhất
+3. Ứng dụng hoặc ý nghĩa thực tiễn
+4. Kết luận ngắn gọn
+
+Hãy viết tóm tắt trong khoảng 300-500 từ, ngắn gọn nhưng đầy đủ thông tin quan trọng.
+Sử dụng định dạng markdown để trình bày rõ ràng nếu cần.""")
+
+
 class SummaryGeneratorTool(BaseTool):
     @property
     def name(self) -> str:
@@ -13,6 +29,15 @@ class SummaryGeneratorTool(BaseTool):
     @property
     def description(self) -> str:
         return "Tạo tóm tắt cho một chủ đề."
+
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Tóm tắt chủ đề học tăng cường",
+            "Tóm tắt ngắn gọn về mạng nơ-ron tích chập",
+            "Viết bản tóm tắt về thuật toán di truyền",
+            "Summarize the topic of Bayesian networks",
+        ]
     
     async def execute(self, assistant, **kwargs):
         topic = kwargs.get("question", "")
@@ -21,29 +46,21 @@ class SummaryGeneratorTool(BaseTool):
         
         try:
             logger.info(f"Summary Generator: Retrieving context for '{topic}'...")
-            context = await assistant.retriever.search(topic)
+            context = await self.retrieve(assistant, topic, kwargs)
             if not context:
                 logger.warning(f"Summary Generator: No documents found for '{topic}'.")
                 return f"Không tìm thấy thông tin về '{topic}' để tạo tóm tắt."
             
-            context_text = "\n\n".join([doc["text"] for doc in context])
+            context_text = pack_chunks(context, formatter=plain_formatter, label=self.name)["text"]
             logger.info(f"Summary Generator: Retrieved {len(context)} chunks for '{topic}'.")
             
-            prompt = f"""Dựa trên thông tin sau, tạo bản tóm tắt ngắn gọn và dễ hiểu về chủ đề "{topic}".
-            Thông tin: {context_text}
-            
-            Bản tóm tắt nên bao gồm:
-            1. Định nghĩa và khái niệm chính
-            2. Các điểm quan trọng nhất
-            3. Ứng dụng hoặc ý nghĩa thực tiễn
-            4. Kết luận ngắn gọn
-            
-            Hãy viết tóm tắt trong khoảng 300-500 từ, ngắn gọn nhưng đầy đủ thông tin quan trọng.
-            Sử dụng định dạng markdown để trình bày rõ ràng nếu cần."""
+            prompt = prompts.format(self.name, topic=topic, context_text=context_text)
             
             logger.info(f"Summary Generator: Calling LLM for '{topic}'...")
             # Sửa thành ainvoke để sử dụng không đồng bộ
-            response = await assistant.llm.ainvoke(prompt)
+            response = await self.generate_cached(
+                assistant, topic, lambda: assistant.llm.ainvoke(prompt), chunks=context, options=kwargs.get("options")
+            )
             
             # Xử lý kết quả phù hợp với cấu trúc response
             result = response.content if hasattr(response, 'content') else str(response)
@@ -1,24 +1,33 @@
 # tools/tool_registry.py
 from typing import Dict, Any, Optional, Callable, Coroutine, List, Union # Thêm Union
 from .base_tool import BaseTool
+import copy
 import inspect
 import logging
 from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
 import asyncio
 from config import settings as config  
+from utils.single_flight import SingleFlight, make_key
+from utils.tracing import tracer
 
 
 # --- Logging Setup ---
 logging.basicConfig(level=config.LOGGING_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Các tham số thực sự ảnh hưởng tới kết quả của tool, dùng làm khóa coalescing
+_SINGLE_FLIGHT_KWARGS = ("question", "context", "options", "partition_keys")
+
 class ToolRegistry:
     """Registers and manages tools for the Learning Assistant."""
 
     def __init__(self, assistant: 'LearningAssistant'):
         self.assistant = assistant
         self.tools: Dict[str, BaseTool] = {}
+        self._execute_flight = SingleFlight("tool_execute")
+        # Danh mục công cụ cho prompt router, dựng lại khi có công cụ mới đăng ký
+        self._tools_description: Optional[str] = None
         logger.info("ToolRegistry initialized.")
 
     def register_tool(self, tool: BaseTool):
@@ -33,6 +42,7 @@ class ToolRegistry:
         if tool.name in self.tools:
             logger.warning(f"Overwriting existing tool in registry: {tool.name}")
         self.tools[tool.name] = tool
+        self._tools_description = None
         logger.info(f"Registered tool: {tool.name} - Needs Context: {tool.needs_context}") # Log thêm needs_context
         return self
 
@@ -49,6 +59,18 @@ class ToolRegistry:
         tool = self.get_tool(name)
         return tool.description if tool else None
 
+    def get_tools_description(self) -> str:
+        """Gets the tool catalogue text for the router prompt (cached until a tool is registered)."""
+        if self._tools_description is None:
+            lines = [f"- {name}: {tool.description}" for name, tool in self.tools.items() if tool.description]
+            self._tools_description = "\n".join(lines) or "Không có công cụ nào được mô tả."
+        return self._tools_description
+
+    def get_tool_examples(self, name: str) -> List[str]:
+        """Gets the example requests of a tool (used by the local intent router)."""
+        tool = self.get_tool(name)
+        return list(tool.examples) if tool else []
+
     def get_tool_names(self) -> List[str]:
          """Gets a list of names of all registered tools."""
          return list(self.tools.keys())
@@ -94,6 +116,27 @@ class ToolRegistry:
             #     result = await loop.run_in_executor(executor, lambda: execute_method(assistant=self.assistant, **kwargs))
             # return result
 
+        with tracer.span(f"tool.{name}", tool=name):
+            if tool.single_flight:
+                key = self._single_flight_key(tool, kwargs)
+                result = await self._execute_flight.do(key, lambda: self._run_tool(name, execute_method, kwargs))
+                # Kết quả dùng chung giữa các caller, trả về bản sao để caller tự do chỉnh sửa
+                return copy.deepcopy(result)
+            return await self._run_tool(name, execute_method, kwargs)
+
+    def _single_flight_key(self, tool: BaseTool, kwargs: Dict[str, Any]) -> str:
+        """Builds the coalescing key from the tool inputs and the current index version."""
+        inputs = {k: kwargs.get(k) for k in _SINGLE_FLIGHT_KWARGS}
+        options = dict(inputs.get("options") or {})
+        if not tool.user_scoped:
+            # username chỉ dùng để lưu kết quả, không ảnh hưởng tới nội dung sinh ra
+            options.pop("username", None)
+        inputs["options"] = options
+        retriever = getattr(self.assistant, "retriever", None)
+        index_version = getattr(retriever, "index_version", None)
+        return make_key(tool.name, inputs, index_version)
+
+    async def _run_tool(self, name: str, execute_method: Callable[..., Coroutine[Any, Any, Any]], kwargs: Dict[str, Any]) -> Any:
         logger.info(f"Executing async tool '{name}'...")
         try:
             # Gọi trực tiếp hàm async execute
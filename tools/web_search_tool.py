@@ -14,6 +14,16 @@ class WebSearchTool(BaseTool):
     @property
     def description(self) -> str:
         return "Tìm kiếm thông tin trên internet."
+
+    @property
+    def examples(self) -> List[str]:
+        return [
+            "Tìm trên mạng tin tức mới nhất về AI",
+            "Hôm nay là thứ mấy?",
+            "Tra cứu trên internet giá vé xem phim",
+            "Thời tiết Hà Nội ngày mai thế nào?",
+            "Search the web for the latest Python release",
+        ]
     
     async def execute(self, assistant, **kwargs) -> str:
         """Thực hiện tìm kiếm web bất đồng bộ"""
@@ -0,0 +1,160 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional, Tuple, TypedDict
+
+from pymongo import UpdateOne
+
+from config import settings as config
+from utils.lru_cache import LRUCache
+from utils.metrics import metrics
+from utils.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+class ChatTurn(TypedDict):
+    user: str
+    assistant: str
+    timestamp: datetime
+
+
+class ChatHistoryCache:
+    """
+    Recent chat turns per user, kept in memory as a ring buffer of `turns` entries with
+    an LRU over `max_users` users, in front of the user documents in MongoDB.
+
+    A user's buffer is loaded lazily (one `$slice` read, in a worker thread, shared by
+    concurrent requests) and updated in memory on every new turn. Writes go through a
+    write-behind queue: a background task batches them into one `bulk_write` per flush,
+    so answering a question never waits on MongoDB.
+    """
+
+    def __init__(self, collection, max_users: int = config.CHAT_HISTORY_CACHE_USERS,
+                 turns: int = config.CHAT_HISTORY_TURNS, max_pending: int = config.CHAT_HISTORY_WRITE_QUEUE,
+                 batch_size: int = config.CHAT_HISTORY_WRITE_BATCH, retries: int = config.CHAT_HISTORY_WRITE_RETRIES):
+        self.collection = collection
+        self.turns = turns
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.retries = retries
+        self._buffers = LRUCache("chat_history", max_size=max_users)
+        self._load_flight = SingleFlight("chat_history_load")
+        # Lượt đã ghi vào bộ nhớ nhưng chưa ghi xuống MongoDB, để lần tải lại (sau khi bị LRU loại) không bỏ sót
+        self._unflushed: Dict[str, List[ChatTurn]] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+
+    async def recent(self, username: str, limit: Optional[int] = None) -> List[ChatTurn]:
+        """The user's last `limit` turns (at most `turns`), oldest first."""
+        if self.collection is None or not username:
+            return []
+        buffer = self._buffers.get(username)
+        if buffer is None:
+            buffer = await self._load_flight.do(username, lambda: self._load(username))
+        turns = list(buffer)
+        return turns[-limit:] if limit else turns
+
+    async def _load(self, username: str) -> Deque[ChatTurn]:
+        try:
+            user_data = await asyncio.to_thread(
+                self.collection.find_one, {"_id": username}, {"chat_history": {"$slice": -self.turns}}
+            )
+        except Exception as e:
+            # Không lưu vào cache: lần sau thử đọc lại
+            logger.error(f"Failed to load chat history for user {username}: {e}")
+            return deque(maxlen=self.turns)
+        stored = (user_data or {}).get("chat_history") or []
+        buffer: Deque[ChatTurn] = deque(stored, maxlen=self.turns)
+        buffer.extend(self._unflushed.get(username, []))
+        self._buffers.put(username, buffer)
+        return buffer
+
+    async def append(self, username: str, question: str, response: str) -> None:
+        """Records a turn in memory at once and queues it for MongoDB."""
+        if self.collection is None or not username:
+            return
+        turn = ChatTurn(user=question, assistant=response, timestamp=datetime.now(timezone.utc))
+        buffer = self._buffers.get(username)
+        if buffer is not None:
+            buffer.append(turn)
+        self._unflushed.setdefault(username, []).append(turn)
+        self._ensure_writer()
+        # Hàng đợi đầy nghĩa là MongoDB chậm hơn lưu lượng: chỉ lúc đó lời gọi mới phải chờ
+        await self._queue.put((username, turn))
+        metrics.set_gauge("chat_history.pending_writes", self._queue.qsize())
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None or self._writer.done():
+            if self._queue is None:
+                self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._writer = asyncio.get_running_loop().create_task(self._write_loop())
+
+    async def _write_loop(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await self._write(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+                metrics.set_gauge("chat_history.pending_writes", self._queue.qsize())
+
+    async def _write(self, batch: List[Tuple[str, ChatTurn]]) -> None:
+        by_user: Dict[str, List[ChatTurn]] = {}
+        for username, turn in batch:
+            by_user.setdefault(username, []).append(turn)
+        operations = [
+            UpdateOne(
+                {"_id": username},
+                {
+                    "$push": {"chat_history": {"$each": turns}},
+                    "$inc": {"chat_history_count": len(turns)},
+                    "$set": {"last_activity": turns[-1]["timestamp"]},
+                    "$setOnInsert": {"username": username}
+                },
+                upsert=True
+            )
+            for username, turns in by_user.items()
+        ]
+        for attempt in range(self.retries + 1):
+            try:
+                await asyncio.to_thread(self.collection.bulk_write, operations, ordered=False)
+                metrics.increment("chat_history.writes", len(batch))
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    metrics.increment("chat_history.write_errors", len(batch))
+                    logger.error(f"Failed to save {len(batch)} chat turn(s) for {list(by_user)}: {e}")
+                    break
+                await asyncio.sleep(0.5 * 2 ** attempt)
+        for username, turns in by_user.items():
+            pending = self._unflushed.get(username)
+            if pending is not None:
+                del pending[:len(turns)]
+                if not pending:
+                    del self._unflushed[username]
+
+    async def flush(self, timeout: Optional[float] = None) -> None:
+        """Waits (up to `timeout` seconds) until every queued turn is written, then stops the writer."""
+        if self._writer is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Chat history flush timed out with {self._queue.qsize()} turn(s) unwritten")
+        self._writer.cancel()
+        try:
+            await self._writer
+        except asyncio.CancelledError:
+            pass
+        self._writer = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "users": len(self._buffers),
+            "pending_writes": self._queue.qsize() if self._queue is not None else 0,
+        }
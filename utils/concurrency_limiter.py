@@ -0,0 +1,205 @@
+import asyncio
+import contextlib
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import AsyncIterator, Deque, Dict, Iterator, Optional
+
+from config import settings as config
+from utils.metrics import metrics
+from utils.tracing import current_span
+
+logger = logging.getLogger(__name__)
+
+# Thứ tự ưu tiên: sinh câu trả lời cho người dùng trước, rồi định tuyến, cuối cùng là việc chạy nền
+PRIORITIES: Dict[str, int] = {"interactive": 0, "routing": 1, "background": 2}
+
+_priority: ContextVar[str] = ContextVar("llm_priority", default="interactive")
+
+
+@contextlib.contextmanager
+def priority(name: str) -> Iterator[None]:
+    """Runs the LLM calls made inside the block (and in tasks it starts) at priority `name`."""
+    if name not in PRIORITIES:
+        raise ValueError(f"Unknown priority: {name}")
+    token = _priority.set(name)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+def is_rate_limited(exc: BaseException) -> bool:
+    """True for provider throttling errors (HTTP 429 / RESOURCE_EXHAUSTED), whatever the client library."""
+    for attr in ("status_code", "code", "status"):
+        value = getattr(exc, attr, None)
+        if value == 429 or getattr(value, "value", None) == 429:
+            return True
+    text = f"{type(exc).__name__} {exc}".lower()
+    return any(marker in text for marker in ("429", "resourceexhausted", "resource_exhausted", "rate limit", "quota"))
+
+
+class LimiterRejected(Exception):
+    """Raised instead of queueing when a priority's queue is full or its wait times out."""
+
+    def __init__(self, name: str, priority: str, reason: str):
+        super().__init__(f"{name}: {priority} call rejected ({reason})")
+        self.priority = priority
+        self.reason = reason
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Async concurrency limit with priority queues and an AIMD-adjusted limit.
+
+    Each success within `latency_target` seconds grows the limit by 1/limit (about +1 per
+    window of `limit` calls); a throttling error or a slower call multiplies it by
+    `backoff`, at most once per window: calls that started before the last decrease do
+    not decrease it again. Waiters are served strictly by priority, and each priority has
+    a bounded queue that rejects new calls at once when full.
+    """
+
+    def __init__(self, name: str, initial_limit: int = 8, min_limit: int = 1, max_limit: int = 32,
+                 queue_sizes: Optional[Dict[str, int]] = None, queue_timeout: Optional[float] = 10.0,
+                 latency_target: float = 15.0, backoff: float = 0.5):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.queue_sizes = {p: (queue_sizes or {}).get(p, 64) for p in PRIORITIES}
+        self.queue_timeout = queue_timeout
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {p: deque() for p in PRIORITIES}
+        self._last_decrease = 0.0
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._waiters.values())
+
+    def _has_waiters(self, up_to: str) -> bool:
+        """Whether a call of priority `up_to` or more urgent is already waiting."""
+        return any(self._waiters[p] for p in PRIORITIES if PRIORITIES[p] <= PRIORITIES[up_to])
+
+    def busy(self, up_to: str = "interactive", max_load: float = 1.0) -> bool:
+        """Whether calls of priority `up_to` or more urgent are queued, or `max_load` of the limit is in use."""
+        return self._has_waiters(up_to) or self.in_flight >= max_load * self.limit
+
+    async def _acquire(self, priority: str) -> None:
+        if self.in_flight < int(self.limit) and not self._has_waiters(priority):
+            self.in_flight += 1
+            return
+        queue = self._waiters[priority]
+        if len(queue) >= self.queue_sizes[priority]:
+            self._reject(priority, "queue_full")
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        self._publish()
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # Vừa được cấp chỗ đúng lúc bỏ cuộc: trả lại chỗ cho người kế tiếp
+                self.in_flight -= 1
+                self._wake()
+            elif future in queue:
+                queue.remove(future)
+            self._publish()
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject(priority, "timeout")
+            raise
+
+    def _reject(self, priority: str, reason: str) -> None:
+        metrics.increment(f"{self.name}.rejected.{reason}")
+        metrics.increment(f"{self.name}.rejected.{priority}")
+        raise LimiterRejected(self.name, priority, reason)
+
+    def _wake(self) -> None:
+        for p in PRIORITIES:
+            queue = self._waiters[p]
+            while queue and self.in_flight < int(self.limit):
+                future = queue.popleft()
+                if future.done():
+                    continue
+                self.in_flight += 1
+                future.set_result(None)
+
+    def _release(self, started: float, exc: Optional[BaseException]) -> None:
+        self.in_flight -= 1
+        latency = time.monotonic() - started
+        if isinstance(exc, (asyncio.CancelledError, GeneratorExit)):
+            # Lời gọi bị hủy không nói gì về tải của nhà cung cấp
+            pass
+        elif exc is not None and is_rate_limited(exc):
+            metrics.increment(f"{self.name}.throttled")
+            self._decrease(started, "throttled")
+        elif exc is None and latency > self.latency_target:
+            metrics.increment(f"{self.name}.slow")
+            self._decrease(started, "slow")
+        elif exc is None:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        self._wake()
+        self._publish()
+
+    def _decrease(self, started: float, reason: str) -> None:
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        previous = self.limit
+        self.limit = max(float(self.min_limit), self.limit * self.backoff)
+        metrics.increment(f"{self.name}.decreases")
+        logger.warning(f"{self.name}: concurrency limit {previous:.1f} -> {self.limit:.1f} ({reason})")
+
+    def _publish(self) -> None:
+        metrics.set_gauge(f"{self.name}.limit", round(self.limit, 2))
+        metrics.set_gauge(f"{self.name}.in_flight", self.in_flight)
+        metrics.set_gauge(f"{self.name}.queued", self.queued)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: Optional[str] = None) -> AsyncIterator[None]:
+        """Holds one unit of concurrency for the block; raises LimiterRejected instead of waiting too long."""
+        priority = priority or current_priority()
+        queued_at = time.monotonic()
+        await self._acquire(priority)
+        started = time.monotonic()
+        metrics.increment(f"{self.name}.admitted.{priority}")
+        metrics.set_gauge(f"{self.name}.last_wait_ms", round((started - queued_at) * 1000, 1))
+        current_span().set_attribute("limiter.wait_ms", round((started - queued_at) * 1000, 1))
+        self._publish()
+        exc: Optional[BaseException] = None
+        try:
+            yield
+        except BaseException as e:
+            exc = e
+            raise
+        finally:
+            self._release(started, exc)
+
+
+_limiter: Optional[AdaptiveConcurrencyLimiter] = None
+
+
+def get_llm_limiter() -> AdaptiveConcurrencyLimiter:
+    """Process-wide limiter shared by every outbound LLM call."""
+    global _limiter
+    if _limiter is None:
+        _limiter = AdaptiveConcurrencyLimiter(
+            "llm_limiter",
+            initial_limit=config.LLM_CONCURRENCY_INITIAL,
+            min_limit=config.LLM_CONCURRENCY_MIN,
+            max_limit=config.LLM_CONCURRENCY_MAX,
+            queue_sizes={
+                "interactive": config.LLM_QUEUE_SIZE_INTERACTIVE,
+                "routing": config.LLM_QUEUE_SIZE_ROUTING,
+                "background": config.LLM_QUEUE_SIZE_BACKGROUND,
+            },
+            queue_timeout=config.LLM_QUEUE_TIMEOUT_SECONDS or None,
+            latency_target=config.LLM_LATENCY_TARGET_SECONDS
+        )
+    return _limiter
@@ -0,0 +1,260 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, TypedDict
+
+from config import settings as config
+from utils.metrics import metrics
+from utils.single_flight import make_key
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_topic(topic: str) -> str:
+    """Case-, whitespace- and trailing-punctuation-insensitive form of a topic."""
+    topic = unicodedata.normalize("NFC", topic or "").lower()
+    return re.sub(r"\s+", " ", topic).strip(" \t\n?!.,;:\"'")
+
+
+def context_fingerprint(chunks: Optional[Sequence[Dict[str, Any]]] = None, context_text: Optional[str] = None) -> str:
+    """
+    Identifies the retrieved context: the sorted chunk ids when known (ids are content
+    hashes, so re-indexed chunks get new ids), otherwise a hash of the context text.
+    """
+    ids = sorted(str(chunk["id"]) for chunk in chunks or [] if chunk.get("id") is not None)
+    if ids:
+        return "ids:" + hashlib.sha1(",".join(ids).encode("utf-8")).hexdigest()
+    return "text:" + hashlib.sha1((context_text or "").encode("utf-8")).hexdigest()
+
+
+# Phần còn lại của yêu cầu (ngoài chủ đề) chỉ được gồm các từ này thì mới dùng bản sinh trước của tài liệu:
+# "Tóm tắt giúp em chương 2" khớp, "Tóm tắt hồi quy tuyến tính và hồi quy logistic" thì không
+_REQUEST_WORDS = set("""
+tóm tắt vẽ tạo làm lập soạn sinh cho tôi em mình giúp hãy xin làm ơn về của phần chủ đề nội dung bài chương
+sơ đồ tư duy thẻ ghi nhớ học flashcard flashcards bộ một các những ngắn gọn chi tiết bản giùm với nhé nha ạ
+summarize summarise summary create make generate build draw write give me a an the of on about for please
+mind map maps cards card deck
+""".split())
+
+# Tài liệu đang được sinh trước trong ngữ cảnh hiện tại (dấu vân tay nội dung của nó)
+_document: ContextVar[Optional[str]] = ContextVar("pregenerated_document", default=None)
+
+
+@contextlib.contextmanager
+def document_scope(fingerprint: str) -> Iterator[None]:
+    """Stores the generations made inside the block under the document `fingerprint` and their topic."""
+    token = _document.set(fingerprint)
+    try:
+        yield
+    finally:
+        _document.reset(token)
+
+
+def current_document() -> Optional[str]:
+    return _document.get()
+
+
+def document_key_fingerprint(fingerprint: str) -> str:
+    """Context part of the cache key of a generation pre-generated for a whole document."""
+    return "doc:" + fingerprint
+
+
+def _contains_phrase(text: str, phrase: str) -> Optional[str]:
+    """`text` without `phrase` when it occurs there as whole words, else None."""
+    match = re.search(rf"(?<!\w){re.escape(phrase)}(?!\w)", text)
+    if match is None:
+        return None
+    return text[:match.start()] + " " + text[match.end():]
+
+
+class DocumentTopic(TypedDict):
+    fingerprint: str
+    source: str
+    topic: str
+
+
+class GenerationCache:
+    """
+    Persistent SQLite cache of LLM generations, with LRU eviction above `max_entries`
+    and a TTL (seconds). Keys include the retrieved chunk ids, so generations over
+    changed chunks are never served; their stale entries age out through LRU/TTL.
+    Pre-generated documents are also recorded (chunk ids and topics), so a request whose
+    retrieved chunks belong to one can be served the generation of the topic it names.
+    """
+
+    def __init__(self, path: str, max_entries: int = 2000, ttl: Optional[float] = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS generations ("
+                "key TEXT PRIMARY KEY, tool TEXT, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_generations_access ON generations(last_access)")
+            # Chủ đề của các tài liệu đã sinh trước, để yêu cầu của người dùng tìm lại bản sinh theo (tài liệu, chủ đề)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "fingerprint TEXT PRIMARY KEY, source TEXT NOT NULL, owner TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS document_chunks (chunk_id TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+                "PRIMARY KEY (chunk_id, fingerprint))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS document_topics (fingerprint TEXT NOT NULL, alias TEXT NOT NULL, "
+                "topic TEXT NOT NULL, PRIMARY KEY (fingerprint, alias))"
+            )
+
+    @staticmethod
+    def make_key(tool: str, topic: str, fingerprint: str, prompt_version: str, model: Optional[str]) -> str:
+        return make_key(tool, normalize_topic(topic), fingerprint, prompt_version, model)
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created_at FROM generations WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and row[1] + self.ttl < now:
+                self._conn.execute("DELETE FROM generations WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                metrics.increment("generation_cache.misses")
+                return None
+            self._conn.execute("UPDATE generations SET last_access = ? WHERE key = ?", (now, key))
+        metrics.increment("generation_cache.hits")
+        return json.loads(row[0])
+
+    def put(self, key: str, value: Any, tool: Optional[str] = None) -> None:
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO generations (key, tool, value, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, tool, json.dumps(value, ensure_ascii=False, default=str), now, now)
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            expired = self._conn.execute("DELETE FROM generations WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+            if expired:
+                metrics.increment("generation_cache.expired", expired)
+        overflow = self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM generations WHERE key IN (SELECT key FROM generations ORDER BY last_access LIMIT ?)", (overflow,)
+            )
+            metrics.increment("generation_cache.evictions", overflow)
+
+    def register_document(self, source: str, owner: str, chunk_ids: Iterable[Any],
+                          topics: Dict[str, List[str]]) -> str:
+        """
+        Records a pre-generated document: its chunk ids and its topics, each with the
+        aliases a request may name it by. Replaces an earlier version of the same
+        (source, owner). Returns the document fingerprint used in the cache keys.
+        """
+        ids = sorted({str(chunk_id) for chunk_id in chunk_ids})
+        fingerprint = context_fingerprint([{"id": chunk_id} for chunk_id in ids])
+        with self._lock, self._conn:
+            previous = [row[0] for row in self._conn.execute(
+                "SELECT fingerprint FROM documents WHERE source = ? AND owner = ?", (source, owner))]
+            for old in previous:
+                self._conn.execute("DELETE FROM document_chunks WHERE fingerprint = ?", (old,))
+                self._conn.execute("DELETE FROM document_topics WHERE fingerprint = ?", (old,))
+            self._conn.execute("DELETE FROM documents WHERE source = ? AND owner = ?", (source, owner))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (fingerprint, source, owner, created_at) VALUES (?, ?, ?, ?)",
+                (fingerprint, source, owner, time.time())
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO document_chunks (chunk_id, fingerprint) VALUES (?, ?)",
+                [(chunk_id, fingerprint) for chunk_id in ids]
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO document_topics (fingerprint, alias, topic) VALUES (?, ?, ?)",
+                [(fingerprint, normalize_topic(alias), topic) for topic, aliases in topics.items()
+                 for alias in aliases if normalize_topic(alias)]
+            )
+        return fingerprint
+
+    def match_document_topic(self, request: str, chunk_ids: Iterable[Any]) -> Optional[DocumentTopic]:
+        """
+        The pre-generated topic a request asks for: one of the documents the retrieved
+        chunks belong to (so the caller can read it) has a topic named in the request, and
+        the rest of the request is only request wording. The longest such topic wins.
+        """
+        ids = list({str(chunk_id) for chunk_id in chunk_ids if chunk_id is not None})
+        if not ids:
+            return None
+        text = normalize_topic(request)
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT t.fingerprint, d.source, t.alias, t.topic FROM document_topics t "
+                "JOIN documents d ON d.fingerprint = t.fingerprint "
+                f"WHERE t.fingerprint IN (SELECT DISTINCT fingerprint FROM document_chunks WHERE chunk_id IN ({placeholders}))",
+                ids
+            ).fetchall()
+        best: Optional[DocumentTopic] = None
+        best_length = 0
+        for fingerprint, source, alias, topic in rows:
+            rest = _contains_phrase(text, alias)
+            if rest is None or len(alias) <= best_length:
+                continue
+            if all(word in _REQUEST_WORDS for word in re.findall(r"\w+", rest)):
+                best, best_length = DocumentTopic(fingerprint=fingerprint, source=source, topic=topic), len(alias)
+        return best
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM generations")
+            self._conn.execute("DELETE FROM document_topics")
+            self._conn.execute("DELETE FROM document_chunks")
+            self._conn.execute("DELETE FROM documents")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+        return {"path": self.path, "entries": count, "max_entries": self.max_entries, "ttl": self.ttl}
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+_cache: Optional[GenerationCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_generation_cache() -> Optional[GenerationCache]:
+    """Process-wide generation cache from config, or None when disabled or unavailable."""
+    global _cache
+    if not config.GENERATION_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    _cache = GenerationCache(
+                        config.GENERATION_CACHE_PATH,
+                        max_entries=config.GENERATION_CACHE_MAX_ENTRIES,
+                        ttl=config.GENERATION_CACHE_TTL_SECONDS or None
+                    )
+                except sqlite3.Error as e:
+                    logger.error(f"Generation cache unavailable ({config.GENERATION_CACHE_PATH}): {e}")
+                    return None
+    return _cache
+
@@ -0,0 +1,106 @@
+import json
+import re
+from typing import Any
+
+from utils.metrics import metrics
+
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r",(\s*[}\]])")
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _fix_outside_strings(text: str) -> str:
+    """
+    Removes // and /* */ comments (the prompts' examples contain some) and turns Python
+    literals into JSON ones, leaving string contents untouched.
+    """
+    out, i, in_string = [], 0, False
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if ch == "\\" and i + 1 < len(text):
+                out.append(text[i + 1])
+                i += 1
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif text.startswith("//", i):
+            i = text.find("\n", i)
+            if i == -1:
+                break
+            continue
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = len(text) if end == -1 else end + 2
+            continue
+        elif ch.isalpha():
+            word = re.match(r"\w+", text[i:]).group(0)
+            out.append(_LITERALS.get(word, word))
+            i += len(word)
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def _close_truncated(text: str) -> str:
+    """Closes an unterminated string and any brackets left open by a cut-off response."""
+    stack, in_string, escaped = [], False, False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]" and stack:
+            stack.pop()
+    if in_string:
+        text += '"'
+    text = re.sub(r"[,:]\s*$", "", text.rstrip())
+    return text + "".join(reversed(stack))
+
+
+def repair_json(text: str) -> str:
+    """
+    Cheap textual fixes for common LLM JSON mistakes: code fences, prose around the
+    object, comments, trailing commas, Python literals and truncation.
+    """
+    text = _FENCE_RE.sub("", text.strip())
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if starts:
+        text = text[min(starts):]
+        end = max(text.rfind("}"), text.rfind("]"))
+        if end != -1 and _close_truncated(text[:end + 1]) == text[:end + 1]:
+            text = text[:end + 1]
+    text = _fix_outside_strings(text)
+    text = _close_truncated(text)
+    return _TRAILING_COMMA_RE.sub(r"\1", text)
+
+
+def loads_llm_json(text: str) -> Any:
+    """
+    Parses a JSON response from the LLM, repairing it once when it does not parse as is.
+    Raises json.JSONDecodeError when even the repaired text is invalid.
+    """
+    cleaned = _FENCE_RE.sub("", text.strip())
+    try:
+        return json.loads(cleaned)
+    except json.JSONDecodeError:
+        pass
+    try:
+        result = json.loads(repair_json(text))
+    except json.JSONDecodeError:
+        metrics.increment("json_repair.failed")
+        raise
+    metrics.increment("json_repair.repaired")
+    return result
@@ -0,0 +1,39 @@
+import threading
+from typing import Dict, Any
+
+
+class Metrics:
+    """Thread-safe in-process counters and gauges, exposed through /metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, Any] = {}
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: Any) -> None:
+        with self._lock:
+            self._gauges[name] = value
+
+    def get(self, name: str, default: Any = 0) -> Any:
+        with self._lock:
+            if name in self._counters:
+                return self._counters[name]
+            return self._gauges.get(name, default)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Returns a copy of all counters and gauges."""
+        with self._lock:
+            return {"counters": dict(self._counters), "gauges": dict(self._gauges)}
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+
+
+# Registry dùng chung cho toàn bộ tiến trình
+metrics = Metrics()
@@ -0,0 +1,51 @@
+from typing import Any, Dict, Iterable, List, Optional
+from config import settings as config
+
+COURSE_PREFIX = "course:"
+
+
+def course_partition_key(subject: str) -> str:
+    """Partition key for documents shared by everyone in a course/subject."""
+    return f"{COURSE_PREFIX}{subject.strip().lower()}"
+
+
+def is_reserved_username(username: Optional[str]) -> bool:
+    """Usernames that would collide with the shared partition or a course partition."""
+    name = (username or "").strip().lower()
+    return name == config.SHARED_PARTITION_KEY.lower() or name.startswith(COURSE_PREFIX)
+
+
+def user_courses(user: Optional[Dict[str, Any]]) -> List[str]:
+    """Courses the user is enrolled in, from the "courses" list of their profile."""
+    courses = (user or {}).get("courses") or []
+    if isinstance(courses, str):
+        courses = [courses]
+    return [course.strip().lower() for course in courses if isinstance(course, str) and course.strip()]
+
+
+def is_course_member(user: Optional[Dict[str, Any]], course: Optional[str]) -> bool:
+    """Whether `user` may read and upload documents of `course`."""
+    return bool(course and course.strip()) and course.strip().lower() in user_courses(user)
+
+
+def owner_for_upload(username: Optional[str], subject: Optional[str] = None) -> str:
+    """Chooses the partition key an uploaded document is stored under."""
+    if subject and subject.strip():
+        return course_partition_key(subject)
+    if username:
+        return username
+    return config.SHARED_PARTITION_KEY
+
+
+def partition_keys_for(username: Optional[str], courses: Optional[Iterable[str]] = None) -> List[str]:
+    """Partitions a caller may search: shared documents, their own uploads and their courses."""
+    keys = [config.SHARED_PARTITION_KEY]
+    # Tên trùng phân vùng dùng chung/khóa học không bao giờ được coi là phân vùng riêng của người dùng
+    if username and not is_reserved_username(username):
+        keys.append(username)
+    if isinstance(courses, str):
+        courses = [courses]
+    for course in courses or []:
+        if course and course.strip():
+            keys.append(course_partition_key(course))
+    return list(dict.fromkeys(keys))
@@ -0,0 +1,52 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def make_key(*parts: Any) -> str:
+    """Builds a stable hash key from JSON-serialisable call inputs."""
+    raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical async calls so that only one of them runs.
+
+    The first caller for a key starts the work as a separate task; callers that
+    arrive while it is still in flight await the same task. The shared task is
+    shielded, so one caller timing out does not cancel the work for the others.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        metrics.increment(f"single_flight.{self.name}.calls")
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t, k=key: self._forget(k, t))
+        else:
+            metrics.increment(f"single_flight.{self.name}.coalesced")
+            logger.debug(f"SingleFlight[{self.name}]: joined in-flight call {key[:12]}")
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Lấy exception để tránh cảnh báo "exception was never retrieved" khi mọi caller đã hủy
+        if not task.cancelled():
+            task.exception()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
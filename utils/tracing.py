@@ -0,0 +1,348 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Sequence
+
+from config import settings as config
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # OpenTelemetry là tùy chọn: khi có SDK được cấu hình, span được gửi thêm qua nó
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+
+
+class Span:
+    """
+    A timed operation, shaped like an OpenTelemetry span: ids, parent, start/end times in
+    nanoseconds since the epoch, attributes and an OK/ERROR status.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional["Span"], trace: Optional["Trace"],
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace = trace
+        self.trace_id = parent.trace_id if parent else (trace.trace_id if trace else uuid.uuid4().hex)
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "OK"
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self._otel = None
+        if tracer.otel is not None:
+            context = otel_trace.set_span_in_context(parent._otel) if parent is not None and parent._otel else None
+            self._otel = tracer.otel.start_span(name, context=context, attributes=self.attributes, start_time=self.start_time)
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_time if self.end_time is not None else time.time_ns()
+        return (end - self.start_time) / 1e6
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+        if self._otel is not None:
+            self._otel.set_attribute(key, value)
+
+    def record_exception(self, exc: BaseException) -> None:
+        self.status = "ERROR"
+        self.attributes["exception.type"] = type(exc).__name__
+        self.attributes["exception.message"] = str(exc)[:200]
+        if self._otel is not None:
+            self._otel.record_exception(exc)
+            self._otel.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR))
+
+    def end(self) -> None:
+        if self.end_time is not None:
+            return
+        self.end_time = time.time_ns()
+        if self._otel is not None:
+            self._otel.end(end_time=self.end_time)
+        if self.trace is not None:
+            self.trace.add(self)
+        self.tracer.export(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "request_id": self.trace.request_id if self.trace else None,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration_ms": round(self.duration_ms, 2),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """Returned when tracing is disabled; accepts and drops everything."""
+    trace = None
+    duration_ms = 0.0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def record_exception(self, exc: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """The spans of one request, used for the per-request timing breakdown."""
+
+    def __init__(self, name: str, request_id: Optional[str] = None):
+        self.name = name
+        self.request_id = request_id or uuid.uuid4().hex
+        self.trace_id = uuid.uuid4().hex
+        self.root: Optional[Span] = None
+        self._spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+
+    @property
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def breakdown(self) -> Dict[str, Any]:
+        """
+        Total time per span name (spans of the same name are summed, so stages that run
+        concurrently can add up to more than `total_ms`).
+        """
+        stages: Dict[str, Dict[str, Any]] = {}
+        for span in self.spans:
+            if span is self.root:
+                continue
+            stage = stages.setdefault(span.name, {"ms": 0.0, "count": 0})
+            stage["ms"] += span.duration_ms
+            stage["count"] += 1
+            if span.status == "ERROR":
+                stage["errors"] = stage.get("errors", 0) + 1
+        for stage in stages.values():
+            stage["ms"] = round(stage["ms"], 1)
+        return {
+            "request_id": self.request_id,
+            "trace_id": self.trace_id,
+            "total_ms": round(self.root.duration_ms, 1) if self.root else None,
+            "stages": stages,
+        }
+
+
+class InMemorySpanExporter:
+    """Keeps the most recent finished spans in memory (served by GET /traces/{request_id})."""
+
+    def __init__(self, max_spans: int = 2048):
+        self._spans: Deque[Span] = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[Span]) -> None:
+        with self._lock:
+            self._spans.extend(spans)
+
+    def get_finished_spans(self, request_id: Optional[str] = None) -> List[Span]:
+        with self._lock:
+            spans = list(self._spans)
+        if request_id is None:
+            return spans
+        return [span for span in spans if span.trace is not None and span.trace.request_id == request_id]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+    def shutdown(self) -> None:
+        self.clear()
+
+
+class FileSpanExporter:
+    """Appends finished spans to a JSON Lines file, one span per line."""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[Span]) -> None:
+        lines = "".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n" for span in spans)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+class Tracer:
+    """
+    Creates spans that nest through a context variable (so they follow asyncio tasks)
+    and hands finished spans to the exporters. With `otel=True` and opentelemetry-api
+    installed, every span is mirrored to the global OpenTelemetry tracer as well.
+    """
+
+    def __init__(self, exporters: Sequence[Any] = (), enabled: bool = True, otel: bool = False):
+        self.exporters = list(exporters)
+        self.enabled = enabled
+        # Exporter trong bộ nhớ (nếu có) phục vụ tra cứu span theo request
+        self.memory_exporter = next((e for e in self.exporters if isinstance(e, InMemorySpanExporter)), None)
+        self.otel = otel_trace.get_tracer("edumentor") if otel and otel_trace is not None else None
+
+    def export(self, span: Span) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export([span])
+            except Exception as e:
+                logger.warning(f"Span exporter {type(exporter).__name__} failed: {e}")
+
+    def start_span(self, name: str, **attributes: Any) -> Span:
+        """
+        Starts a span under the current one without making it current; the caller ends it.
+        Use it where the work spans several steps that may run in different contexts
+        (async generators consumed through separate tasks).
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return Span(self, name, _current_span.get(), _current_trace.get(), attributes)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Runs the block inside a new span, current for the block and the tasks it starts."""
+        if not self.enabled:
+            yield _NOOP_SPAN
+            return
+        span = self.start_span(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except asyncio.CancelledError:
+            # Bị hủy (ví dụ truy xuất suy đoán bị bỏ) không phải là lỗi
+            span.set_attribute("cancelled", True)
+            raise
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def start_trace(self, name: str, request_id: Optional[str] = None) -> Trace:
+        """Starts the trace of one request and its root span; finish it with `end_trace`."""
+        trace = Trace(name, request_id)
+        if self.enabled:
+            trace.root = Span(self, name, None, trace, {"request_id": trace.request_id})
+        return trace
+
+    @contextlib.contextmanager
+    def use_trace(self, trace: Trace) -> Iterator[Trace]:
+        """Makes `trace` (and its root span) current for the block."""
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(trace.root)
+        try:
+            yield trace
+        finally:
+            _current_span.reset(span_token)
+            _current_trace.reset(trace_token)
+
+    def end_trace(self, trace: Trace) -> None:
+        if trace.root is not None:
+            trace.root.end()
+
+    @contextlib.contextmanager
+    def trace_request(self, name: str, request_id: Optional[str] = None) -> Iterator[Trace]:
+        """Traces one request: the block runs under its root span."""
+        trace = self.start_trace(name, request_id)
+        try:
+            with self.use_trace(trace):
+                yield trace
+        except BaseException as e:
+            if trace.root is not None:
+                trace.root.record_exception(e)
+            raise
+        finally:
+            self.end_trace(trace)
+
+    def traced(self, name: str) -> Callable:
+        """Decorator running a sync or async function inside a span."""
+        def decorator(fn: Callable) -> Callable:
+            if inspect.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def in_context(self, name: str, fn: Callable, **attributes: Any) -> Callable:
+        """
+        Wraps `fn` to run inside a span, in the caller's context, for `run_in_executor`
+        (which, unlike asyncio.to_thread, does not carry the current span to the thread).
+        """
+        context = contextvars.copy_context()
+
+        def run(*args, **kwargs):
+            def call():
+                with self.span(name, **attributes):
+                    return fn(*args, **kwargs)
+            return context.run(call)
+        return run
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def current_span() -> Any:
+    """The current span, or a no-op span outside any span."""
+    return _current_span.get() or _NOOP_SPAN
+
+
+def _create_tracer() -> Tracer:
+    exporters: List[Any] = []
+    if config.TRACING_ENABLED:
+        exporters.append(InMemorySpanExporter(config.TRACING_MEMORY_SPANS))
+        if config.TRACING_FILE:
+            try:
+                exporters.append(FileSpanExporter(config.TRACING_FILE))
+            except OSError as e:
+                logger.warning(f"Cannot open trace file {config.TRACING_FILE}: {e}")
+    return Tracer(exporters, enabled=config.TRACING_ENABLED, otel=config.TRACING_OTEL)
+
+
+# Tracer dùng chung cho toàn bộ tiến trình
+tracer = _create_tracer()
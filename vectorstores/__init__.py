@@ -0,0 +1,21 @@
+# vectorstores/__init__.py
+from .base import VectorStore, VectorStoreUnavailable
+from .local_store import LocalVectorStore
+from config import settings as config
+
+
+def create_vector_store(collection_name: str, backend: str = None, host: str = None, port: str = None,
+                        alias: str = None) -> VectorStore:
+    """
+    Creates the configured vector store backend ("milvus" or "local").
+    `alias` names the Milvus connection so each owner can close its own.
+    """
+    backend = (backend or config.VECTOR_STORE_BACKEND).lower()
+    if backend == "local":
+        path = f"{config.LOCAL_VECTOR_STORE_DIR}/{collection_name}"
+        return LocalVectorStore(path, use_faiss=config.LOCAL_VECTOR_STORE_FAISS)
+    if backend == "milvus":
+        # Import trễ để triển khai chỉ dùng backend local không cần cài pymilvus
+        from .milvus_store import MilvusVectorStore
+        return MilvusVectorStore(collection_name, host=host or config.MILVUS_HOST, port=port or config.MILVUS_PORT, alias=alias)
+    raise ValueError(f"Unknown vector store backend: {backend}")
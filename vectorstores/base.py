@@ -0,0 +1,103 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Sequence
+from config import settings as config
+
+# Các cột được lưu trực tiếp trong mọi backend
+RECORD_FIELDS = ("id", "text", "source", "metadata", "owner")
+
+
+class VectorStoreUnavailable(RuntimeError):
+    """Raised when the vector store backend cannot serve a request."""
+
+
+def parse_metadata(metadata: Any) -> Dict[str, Any]:
+    """Decodes the JSON metadata column, tolerating dicts and malformed values."""
+    if isinstance(metadata, dict):
+        return metadata
+    try:
+        return json.loads(metadata or "{}")
+    except (json.JSONDecodeError, TypeError):
+        return {}
+
+
+def record_value(record: Dict[str, Any], field: str) -> Any:
+    """Value of `field` for a record, looking in the metadata for non-column fields."""
+    if field == "owner":
+        # Chunk cũ không có owner được coi là thuộc phân vùng dùng chung
+        return record.get("owner") or parse_metadata(record.get("metadata")).get("owner") or config.SHARED_PARTITION_KEY
+    if field in RECORD_FIELDS:
+        return record.get(field)
+    return parse_metadata(record.get("metadata")).get(field)
+
+
+def matches_filters(record: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> bool:
+    """Equality/membership match used by backends that filter in Python."""
+    for field, expected in (filters or {}).items():
+        value = record_value(record, field)
+        if isinstance(expected, (list, tuple, set)):
+            if str(value) not in {str(item) for item in expected}:
+                return False
+        elif str(value) != str(expected):
+            return False
+    return True
+
+
+class VectorStore(ABC):
+    """
+    Storage backend for chunk embeddings.
+
+    A record is a dict with the keys "id" (int), "text", "source", "metadata"
+    (JSON string), "owner" (partition key) and, on insert, "embedding".
+    Filters are {field: value} equality matches; a list/tuple value matches any
+    of its elements. Fields that are not stored columns are matched against the
+    chunk metadata.
+    """
+
+    @property
+    @abstractmethod
+    def is_ready(self) -> bool:
+        """True once the collection exists and can be searched."""
+
+    @property
+    def has_partition_key(self) -> bool:
+        """Whether records carry a physical partition key column ("owner")."""
+        return True
+
+    @abstractmethod
+    def ensure_collection(self, dim: int) -> None:
+        """Creates the collection for `dim`-dimensional embeddings if it does not exist."""
+
+    @abstractmethod
+    def insert(self, records: List[Dict[str, Any]]) -> int:
+        """Inserts (or replaces) records by id and returns the number written."""
+
+    @abstractmethod
+    def delete(self, ids: Sequence[int]) -> int:
+        """Deletes records by id and returns the number of ids requested."""
+
+    @abstractmethod
+    def search(self, embedding: Sequence[float], top_k: int,
+               filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Nearest neighbours by L2 distance; each hit also carries "distance"."""
+
+    def search_batch(self, embeddings: Sequence[Sequence[float]], top_k: int,
+                     filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """`search` for several query embeddings; backends override it with one batched call."""
+        return [self.search(embedding, top_k, filters) for embedding in embeddings]
+
+    @abstractmethod
+    def get(self, ids: Sequence[int]) -> List[Dict[str, Any]]:
+        """Returns the stored records (without embeddings) for the given ids."""
+
+    @abstractmethod
+    def query(self, filters: Optional[Dict[str, Any]] = None, limit: int = 1000,
+              offset: int = 0) -> List[Dict[str, Any]]:
+        """Scalar scan over records matching `filters`, ordered by insertion."""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """Backend name, record count and other diagnostic values."""
+
+    def close(self) -> None:
+        """Releases resources held by the backend."""
@@ -0,0 +1,145 @@
+"""
+Shared behavioural checks every VectorStore backend must pass.
+
+Enforced by tests/test_vectorstore_conformance.py (Milvus only when a server is reachable).
+Manual runs:
+    python -m vectorstores.conformance            # local NumPy backend
+    python -m vectorstores.conformance --faiss    # local backend with FAISS HNSW
+    python -m vectorstores.conformance --milvus   # Milvus at MILVUS_HOST:MILVUS_PORT
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import uuid
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from .base import VectorStore
+
+DIM = 8
+
+
+def _records(count: int = 20, start: int = 0) -> List[dict]:
+    rng = np.random.default_rng(42 + start)
+    records = []
+    for i in range(start, start + count):
+        metadata = {"source": f"doc{i % 2}.pdf", "doc_type": "pdf", "slide_number": i % 5, "owner": "alice" if i % 2 else "shared"}
+        records.append({
+            "id": 1000 + i,
+            "text": f"chunk {i}",
+            "source": metadata["source"],
+            "metadata": json.dumps(metadata),
+            "owner": metadata["owner"],
+            "embedding": rng.normal(size=DIM).astype(np.float32).tolist(),
+        })
+    return records
+
+
+def check_insert_and_stats(store: VectorStore) -> None:
+    store.ensure_collection(DIM)
+    assert store.is_ready
+    assert store.insert(_records()) == 20
+    assert store.stats()["count"] == 20
+
+
+def check_search_returns_exact_match_first(store: VectorStore) -> None:
+    target = _records()[7]
+    hits = store.search(target["embedding"], top_k=3)
+    assert hits and hits[0]["id"] == target["id"], hits
+    assert hits[0]["distance"] <= 1e-4
+    assert [h["distance"] for h in hits] == sorted(h["distance"] for h in hits)
+    assert {"id", "text", "source", "metadata", "owner", "distance"} <= set(hits[0])
+
+
+def check_search_filters(store: VectorStore) -> None:
+    target = _records()[7]
+    hits = store.search(target["embedding"], top_k=5, filters={"owner": ["shared"]})
+    assert hits and all(h["owner"] == "shared" for h in hits)
+    hits = store.search(target["embedding"], top_k=5, filters={"slide_number": 2})
+    assert hits and all(json.loads(h["metadata"])["slide_number"] == 2 for h in hits)
+    assert store.search(target["embedding"], top_k=5, filters={"source": "missing.pdf"}) == []
+
+
+def check_get_and_query(store: VectorStore) -> None:
+    got = store.get([1003, 1004, 99999])
+    assert sorted(r["id"] for r in got) == [1003, 1004]
+    rows = store.query({"owner": "alice"}, limit=100)
+    assert len(rows) == 10 and all(r["owner"] == "alice" for r in rows)
+    assert len(store.query(limit=5)) == 5
+    assert len(store.query(limit=100, offset=15)) == 5
+
+
+def check_upsert_and_delete(store: VectorStore) -> None:
+    replacement = _records(1, start=3)[0]
+    replacement["text"] = "replaced"
+    store.insert([replacement])
+    assert store.stats()["count"] == 20
+    assert store.get([replacement["id"]])[0]["text"] == "replaced"
+    store.delete([1000, 1001])
+    assert store.get([1000, 1001]) == []
+    assert store.stats()["count"] == 18
+    hits = store.search(_records()[0]["embedding"], top_k=20)
+    assert 1000 not in {h["id"] for h in hits}
+
+
+CHECKS = [
+    check_insert_and_stats,
+    check_search_returns_exact_match_first,
+    check_search_filters,
+    check_get_and_query,
+    check_upsert_and_delete,
+]
+
+
+def run_conformance(store_factory: Callable[[], VectorStore],
+                    cleanup: Optional[Callable[[VectorStore], None]] = None,
+                    checks: Optional[Sequence[Callable[[VectorStore], None]]] = None) -> None:
+    """
+    Runs `checks` (default: every check) in order against a fresh, empty store. `cleanup`
+    (e.g. dropping a temporary collection) runs before the store is closed, even when a check fails.
+    """
+    store = store_factory()
+    try:
+        for check in CHECKS if checks is None else checks:
+            check(store)
+            print(f"  ok  {check.__name__}")
+    finally:
+        try:
+            if cleanup is not None:
+                cleanup(store)
+        finally:
+            store.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="VectorStore conformance checks")
+    parser.add_argument("--milvus", action="store_true", help="Run against Milvus instead of the local backend")
+    parser.add_argument("--faiss", action="store_true", help="Use FAISS HNSW in the local backend")
+    args = parser.parse_args()
+
+    if args.milvus:
+        from .milvus_store import MilvusVectorStore
+        from pymilvus import utility
+        name = f"conformance_{uuid.uuid4().hex[:8]}"
+        # Xóa collection tạm qua alias của chính store (alias mặc định chưa từng được kết nối)
+        run_conformance(lambda: MilvusVectorStore(name),
+                        cleanup=lambda store: utility.drop_collection(name, using=store.alias))
+        return
+
+    from .local_store import LocalVectorStore
+    path = tempfile.mkdtemp(prefix="vectorstore_conformance_")
+    try:
+        run_conformance(lambda: LocalVectorStore(path, use_faiss=args.faiss))
+        # Dữ liệu phải còn nguyên sau khi mở lại từ đĩa
+        reopened = LocalVectorStore(path, use_faiss=args.faiss)
+        assert reopened.stats()["count"] == 18
+        check_search_filters(reopened)
+        print("  ok  reopen_from_disk")
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
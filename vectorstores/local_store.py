@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .base import VectorStore, matches_filters
+
+try:
+    import faiss
+except ImportError:  # FAISS là tùy chọn, mặc định tìm kiếm chính xác bằng NumPy
+    faiss = None
+
+logger = logging.getLogger(__name__)
+
+# Với bộ lọc, lấy dư từ HNSW rồi lọc; nếu vẫn thiếu thì quay về tìm kiếm chính xác
+HNSW_FILTER_OVERFETCH = 8
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process vector store: exact L2 search with NumPy, optionally accelerated
+    by a FAISS HNSW index. Records and vectors are persisted under `path`.
+    """
+
+    def __init__(self, path: str, use_faiss: bool = False, hnsw_m: int = 32, ef_search: int = 64):
+        self.path = path
+        self.use_faiss = use_faiss and faiss is not None
+        if use_faiss and faiss is None:
+            logger.warning("LocalVectorStore: faiss is not installed, falling back to exact NumPy search.")
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self._lock = threading.RLock()
+        self._records: List[Dict[str, Any]] = []
+        self._vectors: Optional[np.ndarray] = None
+        self._row_of: Dict[int, int] = {}
+        self._hnsw = None
+        self._hnsw_dirty = True
+        os.makedirs(self.path, exist_ok=True)
+        self._load()
+
+    # --- Persistence ---
+
+    @property
+    def _vectors_file(self) -> str:
+        return os.path.join(self.path, "vectors.npy")
+
+    @property
+    def _records_file(self) -> str:
+        return os.path.join(self.path, "records.jsonl")
+
+    @property
+    def _hnsw_file(self) -> str:
+        return os.path.join(self.path, "hnsw.faiss")
+
+    def _load(self) -> None:
+        if not (os.path.exists(self._vectors_file) and os.path.exists(self._records_file)):
+            return
+        vectors = np.load(self._vectors_file)
+        with open(self._records_file, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        if len(records) != len(vectors):
+            logger.error(f"LocalVectorStore: {self.path} is inconsistent ({len(records)} records, {len(vectors)} vectors); ignoring it.")
+            return
+        self._records = records
+        self._vectors = vectors.astype(np.float32)
+        self._row_of = {int(record["id"]): row for row, record in enumerate(records)}
+        if self.use_faiss and os.path.exists(self._hnsw_file):
+            index = faiss.read_index(self._hnsw_file)
+            if index.ntotal == len(records):
+                self._hnsw = index
+                self._hnsw_dirty = False
+
+    def _save(self) -> None:
+        # Ghi ra file tạm rồi đổi tên để không để lại trạng thái ghi dở
+        vectors_tmp = self._vectors_file + ".tmp.npy"
+        records_tmp = self._records_file + ".tmp"
+        np.save(vectors_tmp, self._vectors if self._vectors is not None else np.zeros((0, 0), dtype=np.float32))
+        with open(records_tmp, "w", encoding="utf-8") as f:
+            for record in self._records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(vectors_tmp, self._vectors_file)
+        os.replace(records_tmp, self._records_file)
+        if os.path.exists(self._hnsw_file) and self._hnsw_dirty:
+            os.remove(self._hnsw_file)
+
+    # --- VectorStore interface ---
+
+    @property
+    def is_ready(self) -> bool:
+        return self._vectors is not None
+
+    def ensure_collection(self, dim: int) -> None:
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((0, dim), dtype=np.float32)
+                self._save()
+
+    def insert(self, records: List[Dict[str, Any]]) -> int:
+        if not records:
+            return 0
+        with self._lock:
+            self.ensure_collection(len(records[0]["embedding"]))
+            new_vectors = np.asarray([record["embedding"] for record in records], dtype=np.float32)
+            # Ghi đè bản ghi cùng id trước khi thêm mới
+            self._delete_rows([int(record["id"]) for record in records])
+            start = len(self._records)
+            for offset, record in enumerate(records):
+                stored = {key: record.get(key) for key in ("id", "text", "source", "metadata", "owner")}
+                stored["id"] = int(stored["id"])
+                self._records.append(stored)
+                self._row_of[stored["id"]] = start + offset
+            self._vectors = np.vstack([self._vectors, new_vectors])
+            self._hnsw_dirty = True
+            self._save()
+            return len(records)
+
+    def delete(self, ids: Sequence[int]) -> int:
+        with self._lock:
+            removed = self._delete_rows([int(i) for i in ids])
+            if removed:
+                self._hnsw_dirty = True
+                self._save()
+            return len(ids)
+
+    def _delete_rows(self, ids: List[int]) -> int:
+        rows = sorted({self._row_of[i] for i in ids if i in self._row_of})
+        if not rows:
+            return 0
+        keep = np.ones(len(self._records), dtype=bool)
+        keep[rows] = False
+        self._records = [record for row, record in enumerate(self._records) if keep[row]]
+        self._vectors = self._vectors[keep]
+        self._row_of = {int(record["id"]): row for row, record in enumerate(self._records)}
+        return len(rows)
+
+    def search(self, embedding: Sequence[float], top_k: int,
+               filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            if self._vectors is None or len(self._records) == 0 or top_k <= 0:
+                return []
+            query = np.asarray(embedding, dtype=np.float32).reshape(-1)
+            if self.use_faiss:
+                hits = self._search_hnsw(query, top_k, filters)
+                if hits is not None:
+                    return hits
+            return self._search_exact(query, top_k, filters)
+
+    def _search_exact(self, query: np.ndarray, top_k: int, filters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        rows = np.arange(len(self._records))
+        if filters:
+            rows = np.asarray([row for row in rows if matches_filters(self._records[row], filters)], dtype=np.int64)
+            if len(rows) == 0:
+                return []
+        vectors = self._vectors[rows]
+        # ||v - q||^2 = ||v||^2 - 2 v.q + ||q||^2, tính cho cả ma trận một lần
+        distances = np.einsum("ij,ij->i", vectors, vectors) - 2.0 * vectors @ query + float(query @ query)
+        k = min(top_k, len(rows))
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best], kind="stable")]
+        return [self._hit(int(rows[i]), float(max(distances[i], 0.0))) for i in best]
+
+    def _search_hnsw(self, query: np.ndarray, top_k: int, filters: Optional[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+        index = self._ensure_hnsw()
+        k = min(len(self._records), top_k * HNSW_FILTER_OVERFETCH if filters else top_k)
+        distances, rows = index.search(query.reshape(1, -1), k)
+        hits = []
+        for distance, row in zip(distances[0], rows[0]):
+            if row < 0:
+                continue
+            if filters and not matches_filters(self._records[row], filters):
+                continue
+            hits.append(self._hit(int(row), float(distance)))
+            if len(hits) == top_k:
+                return hits
+        # Bộ lọc quá chọn lọc so với số ứng viên HNSW trả về
+        return hits if not filters or k == len(self._records) else None
+
+    def _ensure_hnsw(self):
+        if self._hnsw is None or self._hnsw_dirty:
+            index = faiss.IndexHNSWFlat(self._vectors.shape[1], self.hnsw_m)
+            index.hnsw.efSearch = self.ef_search
+            if len(self._vectors):
+                index.add(self._vectors)
+            self._hnsw = index
+            self._hnsw_dirty = False
+            faiss.write_index(index, self._hnsw_file)
+        return self._hnsw
+
+    def _hit(self, row: int, distance: float) -> Dict[str, Any]:
+        hit = dict(self._records[row])
+        hit["distance"] = distance
+        return hit
+
+    def get(self, ids: Sequence[int]) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(self._records[self._row_of[int(i)]]) for i in ids if int(i) in self._row_of]
+
+    def query(self, filters: Optional[Dict[str, Any]] = None, limit: int = 1000,
+              offset: int = 0) -> List[Dict[str, Any]]:
+        with self._lock:
+            matching = (record for record in self._records if matches_filters(record, filters))
+            results = []
+            for position, record in enumerate(matching):
+                if position < offset:
+                    continue
+                if len(results) >= limit:
+                    break
+                results.append(dict(record))
+            return results
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "backend": "local",
+                "path": self.path,
+                "ready": self.is_ready,
+                "count": len(self._records),
+                "dim": int(self._vectors.shape[1]) if self._vectors is not None else None,
+                "index": "hnsw" if self.use_faiss else "exact",
+                "partition_key": True,
+            }
@@ -0,0 +1,264 @@
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from pymilvus import connections, utility
+from pymilvus.exceptions import ConnectionNotExistException, MilvusUnavailableException
+
+from config import settings as config
+from utils.metrics import metrics
+from .base import VectorStoreUnavailable
+
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Errors worth retrying after a reconnect (network / server availability)."""
+    if isinstance(error, (MilvusUnavailableException, ConnectionNotExistException, ConnectionError, TimeoutError)):
+        return True
+    if grpc is not None and isinstance(error, grpc.RpcError):
+        return error.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+    return False
+
+
+class CircuitBreaker:
+    """
+    Opens after consecutive failures. After `reset_timeout` seconds it lets exactly one
+    trial call through (half-open) and rejects the rest until that call records success
+    (closed) or failure (open again).
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_started_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and now - self.opened_at < self.reset_timeout:
+                return False
+            # Chỉ một lời gọi thử; lời gọi thử không báo kết quả quá reset_timeout thì cho lời gọi khác thử
+            if self.trial_started_at is not None and now - self.trial_started_at < self.reset_timeout:
+                return False
+            self.state = CIRCUIT_HALF_OPEN
+            self.trial_started_at = now
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = CIRCUIT_CLOSED
+            self.consecutive_failures = 0
+            self.trial_started_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            self.trial_started_at = None
+            if self.state == CIRCUIT_HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.monotonic()
+
+
+class MilvusConnection:
+    """
+    Owns one named pymilvus connection alias: connects with bounded retries,
+    guards calls with a circuit breaker, and probes health in the background
+    so the alias is re-established after Milvus comes back.
+    """
+
+    def __init__(self, alias: str, host: str, port: str,
+                 max_retries: int = config.MILVUS_MAX_RETRIES,
+                 backoff_base: float = config.MILVUS_RETRY_BACKOFF,
+                 backoff_max: float = 2.0,
+                 failure_threshold: int = config.MILVUS_CIRCUIT_FAILURES,
+                 reset_timeout: float = config.MILVUS_CIRCUIT_RESET_SECONDS,
+                 timeout: float = config.MILVUS_TIMEOUT):
+        self.alias = alias
+        self.host = host
+        self.port = port
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.healthy = False
+        # Mỗi lần kết nối lại tăng generation; lỗi thấy ở generation cũ đã được xử lý bởi luồng khác
+        self._generation = 0
+        self._reconnect_lock = threading.Lock()
+        self._on_reconnect: Optional[Callable[[], None]] = None
+        self._callback_state = threading.local()
+        self._probe_thread: Optional[threading.Thread] = None
+        self._stop_probe = threading.Event()
+        self._metric_prefix = f"vector_store.milvus.{alias}"
+
+    # --- Connection lifecycle ---
+
+    def connect(self) -> bool:
+        """Connects the alias, retrying with backoff. Returns False instead of raising."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                connections.connect(alias=self.alias, host=self.host, port=self.port, timeout=self.timeout)
+                self._set_healthy(True)
+                return True
+            except Exception as e:
+                logger.warning(f"Milvus[{self.alias}]: connect attempt {attempt + 1} failed: {e}")
+                if attempt < self.max_retries:
+                    time.sleep(self._backoff(attempt))
+        self._set_healthy(False)
+        return False
+
+    def reconnect(self) -> bool:
+        """Re-establishes the alias; concurrent callers wait for one reconnect instead of each starting one."""
+        with self._reconnect_lock:
+            connected = self._reconnect_locked()
+        return self._after_reconnect(connected)
+
+    def _reconnect_locked(self) -> bool:
+        metrics.increment(f"{self._metric_prefix}.reconnects")
+        try:
+            connections.disconnect(self.alias)
+        except Exception:
+            pass
+        connected = self.connect()
+        self._generation += 1
+        return connected
+
+    def _after_reconnect(self, connected: bool) -> bool:
+        """
+        Runs the on_reconnect callback once the reconnect lock is released: the callback
+        makes guarded calls, and a transient error there recovers through the same lock.
+        """
+        if not connected or self._on_reconnect is None or getattr(self._callback_state, "running", False):
+            return connected
+        # Đánh dấu theo luồng: lần kết nối lại lồng bên trong callback không gọi lại callback
+        self._callback_state.running = True
+        try:
+            self._on_reconnect()
+        except Exception as e:
+            logger.error(f"Milvus[{self.alias}]: on_reconnect callback failed: {e}")
+        finally:
+            self._callback_state.running = False
+        return connected
+
+    def _alive(self) -> bool:
+        try:
+            utility.get_server_version(using=self.alias, timeout=self.timeout)
+            return True
+        except Exception as e:
+            logger.warning(f"Milvus[{self.alias}]: health probe failed: {e}")
+            return False
+
+    def _recover(self, generation: int) -> bool:
+        """
+        After a transient error seen at `generation`: reconnects only if no other thread has
+        reconnected since and the alias is actually dead, so one failed call does not
+        disconnect the alias under every other in-flight call sharing it. Returns whether
+        the alias is usable afterwards.
+        """
+        with self._reconnect_lock:
+            if self._generation != generation:
+                return self.healthy
+            if self._alive():
+                return True
+            self._set_healthy(False)
+            connected = self._reconnect_locked()
+        return self._after_reconnect(connected)
+
+    def probe(self) -> bool:
+        """Cheap health check against the server; reconnects when it fails."""
+        if self._alive():
+            self._set_healthy(True)
+            self.breaker.record_success()
+            return True
+        self._set_healthy(False)
+        return self._recover(self._generation)
+
+    def start_health_probe(self, interval: float = config.MILVUS_HEALTH_INTERVAL,
+                           on_reconnect: Optional[Callable[[], None]] = None) -> None:
+        self._on_reconnect = on_reconnect
+        if interval <= 0 or self._probe_thread is not None:
+            return
+
+        def run():
+            while not self._stop_probe.wait(interval):
+                self.probe()
+
+        self._probe_thread = threading.Thread(target=run, name=f"milvus-probe-{self.alias}", daemon=True)
+        self._probe_thread.start()
+
+    def close(self) -> None:
+        self._stop_probe.set()
+        # Chỉ ngắt alias của chính kết nối này, không ảnh hưởng thành phần khác
+        try:
+            connections.disconnect(self.alias)
+        except Exception as e:
+            logger.warning(f"Milvus[{self.alias}]: error while disconnecting: {e}")
+        self._set_healthy(False)
+
+    # --- Guarded calls ---
+
+    def call(self, operation: str, fn: Callable[[], Any]) -> Any:
+        """
+        Runs a Milvus operation behind the circuit breaker, retrying transient
+        errors with jittered backoff and a reconnect in between.
+        Raises VectorStoreUnavailable when Milvus cannot serve the call.
+        """
+        if not self.breaker.allow():
+            metrics.increment(f"{self._metric_prefix}.rejected")
+            raise VectorStoreUnavailable(f"Milvus circuit open for '{self.alias}', skipping {operation}")
+
+        last_error: Optional[Exception] = None
+        for attempt in range(self.max_retries + 1):
+            generation = self._generation
+            try:
+                result = fn()
+                self.breaker.record_success()
+                self._set_healthy(True)
+                self._publish_state()
+                return result
+            except Exception as e:
+                if not is_transient_error(e):
+                    # Máy chủ vẫn trả lời (lỗi của chính lời gọi): không tính là Milvus lỗi, kết thúc lời gọi thử nếu có
+                    self.breaker.record_success()
+                    raise
+                last_error = e
+                metrics.increment(f"{self._metric_prefix}.errors")
+                logger.warning(f"Milvus[{self.alias}]: {operation} failed (attempt {attempt + 1}): {e}")
+                if attempt < self.max_retries:
+                    metrics.increment(f"{self._metric_prefix}.retries")
+                    time.sleep(self._backoff(attempt))
+                    self._recover(generation)
+
+        self.breaker.record_failure()
+        self._set_healthy(False)
+        self._publish_state()
+        raise VectorStoreUnavailable(f"Milvus {operation} failed after {self.max_retries + 1} attempts: {last_error}") from last_error
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: tránh nhiều worker cùng thử lại một lúc
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _set_healthy(self, healthy: bool) -> None:
+        self.healthy = healthy
+        metrics.set_gauge(f"{self._metric_prefix}.healthy", healthy)
+
+    def _publish_state(self) -> None:
+        metrics.set_gauge(f"{self._metric_prefix}.circuit_state", self.breaker.state)
@@ -0,0 +1,247 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from pymilvus import Collection, CollectionSchema, DataType, FieldSchema, utility
+
+from config import settings as config
+from .base import VectorStore, matches_filters, parse_metadata
+from .milvus_connection import MilvusConnection
+
+logger = logging.getLogger(__name__)
+
+# Khi phải lọc bằng Python (trường không có cột riêng) thì lấy dư kết quả từ Milvus
+POST_FILTER_OVERFETCH = 4
+# Milvus giới hạn offset + limit của một truy vấn scalar
+MAX_QUERY_WINDOW = 16384
+# Cột scalar cho số slide/trang để tra cứu trực tiếp "slide_number == N"; -1 nếu chunk không có
+SLIDE_NUMBER_FIELD = "slide_number"
+
+
+class MilvusVectorStore(VectorStore):
+    """
+    Vector store backed by a Milvus collection. Every call goes through a
+    MilvusConnection on its own alias, so failures surface as
+    VectorStoreUnavailable and closing one store never disconnects another.
+    """
+
+    def __init__(self, collection_name: str, host: str = "localhost", port: str = "19530",
+                 alias: Optional[str] = None):
+        self.collection_name = collection_name
+        self.host = host
+        self.port = port
+        self.alias = alias or config.MILVUS_CONNECTION_ALIAS
+        self.collection: Optional[Collection] = None
+        self._field_names: set = set()
+        self.connection = MilvusConnection(self.alias, host, port)
+        if self.connection.connect():
+            self._open_existing()
+        else:
+            # Không chặn khởi động: health probe sẽ kết nối lại và mở collection sau
+            logger.error(f"Milvus[{self.alias}]: could not connect to {host}:{port}; starting degraded.")
+        self.connection.start_health_probe(on_reconnect=self._open_existing)
+
+    def _open_existing(self) -> None:
+        if self.collection is not None:
+            return
+        try:
+            exists = self.connection.call("has_collection", lambda: utility.has_collection(self.collection_name, using=self.alias))
+            if exists:
+                self._open(Collection(self.collection_name, using=self.alias))
+        except Exception as e:
+            logger.error(f"Milvus[{self.alias}]: could not open collection '{self.collection_name}': {e}")
+
+    def _open(self, collection: Collection) -> None:
+        self.connection.call("load", collection.load)
+        self.collection = collection
+        self._field_names = {field.name for field in self.collection.schema.fields}
+        if not self.has_partition_key:
+            logger.warning(f"Collection '{self.collection_name}' has no partition key field; owner is only stored in metadata.")
+
+    @property
+    def is_ready(self) -> bool:
+        return self.collection is not None
+
+    @property
+    def has_partition_key(self) -> bool:
+        return config.MILVUS_PARTITION_KEY_FIELD in self._field_names
+
+    def ensure_collection(self, dim: int) -> None:
+        self._open_existing()
+        if self.collection is not None:
+            return
+        fields = [
+            FieldSchema(name="id", dtype=DataType.INT64, is_primary=True, auto_id=False),
+            FieldSchema(name="text", dtype=DataType.VARCHAR, max_length=65535),
+            FieldSchema(name="source", dtype=DataType.VARCHAR, max_length=255),
+            FieldSchema(name="metadata", dtype=DataType.VARCHAR, max_length=65535),
+            # Partition key: Milvus băm giá trị này vào các phân vùng và chỉ quét phân vùng khớp khi lọc
+            FieldSchema(name=config.MILVUS_PARTITION_KEY_FIELD, dtype=DataType.VARCHAR, max_length=255, is_partition_key=True),
+            FieldSchema(name=SLIDE_NUMBER_FIELD, dtype=DataType.INT64),
+            FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=dim)
+        ]
+        schema = CollectionSchema(fields=fields, description=f"Collection for {self.collection_name}",
+                                  num_partitions=config.MILVUS_NUM_PARTITIONS)
+
+        def create():
+            collection = Collection(name=self.collection_name, schema=schema, using=self.alias)
+            collection.create_index(field_name="embedding", index_params={"metric_type": "L2", "index_type": "HNSW", "params": {"M": 8, "efConstruction": 64}})
+            return collection
+
+        self._open(self.connection.call("create_collection", create))
+
+    def _output_fields(self) -> List[str]:
+        fields = ["id", "text", "source", "metadata"]
+        if self.has_partition_key:
+            fields.append(config.MILVUS_PARTITION_KEY_FIELD)
+        return fields
+
+    def _build_expr(self, filters: Optional[Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
+        """Splits filters into a Milvus boolean expression and the rest, matched in Python."""
+        expr_parts = ["id >= 0"]
+        remaining = {}
+        for field, value in (filters or {}).items():
+            if field not in self._field_names or field in ("metadata", "embedding"):
+                remaining[field] = value
+                continue
+            if field == SLIDE_NUMBER_FIELD:
+                value = [int(v) for v in value] if isinstance(value, (list, tuple, set)) else int(value)
+            if isinstance(value, (list, tuple, set)):
+                expr_parts.append(f"{field} in {json.dumps(list(value), ensure_ascii=False)}")
+            else:
+                expr_parts.append(f"{field} == {json.dumps(value, ensure_ascii=False)}")
+        return " and ".join(expr_parts), remaining
+
+    def _to_record(self, entity: Any) -> Dict[str, Any]:
+        get = entity.get if isinstance(entity, dict) else (lambda name, default=None: getattr(entity, name, default))
+        return {
+            "id": get("id"),
+            "text": get("text", "") or "",
+            "source": get("source", "") or "",
+            "metadata": get("metadata", "{}") or "{}",
+            "owner": get(config.MILVUS_PARTITION_KEY_FIELD),
+        }
+
+    def insert(self, records: List[Dict[str, Any]]) -> int:
+        if not records:
+            return 0
+        if self.collection is None:
+            self.ensure_collection(len(records[0]["embedding"]))
+        rows = []
+        for record in records:
+            row = {name: record.get(name) for name in ("id", "text", "source", "metadata", "embedding")}
+            if self.has_partition_key:
+                row[config.MILVUS_PARTITION_KEY_FIELD] = record.get("owner") or config.SHARED_PARTITION_KEY
+            if SLIDE_NUMBER_FIELD in self._field_names:
+                slide_number = parse_metadata(record.get("metadata")).get(SLIDE_NUMBER_FIELD)
+                row[SLIDE_NUMBER_FIELD] = int(slide_number) if str(slide_number).lstrip("-").isdigit() else -1
+            rows.append(row)
+
+        def write():
+            # upsert để chèn lại cùng id không tạo bản ghi trùng khóa chính
+            self.collection.upsert(rows)
+            self.collection.flush()
+
+        self.connection.call("insert", write)
+        return len(rows)
+
+    def delete(self, ids: Sequence[int]) -> int:
+        if self.collection is None or not ids:
+            return 0
+        expr = f"id in {json.dumps([int(i) for i in ids])}"
+
+        def remove():
+            self.collection.delete(expr=expr)
+            self.collection.flush()
+
+        self.connection.call("delete", remove)
+        return len(ids)
+
+    def search(self, embedding: Sequence[float], top_k: int,
+               filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        return self.search_batch([embedding], top_k, filters)[0]
+
+    def search_batch(self, embeddings: Sequence[Sequence[float]], top_k: int,
+                     filters: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        if self.collection is None or not embeddings:
+            return [[] for _ in embeddings]
+        expr, remaining = self._build_expr(filters)
+        limit = top_k * POST_FILTER_OVERFETCH if remaining else top_k
+        # Một lời gọi search cho nhiều vector truy vấn (nq > 1)
+        results = self.connection.call("search", lambda: self.collection.search(
+            data=[list(embedding) for embedding in embeddings],
+            anns_field="embedding",
+            param={"metric_type": "L2", "params": {"nprobe": 10, "ef": max(64, limit)}},
+            limit=limit,
+            expr=expr,
+            output_fields=self._output_fields()
+        ))
+        batch_hits = []
+        for query_hits in results:
+            hits = []
+            for hit in query_hits:
+                record = self._to_record(hit.entity)
+                record["id"] = hit.id
+                if remaining and not matches_filters(record, remaining):
+                    continue
+                record["distance"] = hit.distance
+                hits.append(record)
+            batch_hits.append(hits[:top_k])
+        return batch_hits
+
+    def get(self, ids: Sequence[int]) -> List[Dict[str, Any]]:
+        if self.collection is None or not ids:
+            return []
+        expr = f"id in {json.dumps([int(i) for i in ids])}"
+        results = self.connection.call("get", lambda: self.collection.query(expr=expr, output_fields=self._output_fields()))
+        return [self._to_record(item) for item in results]
+
+    def query(self, filters: Optional[Dict[str, Any]] = None, limit: int = 1000,
+              offset: int = 0) -> List[Dict[str, Any]]:
+        if self.collection is None:
+            return []
+        expr, remaining = self._build_expr(filters)
+        if not remaining:
+            results = self.connection.call("query", lambda: self.collection.query(
+                expr=expr, output_fields=self._output_fields(), limit=limit, offset=offset))
+            return [self._to_record(item) for item in results]
+
+        # Lọc bằng Python: duyệt theo trang cho đến khi đủ `limit` bản ghi khớp (offset tính trên bản ghi khớp)
+        matched: List[Dict[str, Any]] = []
+        scan_offset = 0
+        batch = max(limit, 1000)
+        while len(matched) < offset + limit and scan_offset < MAX_QUERY_WINDOW:
+            window = min(batch, MAX_QUERY_WINDOW - scan_offset)
+            results = self.connection.call("query", lambda: self.collection.query(
+                expr=expr, output_fields=self._output_fields(), limit=window, offset=scan_offset))
+            matched.extend(record for record in map(self._to_record, results) if matches_filters(record, remaining))
+            if len(results) < window:
+                break
+            scan_offset += window
+        return matched[offset:offset + limit]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "milvus",
+            "collection": self.collection_name,
+            "ready": self.is_ready,
+            "count": self._count() if self.connection.healthy else None,
+            "partition_key": self.has_partition_key,
+            "alias": self.alias,
+            "healthy": self.connection.healthy,
+            "circuit": self.connection.breaker.state,
+        }
+
+    def _count(self) -> int:
+        if self.collection is None:
+            return 0
+        # count(*) bỏ qua bản ghi đã xóa, khác với num_entities
+        return self.connection.call("count", lambda: self.collection.query(expr="id >= 0", output_fields=["count(*)"]))[0]["count(*)"]
+
+    def close(self) -> None:
+        if self.collection is not None:
+            try:
+                self.collection.release()
+            except Exception as e:
+                logger.warning(f"Milvus[{self.alias}]: error while releasing collection: {e}")
+        self.connection.close()